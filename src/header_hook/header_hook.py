@@ -28,21 +28,68 @@ __author__ = "richad.parker@lifearc.org"
 # Imports
 #################################
 # Standard
+import argparse
+import array
+import collections
+import concurrent.futures
+import contextlib
 import copy
+import ctypes
+import ctypes.util
 import fnmatch
+import functools
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import mmap
 import os
+import queue
 import re
+import select
+import sqlite3
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
 from datetime import datetime
 from typing import Any, Tuple
 
+try:
+    # Standard
+    # Unix only (peak RSS in memory reports)
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    # Standard
+    # Unix only (Git concurrency governor)
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    # Standard
+    import tomllib
+except ImportError:
+    # Python < 3.11
+    try:
+        # 3rd party
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
 #################################
 # Settings
 #################################
 
-# Valid programming languages when deciding if a Shebang is valid or not
-# TODO: extend support beyond Python and Shell
+# Valid interpreters when deciding if a Shebang within a Python file
+# is valid or not (see `LANGUAGES` for other file types)
 VALID_LANG = [
     "python",
     "python?",
@@ -55,6 +102,49 @@ VALID_LANG = [
     "bash",
     "ksh",
 ]
+# Supported file types. For each language: the comment marker that
+# prefixes header lines, the interpreters accepted in a shebang (glob
+# matching supported; an empty list means shebangs are not allowed),
+# and the file extensions (case-insensitive) and exact file names
+# used to recognise the file type
+LANGUAGES = {
+    "python": {
+        "comment": "#",
+        "shebangs": VALID_LANG,
+        "extensions": [".py"],
+        "filenames": [],
+    },
+    "r": {
+        "comment": "#",
+        "shebangs": ["Rscript", "R"],
+        "extensions": [".r"],
+        "filenames": [],
+    },
+    "shell": {
+        "comment": "#",
+        "shebangs": ["sh", "ksh", "zsh", "dash", "bash"],
+        "extensions": [".sh", ".bash", ".ksh", ".zsh"],
+        "filenames": [],
+    },
+    "yaml": {
+        "comment": "#",
+        "shebangs": [],
+        "extensions": [".yaml", ".yml"],
+        "filenames": [],
+    },
+    "dockerfile": {
+        "comment": "#",
+        "shebangs": [],
+        "extensions": [".dockerfile"],
+        "filenames": ["Dockerfile", "Containerfile"],
+    },
+    "sql": {
+        "comment": "--",
+        "shebangs": [],
+        "extensions": [".sql"],
+        "filenames": [],
+    },
+}
 
 # Allowed section keys within the metadata block
 # Match searches are case-insensitive. In addition,
@@ -70,6 +160,7 @@ ALLOWED_KEYS = [
     "maintainer(s)",
     "created",
     "last updated",
+    "fingerprint",
     "change log",
 ]
 # List of keys that do not have a large indent added
@@ -81,7 +172,8 @@ NO_KEYVAL_INDENT = ["change log"]
 # capitalised)
 TO_CAP = ["description"]
 # Divider used to denote stand and end of header block (and also
-# defines the limit for word wrapping)
+# defines the limit for word wrapping). Other languages repeat their
+# own comment marker to the same width
 SEP = "##################################################################"
 WRAP_LIMIT = len(SEP)
 # The spacing that defines the gap between the key and the value
@@ -97,11 +189,176 @@ SECOND_KEYVAL_INDENT_N = FIRST_KEYVAL_INDENT_N - DATE_INDENT_N
 # Max number of lines the change log can be before entries get cut
 # (oldest cut first)
 LOG_LINE_LENGTH = 20
+# Branch that releases are made from
+DEFAULT_BRANCH = "main"
+# Header normalisation stages, in the order they run (see
+# `HEADER_STAGE_REGISTRY`). Stages left out are skipped
+HEADER_STAGES = [
+    "update_last_updated",
+    "changelog_trim",
+    "changelog_merger",
+    "changelog_rules",
+    "check_release_date",
+]
+# Facts that stages can ask of Git, each as the command that answers
+# it for a single file. Both are answered from the release branch
+GIT_FACTS = {
+    "last_commit": "git log -1 --format=%cd {branch} -- {path}",
+    "first_added": "git log --diff-filter=A --follow --format=%cd -1 "
+    + "{branch} -- {path}",
+}
+# Committed release manifest (see `Manifest`), relative to the
+# repository root. Used if present
+MANIFEST_FILE = ".header-hook-manifest.json"
+# Header catalogue (see `refresh_catalogue()`): default database file
+# (relative to the current directory), schema version, and the number
+# of files handed to each worker process at a time (smaller refreshes
+# run in-process)
+CATALOGUE_FILE = ".header-hook-catalogue.sqlite"
+CATALOGUE_SCHEMA = 1
+CATALOGUE_BATCH = 64
+# Default completion journal (see `Journal`), relative to the current
+# directory
+JOURNAL_FILE = ".header-hook-journal.jsonl"
+# Background audit queue (see `AuditQueue`), kept in the Git directory
+AUDIT_FILE = "header-hook-audit.json"
+# Diagnostics reported by the flake8 plugin (see `Flake8Checker`).
+# Codes are stable: new checks get new codes, retired codes aren't reused
+FLAKE8_CODES = {
+    "missing": "HDR100 Header block is missing",
+    "invalid": "HDR101 Invalid header block: {}",
+    "changed": "HDR102 Header is not in canonical form (changed: {})",
+    "degraded": "HDR103 Git-derived header checks skipped ({})",
+}
+# Multi-repository mode: files handed to a worker at a time (each
+# repository takes its turn to submit one chunk)
+REPO_CHUNK_FILES = 32
+# Git concurrency governor (see `git_slot()`): the number of Git
+# commands allowed to run at once on the machine and in each repository
+# (across all runs of the hook; 0 means no limit), where the slots are
+# kept (overridden by the `HEADER_HOOK_GIT_SLOT_DIR` environment
+# variable), and the first and longest pause between looking for a
+# free slot
+GIT_MACHINE_SLOTS = 2 * (os.cpu_count() or 1)
+GIT_REPO_SLOTS = os.cpu_count() or 1
+GIT_SLOT_DIR = os.environ.get(
+    "HEADER_HOOK_GIT_SLOT_DIR",
+    os.path.join(tempfile.gettempdir(), "header-hook-git-slots"),
+)
+GIT_SLOT_POLL_S = 0.002
+GIT_SLOT_POLL_MAX_S = 0.05
+# Runs with at least this many files fetch every Git fact needed for
+# every file up front, with one `git log` per fact. Smaller runs ask
+# Git file by file
+GIT_BATCH_MIN_FILES = 8
+# Change log normalisation rules, applied to every change log entry
+# in a single pass (by the Git-free `changelog_rules` stage). Each rule
+# is a (glob, replacement) pair. Entries matching the glob are dropped
+# if the replacement is `None`, otherwise the entry text is replaced.
+# Rules are tried in order (first match wins). The default rules drop
+# legacy "first release" entries (with or without a trailing full
+# stop), as the release entry is regenerated from Git history. Without
+# Git, the oldest such entry is kept as the release entry
+CHANGELOG_RULES = [
+    ("?irst ?elease", None),
+    ("?irst ?elease.", None),
+    ("?irst ?ommit", None),
+    ("?irst ?ommit.", None),
+    ("?nitial ?elease", None),
+    ("?nitial ?elease.", None),
+]
+# Number of hex characters kept from the header fingerprint (an optional
+# header field holding a hash of the rest of the header, plus the
+# settings that produced it)
+FINGERPRINT_LEN = 12
+# Max number of distinct (text, width, indent) combinations kept in the
+# word wrap cache. Shared across all files processed by a single run
+WRAP_CACHE_SIZE = 4096
+# Watch mode: quiet period (seconds) that must follow a burst of file
+# saves before files are re-formatted, and the scan interval used when
+# falling back to mtime polling
+WATCH_DEBOUNCE_S = 0.3
+WATCH_POLL_S = 1.0
+# Output formats. "text" prints messages for files needing attention;
+# "jsonl" streams one JSON event per file (plus a closing summary)
+OUTPUT_FORMATS = ["text", "jsonl"]
+# Ways of spreading files over workers (see `run_files()`). "auto"
+# leaves the choice to the execution planner (see `plan_execution()`)
+EXECUTORS = ["auto", "serial", "thread", "process", "pipeline"]
+# Execution planner cost model (seconds): work per file and per KB of
+# file, each Git answer asked file by file, each history walk (Git
+# answers fetched for many files at once), starting a worker thread or
+# process, and handing a file to a worker process
+PLAN_COSTS = {
+    "file": 0.0007,
+    "kb": 0.00002,
+    "git_call": 0.004,
+    "git_walk": 0.1,
+    "thread_start": 0.0005,
+    "process_start": 0.04,
+    "process_file": 0.0002,
+}
+# Pipeline executor: stages (in order), threads per stage and the
+# capacity of the queue in front of each stage
+PIPELINE_STAGES = ["read", "parse", "git", "format", "write"]
+PIPELINE_WORKERS = {"read": 2, "parse": 1, "git": 8, "format": 1, "write": 2}
+PIPELINE_QUEUE_SIZE = 64
+# Directories never descended into when searching for files
+SKIP_DIRS = [".git", ".venv", "venv", "__pycache__", "node_modules"]
+# Settings that can be overridden from the `[tool.header-hook]` table
+# of `pyproject.toml`. Maps each (TOML) key to the setting it replaces
+# and the type of value expected. Settings derived from these (e.g.,
+# `WRAP_LIMIT`, the indent widths) are recalculated to match
+CONFIG_TABLE = "header-hook"
+CONFIG_KEYS = {
+    "branch": ("DEFAULT_BRANCH", str),
+    "allowed-keys": ("ALLOWED_KEYS", list),
+    "valid-lang": ("VALID_LANG", list),
+    "no-keyval-indent": ("NO_KEYVAL_INDENT", list),
+    "to-cap": ("TO_CAP", list),
+    "sep": ("SEP", str),
+    "date-indent": ("DATE_INDENT_N", int),
+    "log-line-length": ("LOG_LINE_LENGTH", int),
+    "changelog-rules": ("CHANGELOG_RULES", list),
+    "languages": ("LANGUAGES", dict),
+    "stages": ("HEADER_STAGES", list),
+    "manifest": ("MANIFEST_FILE", str),
+    "git-machine-slots": ("GIT_MACHINE_SLOTS", int),
+    "git-repo-slots": ("GIT_REPO_SLOTS", int),
+}
+# Header keys written by the hook itself, so they can't be removed from
+# `ALLOWED_KEYS`
+REQUIRED_KEYS = ["file", "last updated", "fingerprint", "change log"]
+# Where compiled configuration snapshots are cached (overridden by the
+# `HEADER_HOOK_CACHE_DIR` environment variable)
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "header-hook",
+)
+# PEP 263 style encoding declaration (checked in the first two lines
+# of a file). Files without one are assumed to be UTF-8
+CODING_RE = re.compile(rb"^[ \t\f]*#.*?coding[:=][ \t]*([-\w.]+)")
 # Define the regex pattern for ANSI escape codes
 ANSI_ESCAPE = re.compile(r"\x1B[@-_][0-?]*[ -/]*[@-~]")
-# Date variables
-TODAY = datetime.today().strftime("%Y-%m-%d")
+# Date used for files never committed (runs take today's date from
+# `RunContext.today`)
 DEFAULT_DATE = "Thu 1 Jan 1970 00:00:00 +0000"
+# Settings recalculated from the configurable ones (see
+# `build_settings()`)
+DERIVED_SETTINGS = [
+    "WRAP_LIMIT",
+    "FIRST_KEYVAL_INDENT_N",
+    "DATE_INDENT",
+    "SECOND_KEYVAL_INDENT_N",
+]
+# Built-in settings. Never modified: configuration is applied by
+# giving each run its own `Settings` (see `RunContext.settings`)
+DEFAULT_SETTINGS = copy.deepcopy(
+    {
+        name: globals()[name]
+        for name in [x for x, _ in CONFIG_KEYS.values()] + DERIVED_SETTINGS
+    }
+)
 
 
 #################################
@@ -143,6 +400,18 @@ class GitError(Exception):
         super().__init__(self.message)
 
 
+class GitTimeoutError(GitError):
+    def __init__(self, message="Git did not answer within the time budget"):
+        self.message = message
+        super().__init__(self.message)
+
+
+class ConfigError(Exception):
+    def __init__(self, message="Invalid header-hook configuration"):
+        self.message = message
+        super().__init__(self.message)
+
+
 class MultipleResultsFound(Exception):
     def __init__(self, message="Expected one match. Found multiple"):
         self.message = message
@@ -155,17 +424,21 @@ class MultipleResultsFound(Exception):
 
 
 class HeaderBlock:
-    def __init__(self):
+    def __init__(self, allowed_keys: list = None):
         # Dict to store the key/value pairs that make
         # up the header
         self._data = {}
         # Shebang
         self.shebang = None
+        # Key order (see `ALLOWED_KEYS`)
+        self.allowed_keys = ALLOWED_KEYS
+        if allowed_keys is not None:
+            self.allowed_keys = allowed_keys
 
     def __iter__(self):
         date_keys = [x for x in self._data if is_valid_date(x)]
         sorted_date_keys = sorted(date_keys, reverse=True)
-        for key in ALLOWED_KEYS + sorted_date_keys:
+        for key in self.allowed_keys + sorted_date_keys:
             if key in self._data:
                 if is_valid_date(key):
                     is_changelog = True
@@ -173,6 +446,9 @@ class HeaderBlock:
                     is_changelog = False
                 yield key, self._data[key], is_changelog
 
+    def __contains__(self, key: str) -> bool:
+        return key in self._data
+
     def add(self, key: str, value: Any) -> None:
         if key in self._data:
             raise KeyError(f"Key '{key}' already defined for this object")
@@ -240,6 +516,25 @@ class HeaderBlock:
             )
         self.shebang = shebang
 
+    def changed_keys(self, other: "HeaderBlock") -> list:
+        """Keys whose values differ between this header
+        and another (including keys present in only one)
+
+        Args:
+            other (HeaderBlock): Header to compare with
+
+        Returns:
+            list: Changed keys, in header order. The shebang
+                is reported as "shebang"
+        """
+        keys = list(self._data) + [x for x in other._data if x not in self]
+        changed = [
+            key for key in keys if self._data.get(key) != other._data.get(key)
+        ]
+        if self.shebang != other.shebang:
+            changed.insert(0, "shebang")
+        return changed
+
     def get_first_date(self) -> str:
         date_keys = [x for x in self._data if is_valid_date(x)]
         return sorted(date_keys, reverse=True)[-1]
@@ -249,6 +544,563 @@ class HeaderBlock:
         return sorted(date_keys, reverse=True)[0]
 
 
+class Language:
+    """Comment syntax and shebang rules for one supported
+    file type, with all patterns precompiled
+
+    Args:
+        name (str): Language name (key within `LANGUAGES`)
+        comment (str): Marker that starts a comment line
+        shebangs (list): Interpreter globs accepted in a shebang.
+            If empty, the language does not allow shebangs
+        settings (Settings): Settings the language belongs to
+            (header layout, allowed keys, etc.)
+    """
+
+    def __init__(self, name: str, comment: str, shebangs: list, settings: Any):
+        self.name = name
+        self.settings = settings
+        self.comment = comment
+        # Leading comment markers (repeats allowed, e.g. "###")
+        self.comment_re = re.compile(f"^(?:{re.escape(comment)})+")
+        # Header dividers are comments made purely of comment
+        # characters
+        self.divider_re = re.compile(
+            f"^[{re.escape(''.join(set(comment)))}]+$"
+        )
+        # All interpreter globs compiled into a single matcher
+        self.shebang_re = None
+        if shebangs:
+            self.shebang_re = re.compile(
+                "|".join(f"(?:{fnmatch.translate(x)})" for x in shebangs)
+            )
+        # Header divider, padded out to the wrap limit
+        wrap_limit = settings.WRAP_LIMIT
+        self.sep = (comment * wrap_limit)[0:wrap_limit]
+        # Patterns used to inspect a rendered header without
+        # parsing it (see `has_valid_fingerprint()`)
+        self.fingerprint_re = re.compile(
+            f"^{re.escape(comment)} Fingerprint *: ([0-9a-f]+)$"
+        )
+        self.changelog_date_re = re.compile(
+            f"^{re.escape(comment)} {settings.DATE_INDENT}"
+            + r"(\d{4}-\d{2}-\d{2}) *:"
+        )
+
+    def is_comment(self, clean_line: str) -> bool:
+        return self.comment_re.match(clean_line) is not None
+
+    def is_divider(self, clean_line: str) -> bool:
+        return self.is_comment(clean_line) and bool(
+            self.divider_re.match(clean_line)
+        )
+
+    def strip_comment(self, clean_line: str) -> str:
+        return self.comment_re.sub("", clean_line, count=1).strip()
+
+
+def build_language_registry(
+    languages: dict, settings: Any
+) -> Tuple[dict, dict, dict]:
+    """Compile the `LANGUAGES` setting into lookup tables
+
+    Args:
+        languages (dict): Language settings, keyed by language name
+        settings (Settings): Settings the languages belong to
+
+    Returns:
+        Tuple[dict, dict, dict]: `Language` objects keyed by name,
+            by (lower-case) file extension and by file name
+    """
+    by_name = {}
+    by_ext = {}
+    by_filename = {}
+    for name, spec in languages.items():
+        lang = Language(name, spec["comment"], spec["shebangs"], settings)
+        by_name[name] = lang
+        for ext in spec["extensions"]:
+            by_ext[ext.lower()] = lang
+        for filename in spec["filenames"]:
+            by_filename[filename] = lang
+    return by_name, by_ext, by_filename
+
+
+class Settings:
+    """A settings snapshot (see `build_settings()`), with its
+    languages compiled. Each run carries its own (see
+    `RunContext.settings`), so runs with different configurations
+    (e.g., one per repository) can share a process. Settings are
+    read as attributes named after the setting (e.g., `SEP`)
+
+    Args:
+        snapshot (dict): Settings snapshot. Default is the built-in
+            settings
+    """
+
+    def __init__(self, snapshot: dict = None):
+        snapshot = copy.deepcopy(
+            DEFAULT_SETTINGS if snapshot is None else snapshot
+        )
+        # Hashable, and identical to the built-in form (so fingerprints
+        # don't depend on where the settings came from)
+        snapshot["CHANGELOG_RULES"] = [
+            tuple(x) for x in snapshot["CHANGELOG_RULES"]
+        ]
+        self.snapshot = snapshot
+        vars(self).update(snapshot)
+        # Git slots (machine, repository), see `git_slot()`
+        self.git_slots = (self.GIT_MACHINE_SLOTS, self.GIT_REPO_SLOTS)
+        (
+            self.lang_by_name,
+            self.lang_by_ext,
+            self.lang_by_filename,
+        ) = build_language_registry(self.LANGUAGES, self)
+
+    def __reduce__(self):
+        # Sent to worker processes as the snapshot alone. Workers
+        # compile each distinct snapshot once
+        return settings_from_json, (json.dumps(self.snapshot),)
+
+    def changelog_rules(self) -> Any:
+        """Compiled `CHANGELOG_RULES` (see `ChangelogRules`)"""
+        return compile_changelog_rules(tuple(self.CHANGELOG_RULES))
+
+
+@functools.lru_cache(maxsize=16)
+def settings_from_json(text: str) -> Settings:
+    return Settings(json.loads(text))
+
+
+# Used wherever a run's own settings aren't given
+BUILTIN_SETTINGS = Settings()
+LANG_BY_NAME = BUILTIN_SETTINGS.lang_by_name
+LANG_BY_EXT = BUILTIN_SETTINGS.lang_by_ext
+LANG_BY_FILENAME = BUILTIN_SETTINGS.lang_by_filename
+PYTHON = LANG_BY_NAME["python"]
+
+
+def classify(file_path: str, settings: Settings = None) -> Any:
+    """Work out the language of a file from its name
+
+    Args:
+        file_path (str): Path to the file
+        settings (Settings): Settings in use. Default is the
+            built-in settings
+
+    Returns:
+        Language: Language of the file, or `None` if the
+            file type is not supported
+    """
+    if settings is None:
+        settings = BUILTIN_SETTINGS
+    filename = os.path.basename(file_path)
+    lang = settings.lang_by_filename.get(filename)
+    if lang is None:
+        ext = os.path.splitext(filename)[1].lower()
+        lang = settings.lang_by_ext.get(ext)
+    return lang
+
+
+class Deadline:
+    """Point in time by which work must finish
+
+    Args:
+        seconds (float): Time allowed from now. `None` means
+            no limit
+        parent (Deadline): Optional enclosing deadline (e.g.,
+            the budget for the whole run). Whichever deadline
+            comes first applies
+    """
+
+    def __init__(self, seconds: float = None, parent: Any = None):
+        self.end = None
+        if seconds is not None:
+            self.end = time.monotonic() + seconds
+        if parent is not None and parent.end is not None:
+            if self.end is None or parent.end < self.end:
+                self.end = parent.end
+
+    def remaining(self) -> Any:
+        """Seconds left (never negative), or `None` if
+        there is no limit"""
+        if self.end is None:
+            return None
+        return max(self.end - time.monotonic(), 0.0)
+
+    def expired(self) -> bool:
+        return self.remaining() == 0.0
+
+
+class RunContext:
+    """Per-run state (options, clock, deadline and caches). Passed
+    explicitly to every file processed in the run, so that nothing
+    mutable is shared through module-level globals. The caches are
+    safe to share between threads: entries are only ever added, and
+    repeat answers are identical
+
+    Args:
+        check_fs (bool): If `False`, shebangs are validated without
+            filesystem access. Default is `True`
+        fingerprint (bool): If `True`, a fingerprint field is added
+            to headers. Default is `False`
+        check (bool): If `True`, files are not modified. Default
+            is `False`
+        branch (str): Release branch. Default is the `DEFAULT_BRANCH`
+            setting
+        budget_s (float): Time budget for the whole run (seconds).
+            Default is `None` (no limit)
+        file_budget_s (float): Time budget for each file (seconds).
+            Default is `None` (no limit)
+        today (str): Date (YYYY-MM-DD) used for new change log
+            entries. Default is the current date
+        memory (bool): If `True`, allocations are traced for each
+            stage of each file (see `FileReport`). Default is `False`
+        zero_decode (bool): If `True`, files are read as bytes and
+            only the header is decoded (see `ByteSource`). If
+            `False`, whole files are read/written in text mode with
+            the platform's default encoding. Default is `True`
+        offline (bool): If `True`, Git is never consulted: header
+            stages that need Git facts are skipped. Default is
+            `False`
+        digests (bool): If `True`, digests of each file's contents
+            before and after processing are added to its report
+            (bytes path only, see `zero_decode`). Default is `False`
+        settings (Settings): Settings for the run. Default is the
+            built-in settings
+    """
+
+    def __init__(
+        self,
+        check_fs: bool = True,
+        fingerprint: bool = False,
+        check: bool = False,
+        branch: str = None,
+        budget_s: float = None,
+        file_budget_s: float = None,
+        today: str = None,
+        memory: bool = False,
+        zero_decode: bool = True,
+        offline: bool = False,
+        digests: bool = False,
+        settings: Settings = None,
+    ):
+        self.settings = BUILTIN_SETTINGS if settings is None else settings
+        self.check_fs = check_fs
+        self.memory = memory
+        self.zero_decode = zero_decode
+        self.offline = offline
+        self.digests = digests
+        self.fingerprint = fingerprint
+        self.check = check
+        # Release branch as given (`None` follows the settings, see
+        # `branch`)
+        self.branch_given = branch
+        self.deadline = Deadline(budget_s)
+        self.file_budget_s = file_budget_s
+        self.today = today if today is not None else current_date()
+        self.git_cache = {}
+        # Per-stage counters from the last pipeline run (see
+        # `Pipeline.stats()`)
+        self.pipeline_stats = None
+        # Release manifest in use (see `use_manifest()`)
+        self.manifest = None
+        # Execution plan chosen for the last "auto" run (see
+        # `plan_execution()`)
+        self.plan = None
+
+    @property
+    def branch(self) -> str:
+        """Release branch: as given, or else the `DEFAULT_BRANCH`
+        setting of the run's settings"""
+        if self.branch_given is not None:
+            return self.branch_given
+        return self.settings.DEFAULT_BRANCH
+
+    def file_deadline(self) -> Deadline:
+        return Deadline(self.file_budget_s, self.deadline)
+
+
+def current_date() -> str:
+    return datetime.today().strftime("%Y-%m-%d")
+
+
+class FileReport:
+    """Outcome of processing one file, with measurements for
+    each stage of `chain()`
+
+    Args:
+        path (str): File processed
+        memory (bool): If `True`, each stage also records the
+            net change in traced memory (`mem_net`, bytes) and its
+            allocation peak above the starting point (`mem_peak`,
+            bytes). Requires `tracemalloc` to be tracing
+    """
+
+    def __init__(self, path: str, memory: bool = False):
+        self.path = path
+        self.memory = memory
+        self.changed = False
+        # Header already canonical (fingerprint fast path)?
+        self.canonical = False
+        # Header keys whose values changed
+        self.changed_keys = []
+        # Error message, if the file could not be processed
+        self.error = None
+        # Names of Git-derived steps that were skipped/degraded
+        self.degraded = []
+        # Git commands run, answers served from the cache, and time
+        # spent waiting for a Git slot (see `git_slot()`)
+        self.git = {"calls": 0, "cache_hits": 0, "wait_s": 0.0}
+        # Stage name -> measurements (`time_s`, plus `mem_net`
+        # and `mem_peak` in memory mode)
+        self.stages = {}
+        self.size = None
+        # Process peak resident set size (KiB) once done
+        self.peak_rss_kb = None
+        # Digests of the file's contents before and after (or, in
+        # check mode, as it would be after) processing. Only taken
+        # if `RunContext.digests` is set (see `content_digest()`)
+        self.digest_in = None
+        self.digest_out = None
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        if self.memory:
+            mem_before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = {"time_s": time.perf_counter() - start}
+            if self.memory:
+                current, peak = tracemalloc.get_traced_memory()
+                record["mem_net"] = current - mem_before
+                record["mem_peak"] = peak - mem_before
+            self.stages[name] = record
+
+    def mem_peak(self) -> int:
+        return max(
+            [x.get("mem_peak", 0) for x in self.stages.values()], default=0
+        )
+
+    def outcome(self, check: bool = False) -> str:
+        if self.error is not None:
+            return "error"
+        if self.canonical:
+            return "canonical"
+        if not self.changed:
+            return "unchanged"
+        return "would_change" if check else "changed"
+
+    def to_event(self, check: bool = False) -> dict:
+        """Machine-readable form of the report (one JSON Lines
+        event)
+
+        Args:
+            check (bool): Whether the run was in check mode
+                (changed files were not written)
+
+        Returns:
+            dict: Event
+        """
+        event = {
+            "event": "file",
+            "path": self.path,
+            "outcome": self.outcome(check),
+            "changed_keys": self.changed_keys,
+            "degraded": self.degraded,
+            "stages_ms": {
+                name: round(record["time_s"] * 1000, 3)
+                for name, record in self.stages.items()
+            },
+            "git_calls": self.git["calls"],
+            "git_cache_hits": self.git["cache_hits"],
+            "git_wait_ms": round(self.git["wait_s"] * 1000, 3),
+        }
+        if self.error is not None:
+            event["error"] = self.error
+        return event
+
+
+class ByteSource:
+    """The raw bytes of a file, with only the header region
+    decoded. The rest of the file is never decoded: it is passed
+    back out untouched (as a `memoryview`), so encodings and line
+    endings are preserved exactly
+
+    Note:
+        The header region runs from the start of the file up to
+        (and including) the closing header divider, or the first
+        line that is neither blank nor a comment. Header lines
+        are handed out with "\\n" line endings, and converted
+        back to the file's own line ending style on output.
+        Encodings must be ASCII-compatible
+
+    Args:
+        data (bytes): File contents
+        lang (Language): Language of the file
+    """
+
+    def __init__(self, data: bytes, lang: Language):
+        self.data = data
+        self.bom = b""
+        start = 0
+        if data.startswith(b"\xef\xbb\xbf"):
+            self.bom = data[0:3]
+            start = 3
+        self.encoding = self._detect_encoding(data[start : start + 1024])
+        comment = lang.comment.encode()
+        comment_chars = set(comment)
+        # Byte offset at which each header region line starts
+        # (the final offset marks the end of the region)
+        self.offsets = [start]
+        raw_lines = []
+        dividers = 0
+        pos = start
+        while pos < len(data):
+            end = data.find(b"\n", pos)
+            end = len(data) if end == -1 else end + 1
+            line = data[pos:end]
+            raw_lines.append(line)
+            self.offsets.append(end)
+            pos = end
+            stripped = line.strip()
+            if stripped == b"":
+                continue
+            if not stripped.startswith(comment):
+                break
+            if set(stripped) <= comment_chars:
+                dividers += 1
+                if dividers == 2:
+                    break
+        self.newline = b"\n"
+        if raw_lines and raw_lines[0].endswith(b"\r\n"):
+            self.newline = b"\r\n"
+        try:
+            self.lines = [self._decode(x) for x in raw_lines]
+        except (UnicodeDecodeError, LookupError):
+            # Undeclared non-UTF-8 encoding, or a coding cookie
+            # naming a codec Python doesn't have. Latin-1 maps every
+            # byte to a character, so unchanged text round-trips
+            self.encoding = "latin-1"
+            self.lines = [self._decode(x) for x in raw_lines]
+
+    @staticmethod
+    def _detect_encoding(head: bytes) -> str:
+        for line in head.split(b"\n")[0:2]:
+            m = CODING_RE.match(line)
+            if m:
+                return m.group(1).decode("ascii")
+        return "utf-8"
+
+    def _decode(self, line: bytes) -> str:
+        text = line.decode(self.encoding)
+        if text.endswith("\r\n"):
+            text = text[0:-2] + "\n"
+        return text
+
+    def rebuild(self, new_header: list, the_rest: list) -> list:
+        """Encode a new header, and attach the untouched rest
+        of the file
+
+        Args:
+            new_header (list): New header lines
+            the_rest (list): Header region lines left after the
+                header (as returned by `normalise()`). Must be a
+                suffix of `lines`
+
+        Returns:
+            list: Chunks (`bytes`/`memoryview`) making up the
+                new file
+        """
+        consumed = len(self.lines) - len(the_rest)
+        header = "".join(new_header).encode(self.encoding)
+        if self.newline != b"\n":
+            header = header.replace(b"\n", self.newline)
+        body = memoryview(self.data)[self.offsets[consumed] : :]
+        return [self.bom, header, body]
+
+
+class ChangelogRules:
+    """Compiled form of a set of change log normalisation rules.
+    All globs are combined into one regex (one named group per
+    rule), so each entry is matched once, whatever the number
+    of rules
+
+    Args:
+        rules (tuple): (glob, replacement) pairs. A replacement
+            of `None` means matching entries are dropped
+    """
+
+    def __init__(self, rules: tuple):
+        self.replacements = [replacement for _, replacement in rules]
+        self.pattern = re.compile(
+            "|".join(
+                f"(?P<r{i}>{fnmatch.translate(glob)})"
+                for i, (glob, _) in enumerate(rules)
+            )
+        )
+
+    def match(self, val: str) -> Tuple[bool, Any]:
+        """Find the first rule matching a change log entry
+
+        Args:
+            val (str): Change log entry text
+
+        Returns:
+            Tuple[bool, Any]: Whether any rule matched, and the
+                replacement for the matching rule (`None` for
+                drop rules)
+        """
+        if not self.replacements:
+            return False, None
+        m = self.pattern.match(val)
+        if m is None:
+            return False, None
+        return True, self.replacements[int(m.lastgroup[1::])]
+
+    def apply(self, h: HeaderBlock, keep: str = None) -> None:
+        """Drop/rewrite change log entries in a single pass
+        over the header
+
+        Args:
+            h (HeaderBlock): Header block loaded
+                into memory
+            keep (str): Optional key of an entry to leave alone
+        """
+        to_drop = []
+        to_amend = []
+        for key, val, is_changelog in h:
+            if not is_changelog or key == keep:
+                continue
+            matched, replacement = self.match(val)
+            if not matched:
+                continue
+            if replacement is None:
+                to_drop.append(key)
+            else:
+                to_amend.append((key, replacement))
+        for key in to_drop:
+            h.drop(key)
+        for key, replacement in to_amend:
+            h.amend(key, replacement)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_changelog_rules(rules: tuple) -> ChangelogRules:
+    """Compile change log rules. Compilation happens once
+    per process for a given set of rules
+
+    Args:
+        rules (tuple): (glob, replacement) pairs
+
+    Returns:
+        ChangelogRules: Compiled rules
+    """
+    return ChangelogRules(rules)
+
+
 def line_formatter(line: str) -> str:
     # Ensure only single spaces exist
     # (this also removes indentations)
@@ -259,37 +1111,31 @@ def line_formatter(line: str) -> str:
     return formatted
 
 
-def parse_comment(line: str) -> str:
+def parse_comment(line: str, lang: Language = PYTHON) -> str:
     # Confirm input is a comment
-    if not is_valid_comment(line):
+    if not is_valid_comment(line, lang):
         raise ValueError("Input is not a valid comment")
     formatted = line_formatter(line)
-    # Remove comment indicators
-    i = 0
-    comment_indicators = True
-    while comment_indicators:
-        if formatted[i] == "#":
-            i += 1
-        else:
-            comment_indicators = False
     # Remove comment indicators and trailing
     # whitespace
-    return formatted[i::].strip()
+    return lang.strip_comment(formatted)
 
 
-def is_valid_comment(text: str) -> bool:
+def is_valid_comment(text: str, lang: Language = PYTHON) -> bool:
     """`True` if text is a code comment,
     else `False`
 
     Args:
         text (str): Text (single line) to scrutinise
+        lang (Language): Language of the file the text
+            belongs to. Default is Python
 
     Returns:
         bool: `True` if text is a code comment,
     else `False`
     """
     formatted = line_formatter(text)
-    return formatted[0] == "#"
+    return lang.is_comment(formatted)
 
 
 def is_blank(text: str) -> bool:
@@ -297,15 +1143,82 @@ def is_blank(text: str) -> bool:
     return formatted.strip() == ""
 
 
-def is_valid_shebang(text: str) -> bool:
+def split_shebang(text: str) -> Tuple[str, str]:
+    """Split a shebang line into the interpreter path and
+    the name of the interpreter. `/usr/bin/env` forms
+    (e.g., `#!/usr/bin/env -S python3 -u`) resolve to the
+    program that `env` would launch
+
+    Args:
+        text (str): Line to parse
+
+    Raises:
+        ValueError: Line is not a (well-formed) shebang
+
+    Returns:
+        Tuple[str, str]: Interpreter path, interpreter name
+    """
     formatted = line_formatter(text)
     if formatted[0:2] != "#!":
+        raise ValueError("Input is not a shebang")
+    tokens = formatted[2::].split()
+    if len(tokens) == 0:
+        raise ValueError("Shebang does not name an interpreter")
+    path = tokens[0]
+    executable = os.path.basename(path)
+    if executable == "env":
+        # Skip `env` options and VAR=value assignments
+        args = [x for x in tokens[1::] if not x.startswith("-")]
+        args = [x for x in args if "=" not in x]
+        if len(args) == 0:
+            raise ValueError("`env` shebang does not name an interpreter")
+        executable = args[0]
+    return path, executable
+
+
+@functools.lru_cache(maxsize=None)
+def interpreter_exists(path: str) -> bool:
+    """Cached `os.path.isfile()` check. Each interpreter path is
+    only looked up once per process, however many files share it
+
+    Args:
+        path (str): Interpreter path
+
+    Returns:
+        bool: `True` if the path exists as a file
+    """
+    return os.path.isfile(path)
+
+
+def is_valid_shebang(
+    text: str, check_fs: bool = True, lang: Language = PYTHON
+) -> bool:
+    """`True` if text is a shebang for a supported language,
+    else `False`
+
+    Args:
+        text (str): Text (single line) to scrutinise
+        check_fs (bool): If `True`, the interpreter path must
+            also exist on this machine. If `False`, validation
+            is purely syntactic (no filesystem access).
+            Default is `True`
+        lang (Language): Language of the file. Determines the
+            accepted interpreters. Default is Python
+
+    Returns:
+        bool: `True` if text is a valid shebang, else `False`
+    """
+    if lang.shebang_re is None:
         return False
-    path = formatted[2::]
-    if not os.path.isfile(path):
+    try:
+        path, executable = split_shebang(text)
+    except ValueError:
         return False
-    executable = os.path.basename(path)
-    if not any([fnmatch.fnmatch(executable, x) for x in VALID_LANG]):
+    if not path.startswith("/"):
+        return False
+    if not lang.shebang_re.match(executable):
+        return False
+    if check_fs and not interpreter_exists(path):
         return False
     return True
 
@@ -326,7 +1239,7 @@ def is_valid_date(date_string: str) -> bool:
         return False
 
 
-def line_splitter(line: str) -> Tuple[str, str]:
+def line_splitter(line: str, lang: Language = PYTHON) -> Tuple[str, str]:
     """Convert a metadata string into a key/value
     pair. For example., "File: /path/to/file",
     becomes ("file", "/path/to/file"). Exceptions
@@ -336,6 +1249,8 @@ def line_splitter(line: str) -> Tuple[str, str]:
 
     Args:
         line (str): Line to parse
+        lang (Language): Language of the file. Default
+            is Python
 
     Raises:
         ValueError: Line doesn't look like a key/value
@@ -351,8 +1266,9 @@ def line_splitter(line: str) -> Tuple[str, str]:
     # are considered as part of the value
     key = line.split(":")[0]
     val = ":".join(line.split(":")[1::]).strip()
-    formatted_key = parse_comment(key).lower()
-    if formatted_key not in ALLOWED_KEYS and not is_valid_date(formatted_key):
+    formatted_key = parse_comment(key, lang).lower()
+    allowed = lang.settings.ALLOWED_KEYS
+    if formatted_key not in allowed and not is_valid_date(formatted_key):
         raise InvalidKeyError
     return formatted_key, val
 
@@ -370,7 +1286,9 @@ def remove_ansi_escape_codes(text: str) -> str:
     return ANSI_ESCAPE.sub("", text)
 
 
-def wrap_and_indent(proc_msg: str, max_length: int, indent: int) -> str:
+def wrap_and_indent(
+    proc_msg: str, max_length: int, indent: int, prefix: str = "#"
+) -> str:
     """Wrap a (potentially long) message over multiple lines.
        Indent added to lines 2 and beyond (hanging indent)
 
@@ -383,6 +1301,8 @@ def wrap_and_indent(proc_msg: str, max_length: int, indent: int) -> str:
             newline character is added
         indent (int): Size of the introduced indent (for
             all lines except the first one
+        prefix (str): Comment marker that starts each
+            continuation line. Default is "#"
 
     Returns:
         str: A string with wrapping and indentation
@@ -391,7 +1311,7 @@ def wrap_and_indent(proc_msg: str, max_length: int, indent: int) -> str:
     # Remove any existing newline characters
     proc_msg = re.sub(r"\n", "", proc_msg)
     # Start the word wrap
-    indent_str = "#" + " " * indent
+    indent_str = prefix + " " * indent
     split_msg = proc_msg.split(" ")
     wrapped_msg = ""
     new_line = []
@@ -403,7 +1323,7 @@ def wrap_and_indent(proc_msg: str, max_length: int, indent: int) -> str:
         line_len = (
             sum([len(remove_ansi_escape_codes(x)) for x in new_line])
             + len(new_line)
-            + ((indent + 1) * first_line)
+            + ((indent + len(prefix)) * first_line)
         )
         # Are we under the wrap limit?
         if line_len + len(word) <= max_length:
@@ -425,30 +1345,80 @@ def wrap_and_indent(proc_msg: str, max_length: int, indent: int) -> str:
     return wrapped_msg
 
 
-def wrap_wrapper(h: HeaderBlock) -> None:
+@functools.lru_cache(maxsize=WRAP_CACHE_SIZE)
+def cached_wrap_and_indent(
+    proc_msg: str, max_length: int, indent: int, prefix: str = "#"
+) -> str:
+    """Memoized version of `wrap_and_indent()`. Header values
+    such as "First release." or maintainer lines repeat across
+    many files, so the wrapped result is cached (LRU, bounded
+    by `WRAP_CACHE_SIZE`) for the lifetime of the process
+
+    Args:
+        proc_msg (str): Message to be formatted
+        max_length (int): Max length each line can be before a
+            newline character is added
+        indent (int): Size of the introduced indent
+        prefix (str): Comment marker that starts each
+            continuation line. Default is "#"
+
+    Returns:
+        str: A string with wrapping and indentation
+            added
+    """
+    return wrap_and_indent(proc_msg, max_length, indent, prefix)
+
+
+def wrap_cache_stats() -> dict:
+    """Hit/miss counters for the word wrap cache
+
+    Returns:
+        dict: `hits`, `misses`, `size` (current number of
+            entries) and `maxsize`
+    """
+    info = cached_wrap_and_indent.cache_info()
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "size": info.currsize,
+        "maxsize": info.maxsize,
+    }
+
+
+def wrap_wrapper(h: HeaderBlock, lang: Language = PYTHON) -> None:
     """Wrapper around method that performs
     word wrapping/indenting
 
     Args:
         h (HeaderBlock): Header block loaded
             into memory
+        lang (Language): Language of the file. Default
+            is Python
     """
     # Word wrap
     for key, val, is_changelog in h:
         if key != "file":
             # Wrap and indent text. Slight changes to the standard
             # wrap limit and indent size to account for addition of
-            # "#"s, and also colons that separate keys from values.
-            # Wrap and indent text.
+            # comment markers, and also colons that separate keys
+            # from values.
             h.amend(
                 key,
-                wrap_and_indent(
-                    val, WRAP_LIMIT - 1, FIRST_KEYVAL_INDENT_N + 2
+                cached_wrap_and_indent(
+                    val,
+                    lang.settings.WRAP_LIMIT - len(lang.comment),
+                    lang.settings.FIRST_KEYVAL_INDENT_N + 2,
+                    lang.comment,
                 ),
             )
 
 
-def load_meta(raw_text: list, break_limit: int = 3) -> Tuple[dict, list]:
+def load_meta(
+    raw_text: list,
+    break_limit: int = 3,
+    check_fs: bool = True,
+    lang: Language = PYTHON,
+) -> Tuple[dict, list]:
     """Extract the header block from a file,
     converting to a dict.
 
@@ -457,6 +1427,11 @@ def load_meta(raw_text: list, break_limit: int = 3) -> Tuple[dict, list]:
         break_limit (int): number of contiguous lines
             without a comment before the header block
             is considered closed
+        check_fs (bool): If `False`, shebangs are validated
+            syntactically, without checking the interpreter
+            exists on disk
+        lang (Language): Language of the file. Default
+            is Python
 
     Returns:
         dict: header block dict. Text keys are mapped
@@ -465,7 +1440,7 @@ def load_meta(raw_text: list, break_limit: int = 3) -> Tuple[dict, list]:
             is also created for the file shebang
         list: The rest of the file, unedited
     """
-    header = HeaderBlock()
+    header = HeaderBlock(lang.settings.ALLOWED_KEYS)
     # The header block starts when we hit the first
     # line of comments (only blank spaces are allowed
     # to precede)
@@ -476,7 +1451,7 @@ def load_meta(raw_text: list, break_limit: int = 3) -> Tuple[dict, list]:
         if is_blank(line):
             i += 1
             continue
-        elif is_valid_comment(line):
+        elif is_valid_comment(line, lang):
             header_open = True
         else:
             raise MissingHeaderBlockError
@@ -498,7 +1473,7 @@ def load_meta(raw_text: list, break_limit: int = 3) -> Tuple[dict, list]:
                 return header, (raw_text[i + j : :])
             else:
                 continue
-        elif is_valid_comment(line):
+        elif is_valid_comment(line, lang):
             strike_count = 0
         else:
             return header, (raw_text[i + j : :])
@@ -507,19 +1482,19 @@ def load_meta(raw_text: list, break_limit: int = 3) -> Tuple[dict, list]:
         clean_line = line_formatter(line)
         # A second divider line indicates the end of the
         # header block
-        if set(clean_line) == {"#"} and not header_start:
+        if lang.is_divider(clean_line) and not header_start:
             return header, (raw_text[i + j + 1 : :])
         if header_start:
             # Starting divider line is ignored
-            if set(clean_line) == {"#"}:
+            if lang.is_divider(clean_line):
                 continue
             # Shebang?
-            if is_valid_shebang(clean_line):
+            if is_valid_shebang(clean_line, check_fs, lang):
                 header.add_shebang(clean_line)
             # Does the comment block start with a key?
             else:
                 try:
-                    key, val_frag = line_splitter(clean_line)
+                    key, val_frag = line_splitter(clean_line, lang)
                     header.add(key, val_frag)
                     header_start = False
                 except:
@@ -531,66 +1506,204 @@ def load_meta(raw_text: list, break_limit: int = 3) -> Tuple[dict, list]:
             # Are we dealing with a new key/value, or a
             # continuation of a previously-started key/value?
             try:
-                key, val_frag = line_splitter(clean_line)
+                key, val_frag = line_splitter(clean_line, lang)
                 header.add(key, val_frag)
             except:
-                header.append(key, parse_comment(clean_line))
+                header.append(key, parse_comment(clean_line, lang))
 
 
-def create_new_file(
-    header: HeaderBlock, non_header: list, file_path: str
-) -> None:
-    """Save the modified header and unaltered non-header
-    to file
+def render_header(header: HeaderBlock, lang: Language = PYTHON) -> list:
+    """Convert a header block into lines of text
 
     Args:
-        header_dict (HeaderBlock): Header information
-        non_header (list): The rest of the file, unaltered
+        header (HeaderBlock): Header information
+        lang (Language): Language of the file. Default
+            is Python
 
     Returns:
-        None
+        list: Header lines (newline-terminated), from the
+            shebang (if any) to the closing divider
     """
+    settings = lang.settings
     new_file_contents = []
     # First, shebang if it exists
     if header.shebang:
         new_file_contents.append(header.shebang + "\n")
     # Next, opening divider
-    new_file_contents.append(SEP + "\n")
+    new_file_contents.append(lang.sep + "\n")
     # Next we iterate through standard keys (in the expected order)
     # followed by dates (in reverse chronological order)
     for key, val, is_changelog in header:
         # Different formatting rules for standard keys
         # vs date keys
         if is_changelog:
-            indent = DATE_INDENT
-            keyval_spacing = " " * (SECOND_KEYVAL_INDENT_N - len(key))
+            indent = settings.DATE_INDENT
+            keyval_spacing = " " * (settings.SECOND_KEYVAL_INDENT_N - len(key))
         else:
             # For non-date, keys, we also need to consider keys
             # with special spacing rules
             indent = ""
-            if key in NO_KEYVAL_INDENT:
+            if key in settings.NO_KEYVAL_INDENT:
                 keyval_spacing = " "
             else:
-                keyval_spacing = " " * (FIRST_KEYVAL_INDENT_N - len(key))
+                keyval_spacing = " " * (
+                    settings.FIRST_KEYVAL_INDENT_N - len(key)
+                )
         # Add to file, with capitalisation of the key, and (possible)
         # capitalisation of the value
-        if key in TO_CAP or is_changelog:
+        if key in settings.TO_CAP or is_changelog:
             val = val.capitalize()
         else:
             val = val
         new_file_contents.append(
-            f"# {indent}{key.capitalize()}{keyval_spacing}: {val}\n"
+            f"{lang.comment} {indent}{key.capitalize()}"
+            + f"{keyval_spacing}: {val}\n"
         )
 
-    # Add the final header divider, then the rest
-    # of the file contents. We can then save to file
+    # Add the final header divider
+    new_file_contents.append(lang.sep + "\n")
+    return new_file_contents
+
+
+def create_new_file(
+    header: HeaderBlock,
+    non_header: list,
+    file_path: str,
+    lang: Language = PYTHON,
+) -> None:
+    """Save the modified header and unaltered non-header
+    to file
+
+    Args:
+        header_dict (HeaderBlock): Header information
+        non_header (list): The rest of the file, unaltered
+        file_path (str): File to write
+        lang (Language): Language of the file. Default
+            is Python
+
+    Returns:
+        None
+    """
     # TODO: change file save to be in-place
-    new_file_contents.append(SEP + "\n")
-    new_file_contents += non_header
+    new_file_contents = render_header(header, lang) + non_header
     with open(file_path, "w") as f:
         f.writelines(new_file_contents)
 
 
+@functools.lru_cache(maxsize=None)
+def settings_digest(lang: Language) -> str:
+    """Hash of every setting that affects how a header is
+    rendered. Folded into header fingerprints, so that changing
+    a setting invalidates existing fingerprints
+
+    Args:
+        lang (Language): Language of the file (and, through it,
+            the settings in use)
+
+    Returns:
+        str: Hex digest
+    """
+    s = lang.settings
+    settings = (
+        __version__,
+        s.ALLOWED_KEYS,
+        s.NO_KEYVAL_INDENT,
+        s.TO_CAP,
+        s.WRAP_LIMIT,
+        s.FIRST_KEYVAL_INDENT_N,
+        s.DATE_INDENT_N,
+        s.LOG_LINE_LENGTH,
+        s.CHANGELOG_RULES,
+        s.HEADER_STAGES,
+        lang.name,
+        lang.comment,
+    )
+    return hashlib.sha256(repr(settings).encode()).hexdigest()
+
+
+def header_fingerprint(header_lines: list, lang: Language = PYTHON) -> str:
+    """Fingerprint of a rendered header
+
+    Args:
+        header_lines (list): Rendered header lines, excluding
+            the fingerprint line itself
+        lang (Language): Language of the file. Default
+            is Python
+
+    Returns:
+        str: Short hex digest (`FINGERPRINT_LEN` characters)
+    """
+    digest = hashlib.sha256(settings_digest(lang).encode())
+    for line in header_lines:
+        digest.update(line.encode())
+    return digest.hexdigest()[0:FINGERPRINT_LEN]
+
+
+def add_fingerprint(h: HeaderBlock, lang: Language = PYTHON) -> None:
+    """Add (or refresh) the fingerprint field. Must be
+    the last change made to the header before it is saved
+
+    Args:
+        h (HeaderBlock): Header block loaded
+            into memory
+        lang (Language): Language of the file. Default
+            is Python
+    """
+    h.drop("fingerprint")
+    fingerprint = header_fingerprint(render_header(h, lang), lang)
+    h.add("fingerprint", fingerprint)
+
+
+def has_valid_fingerprint(raw_text: list, lang: Language, today: str) -> bool:
+    """Fast check for an already-canonical header, without
+    parsing it. The header lines are hashed as-is and compared
+    with the embedded fingerprint. As the change log always
+    gains an entry for today, a header last formatted on a
+    previous day is never considered canonical.
+
+    Note:
+        Git-derived values (release date, merged change log)
+        are trusted as recorded when the fingerprint was
+        written
+
+    Args:
+        raw_text (list): text loaded into memory
+        lang (Language): Language of the file
+        today (str): Today's date (YYYY-MM-DD)
+
+    Returns:
+        bool: `True` if the header carries a fingerprint that
+            matches its contents and today's date
+    """
+    sep = lang.sep + "\n"
+    i = 0
+    # Optional shebang, then the opening divider
+    if len(raw_text) > 0 and raw_text[0].startswith("#!"):
+        i = 1
+    if len(raw_text) <= i or raw_text[i] != sep:
+        return False
+    fingerprint = None
+    last_date = None
+    header_lines = raw_text[0 : i + 1]
+    for line in raw_text[i + 1 : :]:
+        m = lang.fingerprint_re.match(line.rstrip("\n"))
+        if m:
+            fingerprint = m.group(1)
+            continue
+        header_lines.append(line)
+        if line == sep:
+            break
+        m = lang.changelog_date_re.match(line)
+        if m and (last_date is None or m.group(1) > last_date):
+            last_date = m.group(1)
+    else:
+        # No closing divider
+        return False
+    if fingerprint is None or last_date != today:
+        return False
+    return fingerprint == header_fingerprint(header_lines, lang)
+
+
 def git_date_convert(datestr: str) -> str:
     # Decide direction of conversion
     if "-" in datestr:
@@ -602,40 +1715,488 @@ def git_date_convert(datestr: str) -> str:
     return new_datestr
 
 
-def ask_git(cmd: str) -> str:
-    try:
-        res = subprocess.run(
-            cmd.split(" "),
-            check=True,
-            capture_output=True,
-            text=True,
-        )
-        return res.stdout.strip()
+def git_slot_dirs(slots: tuple = None) -> list:
+    """Semaphore directories that Git commands need a slot in:
+    one for the machine, and one for the repository (keyed by
+    the current directory), with the number of slots in each
+
+    Args:
+        slots (tuple): Number of slots for the machine and for
+            the repository (see `Settings.git_slots`). Default is
+            `GIT_MACHINE_SLOTS`, `GIT_REPO_SLOTS`
+    """
+    if slots is None:
+        slots = (GIT_MACHINE_SLOTS, GIT_REPO_SLOTS)
+    machine_slots, repo_slots = slots
+    dirs = []
+    if machine_slots > 0:
+        machine = os.path.join(GIT_SLOT_DIR, "machine")
+        dirs.append((machine, machine_slots))
+    if repo_slots > 0:
+        repo = os.path.realpath(os.getcwd()).encode(errors="surrogateescape")
+        name = "repo-" + hashlib.sha256(repo).hexdigest()[0:16]
+        dirs.append((os.path.join(GIT_SLOT_DIR, name), repo_slots))
+    return dirs
+
+
+def acquire_slot(directory: str, slots: int, deadline: Deadline = None):
+    """Take one of the slots of a semaphore directory (a lock file
+    per slot, locked with `flock`), waiting for one to be free.
+    Locks are released by the system if the holder dies, so a
+    crashed run never leaves a slot taken
+
+    Args:
+        directory (str): Semaphore directory (created if needed)
+        slots (int): Number of slots
+        deadline (Deadline): Optional time limit for the wait
+
+    Raises:
+        GitTimeoutError: Deadline passed before a slot was free
+
+    Returns:
+        int: File descriptor holding the slot (close to release)
+    """
+    os.makedirs(directory, exist_ok=True)
+    delay = GIT_SLOT_POLL_S
+    # Start at a different slot in each process, so waiting
+    # processes don't all contend for the first one
+    first = os.getpid() % slots
+    while True:
+        for i in range(slots):
+            path = os.path.join(directory, f"{(first + i) % slots}.lock")
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        remaining = None if deadline is None else deadline.remaining()
+        if remaining == 0.0:
+            raise GitTimeoutError(f"No Git slot free in {directory}")
+        time.sleep(delay if remaining is None else min(delay, remaining))
+        delay = min(delay * 2, GIT_SLOT_POLL_MAX_S)
+
+
+@contextlib.contextmanager
+def git_slot(deadline: Deadline = None, stats: dict = None, slots=None):
+    """Hold a slot for one Git command, machine-wide and for the
+    repository (see `GIT_MACHINE_SLOTS`, `GIT_REPO_SLOTS`), so
+    concurrent runs share Git (and the disk) instead of swamping
+    it. Slots are always taken in the same order (machine, then
+    repository), so runs can't deadlock. A no-op where `flock`
+    isn't available
+
+    Args:
+        deadline (Deadline): Optional time limit for the wait
+        stats (dict): Optional counters. The time spent waiting
+            is added to `wait_s`
+        slots (tuple): Number of slots (see `git_slot_dirs()`)
+
+    Raises:
+        GitTimeoutError: Deadline passed before a slot was free
+    """
+    if fcntl is None:
+        yield
+        return
+    start = time.perf_counter()
+    held = []
+    try:
+        for directory, n_slots in git_slot_dirs(slots):
+            held.append(acquire_slot(directory, n_slots, deadline))
+        if stats is not None:
+            stats["wait_s"] += time.perf_counter() - start
+        yield
+    finally:
+        for fd in held:
+            os.close(fd)
+
+
+def ask_git(
+    cmd: str,
+    cache: dict = None,
+    deadline: Deadline = None,
+    stats: dict = None,
+    slots: tuple = None,
+) -> str:
+    """Run a Git command, returning its output
+
+    Args:
+        cmd (str): Command to run
+        cache (dict): Optional store of previous answers, keyed
+            by command. Long-running modes (e.g., watch mode)
+            use this to avoid asking Git the same question twice
+        deadline (Deadline): Optional time limit. Cached answers
+            are still returned after the deadline has passed
+        stats (dict): Optional counters. `calls` and `cache_hits`
+            are incremented, and time spent waiting for a Git slot
+            (see `git_slot()`) is added to `wait_s`
+        slots (tuple): Number of Git slots (see `git_slot_dirs()`)
+
+    Raises:
+        GitError: Git command failed
+        GitTimeoutError: Deadline passed before Git answered
+
+    Returns:
+        str: Command output, stripped of surrounding whitespace
+    """
+    if cache is not None and cmd in cache:
+        if stats is not None:
+            stats["cache_hits"] += 1
+        return cache[cmd]
+    if stats is not None:
+        stats["calls"] += 1
+    if deadline is not None and deadline.expired():
+        raise GitTimeoutError(f"No time left to run `{cmd}`")
+    try:
+        with git_slot(deadline, stats, slots):
+            timeout = None if deadline is None else deadline.remaining()
+            res = subprocess.run(
+                cmd.split(" "),
+                check=True,
+                capture_output=True,
+                text=True,
+                timeout=timeout,
+            )
+    except subprocess.TimeoutExpired:
+        raise GitTimeoutError(f"`{cmd}` did not finish in {timeout:.3f}s")
     except subprocess.CalledProcessError as e:
         raise GitError(f"Problem communicating with Git: {e}")
+    answer = res.stdout.strip()
+    if cache is not None:
+        cache[cmd] = answer
+    return answer
+
+
+def iter_git_log(args: list, deadline: Deadline = None, slots=None):
+    """Stream the commits of a `git log --name-status` walk
+
+    Args:
+        args (list): Extra `git log` arguments (revision, options)
+        deadline (Deadline): Optional time limit. The walk is
+            abandoned once it passes
+        slots (tuple): Number of Git slots (see `git_slot_dirs()`)
+
+    Raises:
+        GitError: Git command failed
+        GitTimeoutError: Deadline passed before the walk finished
+
+    Yields:
+        Tuple[str, str, list]: Commit hash, commit date (`%cd`)
+            and the files the commit touched, newest commit first.
+            Each file is a (status, path, old path) tuple; the old
+            path is `None` unless the file was renamed or copied.
+            Merges (with `-c`) have one status letter per parent
+    """
+    cmd = ["git", "log", "-z", "--format=%x01%H %cd", "--name-status"]
+    cmd += args
+    # The slot is held for the whole walk
+    with git_slot(deadline, slots=slots):
+        proc = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+        # Reads block until Git writes, and a walk can go a long time
+        # without output (e.g., `--diff-filter`), so Git is stopped
+        # once the deadline passes
+        timed_out = threading.Event()
+        timer = None
+        if deadline is not None and deadline.remaining() is not None:
+
+            def stop():
+                timed_out.set()
+                proc.kill()
+
+            timer = threading.Timer(deadline.remaining(), stop)
+            timer.daemon = True
+            timer.start()
+        commit = None
+        files = []
+        tokens = []
+        buffer = b""
+        try:
+            while True:
+                if deadline is not None and deadline.expired():
+                    raise GitTimeoutError(f"`{' '.join(cmd)}` ran out of time")
+                block = proc.stdout.read1(1 << 16)
+                if timed_out.is_set():
+                    raise GitTimeoutError(f"`{' '.join(cmd)}` ran out of time")
+                if not block:
+                    break
+                buffer += block
+                *complete, buffer = buffer.split(b"\0")
+                tokens.extend(complete)
+                # Consume whole entries only (renames span three tokens)
+                i = 0
+                while i < len(tokens):
+                    token = tokens[i].decode(errors="surrogateescape")
+                    token = token.lstrip("\n")
+                    if token.startswith("\x01"):
+                        if commit is not None:
+                            yield commit + (files,)
+                        commit, files = tuple(token[1::].split(" ", 1)), []
+                        i += 1
+                    elif token == "":
+                        i += 1
+                    elif token[0] in "RC" and token[1:].isdigit():
+                        # Rename/copy (with a similarity score). Merge
+                        # statuses (`-c`: one letter per parent, e.g.
+                        # "RM") are followed by a single path
+                        if i + 2 >= len(tokens):
+                            break
+                        old, new = tokens[i + 1], tokens[i + 2]
+                        files.append(
+                            (
+                                token[0],
+                                new.decode(errors="surrogateescape"),
+                                old.decode(errors="surrogateescape"),
+                            )
+                        )
+                        i += 3
+                    else:
+                        if i + 1 >= len(tokens):
+                            break
+                        path = tokens[i + 1].decode(errors="surrogateescape")
+                        files.append((token, path, None))
+                        i += 2
+                tokens = tokens[i::]
+        finally:
+            if timer is not None:
+                timer.cancel()
+            proc.stdout.close()
+            if proc.poll() is None:
+                proc.kill()
+            returncode = proc.wait()
+    if returncode != 0:
+        raise GitError(f"Problem communicating with Git: `{' '.join(cmd)}`")
+    if commit is not None:
+        yield commit + (files,)
+
+
+def batch_last_commit(
+    paths: set, branch: str, deadline: Deadline, slots: tuple = None
+) -> dict:
+    """Answer the `last_commit` Git fact for many files with one
+    history walk (see `GIT_FACTS`)
+
+    Args:
+        paths (set): Paths, relative to the repository root
+        branch (str): Release branch
+        deadline (Deadline): Optional time limit
+        slots (tuple): Number of Git slots (see `git_slot_dirs()`)
+
+    Returns:
+        dict: Answer for each path (an empty string if the file
+            has never been committed to `branch`)
+    """
+    answers = dict.fromkeys(paths, "")
+    pending = set(paths)
+    # `-c`: merges count only where they differ from every parent,
+    # as with a path-limited `git log`
+    for _, date, files in iter_git_log(["-c", branch], deadline, slots):
+        for _, path, old in files:
+            for name in (path, old):
+                if name in pending:
+                    answers[name] = date
+                    pending.discard(name)
+        if not pending:
+            break
+    return answers
+
+
+def first_added_commits(
+    paths: set, branch: str, deadline: Deadline, slots: tuple = None
+) -> dict:
+    """Find the commit that first added each of many files to a
+    branch, with one history walk. As with `git log --follow`,
+    renames are followed back to the original file
+
+    Args:
+        paths (set): Paths, relative to the repository root
+        branch (str): Release branch
+        deadline (Deadline): Optional time limit
+        slots (tuple): Number of Git slots (see `git_slot_dirs()`)
+
+    Returns:
+        dict: (commit hash, commit date) for each path, or `None`
+            if the file has never been added on `branch`
+    """
+    commits = []
+    # Per path: (commit index, status, old path), newest first
+    events = {}
+    for sha, date, files in iter_git_log([branch, "--"], deadline, slots):
+        commits.append((sha, date))
+        for status, path, old in files:
+            events.setdefault(path, []).append((len(commits) - 1, status, old))
+    answers = {}
+    for path in paths:
+        answer = None
+        name, after = path, -1
+        while name is not None and answer is None:
+            current, name = name, None
+            for index, status, old in events.get(current, []):
+                if index <= after:
+                    continue
+                if status == "A":
+                    answer = commits[index]
+                    break
+                if status == "R":
+                    # Continue under the old name, further back
+                    name, after = old, index
+                    break
+        answers[path] = answer
+    return answers
+
+
+def batch_first_added(
+    paths: set, branch: str, deadline: Deadline, slots: tuple = None
+) -> dict:
+    """Answer the `first_added` Git fact for many files with one
+    history walk (see `GIT_FACTS` and `first_added_commits()`)
+
+    Args:
+        paths (set): Paths, relative to the repository root
+        branch (str): Release branch
+        deadline (Deadline): Optional time limit
+        slots (tuple): Number of Git slots (see `git_slot_dirs()`)
+
+    Returns:
+        dict: Answer for each path (an empty string if the file
+            has never been added on `branch`)
+    """
+    commits = first_added_commits(paths, branch, deadline, slots)
+    return {x: "" if y is None else y[1] for x, y in commits.items()}
+
+
+GIT_FACT_BATCHES = {
+    "last_commit": batch_last_commit,
+    "first_added": batch_first_added,
+}
+
+
+def prefetch_git_facts(files: list, ctx: RunContext) -> int:
+    """Fetch the Git facts declared by the active header stages
+    (see `HeaderStage`) for many files up front, so the stages
+    find the answers in `ctx.git_cache`.
+    Best-effort: anything not prefetched (e.g., if Git fails or
+    runs out of time) is asked of Git file by file, as usual
+
+    Note:
+        Answers are stored against each file's path as given,
+        so only relative paths are prefetched, and only when run
+        from the repository root. Headers whose File key differs
+        from the file's path simply miss the cache
+
+    Args:
+        files (list): Files about to be processed
+        ctx (RunContext): Run options, clock and caches
+
+    Returns:
+        int: Number of answers added to the cache
+    """
+    facts = {x for stage in active_stages(ctx) for x in stage.git_facts}
+    if ctx.offline or not facts or len(files) < GIT_BATCH_MIN_FILES:
+        return 0
+    try:
+        top = ask_git(
+            "git rev-parse --show-toplevel", slots=ctx.settings.git_slots
+        )
+    except GitError:
+        return 0
+    if os.path.realpath(top) != os.path.realpath(os.getcwd()):
+        return 0
+    paths = {
+        x for x in files if not os.path.isabs(x) and os.path.normpath(x) == x
+    }
+    added = 0
+    for fact in sorted(facts):
+        cmds = {
+            x: GIT_FACTS[fact].format(branch=ctx.branch, path=x) for x in paths
+        }
+        # Already known (e.g., from the release manifest)?
+        todo = {x for x in paths if cmds[x] not in ctx.git_cache}
+        if len(todo) < GIT_BATCH_MIN_FILES:
+            continue
+        try:
+            answers = GIT_FACT_BATCHES[fact](
+                todo, ctx.branch, ctx.deadline, ctx.settings.git_slots
+            )
+        except GitError:
+            continue
+        for path, answer in answers.items():
+            ctx.git_cache[cmds[path]] = answer
+            added += 1
+    return added
 
 
-def check_release_date(h: HeaderBlock, branch: str = "main") -> None:
+def check_release_date(
+    h: HeaderBlock,
+    today: str,
+    branch: str = "main",
+    git_cache: dict = None,
+    deadline: Deadline = None,
+    git_stats: dict = None,
+    settings: Settings = None,
+) -> None:
+    """Ensure the first change log entry is the release entry,
+    dated by the first appearance of the file on `branch`
+
+    Args:
+        h (HeaderBlock): Header block loaded
+            into memory
+        today (str): Release date used if the file has never
+            been pushed to `branch`
+        branch (str): Release branch. Default is "main"
+        git_cache (dict): Optional store of Git answers
+        deadline (Deadline): Optional time limit for Git. If
+            Git can't answer in time, the release date already
+            recorded in the header is kept
+        git_stats (dict): Optional Git call counters (see
+            `ask_git()`)
+        settings (Settings): Settings in use (change log rules,
+            Git slots). Default is the built-in settings
+
+    Raises:
+        GitTimeoutError: Git did not answer in time, and the
+            header has no recorded release date (the header
+            is left unchanged)
+    """
+    if settings is None:
+        settings = BUILTIN_SETTINGS
     filepath = h.get("file")
-    # Drop any pre-existing changelog fields that denote
-    # the first release
-    for msg in ["?irst ?release?", "?irst ?omit?", "?nitial ?release?"]:
-        h.drop_by_val(msg)
+    rules = settings.changelog_rules()
+    # Release date recorded by a previous run (oldest entry
+    # that the rules would drop as a "first release" entry)
+    recorded = None
+    for key, val, is_changelog in h:
+        if is_changelog and rules.match(val) == (True, None):
+            recorded = key
     # First change log value should always be "Release date"
     # (although this entry will be deleted if the changelog is
     # too long)
     # Set release date to the first date the file
     # appeared on the main branch
-    git_cmd = f"git log --diff-filter=A --follow --format=%cd -1 {branch} -- {filepath}"
+    git_cmd = GIT_FACTS["first_added"].format(branch=branch, path=filepath)
     try:
-        rel_date = ask_git(git_cmd)
+        rel_date = ask_git(
+            git_cmd, git_cache, deadline, git_stats, settings.git_slots
+        )
+    except GitTimeoutError:
+        if recorded is None:
+            raise
+        rel_date = None
     except GitError:
         raise GitError(f"Branch {branch} not found in project")
-    # Never pushed to main?
-    if rel_date == "":
-        rel_date = git_date_convert(TODAY) + "+0000"
-    # Format provided date
-    rel_date = git_date_convert(rel_date)
+    # Drop any pre-existing changelog fields that denote
+    # the first release (plus any other configured clean-up)
+    rules.apply(h)
+    if rel_date is None:
+        # Git too slow: fall back to the recorded date
+        rel_date = recorded
+    else:
+        # Never pushed to main?
+        if rel_date == "":
+            rel_date = git_date_convert(today) + "+0000"
+        # Format provided date
+        rel_date = git_date_convert(rel_date)
     # TODO: for now, change log entries for the same day as the
     # release day are dropped, replaced instead by the
     # simple release method. In future, might want to consider
@@ -645,6 +2206,26 @@ def check_release_date(h: HeaderBlock, branch: str = "main") -> None:
     h.add(rel_date, "First release")
 
 
+def apply_changelog_rules(h: HeaderBlock, settings: Settings) -> None:
+    """Apply the change log rules (see `CHANGELOG_RULES`) without
+    Git. The release entry (the oldest entry the rules would drop)
+    is kept, as "First release", for `check_release_date()` to date
+
+    Args:
+        h (HeaderBlock): Header block loaded
+            into memory
+        settings (Settings): Settings in use
+    """
+    rules = settings.changelog_rules()
+    release = None
+    for key, val, is_changelog in h:
+        if is_changelog and rules.match(val) == (True, None):
+            release = key
+    rules.apply(h, keep=release)
+    if release is not None:
+        h.amend(release, "First release")
+
+
 def update_last_updated(h: HeaderBlock):
     last_date = h.get_last_date()
     h.amend("last updated", last_date)
@@ -656,7 +2237,15 @@ def prep_for_join(msg: str) -> str:
     return msg
 
 
-def changelog_merger(h: HeaderBlock, branch: str) -> None:
+def changelog_merger(
+    h: HeaderBlock,
+    branch: str,
+    today: str,
+    git_cache: dict = None,
+    deadline: Deadline = None,
+    git_stats: dict = None,
+    slots: tuple = None,
+) -> None:
     """ABC
 
     Note:
@@ -666,12 +2255,24 @@ def changelog_merger(h: HeaderBlock, branch: str) -> None:
 
     Args:
         h (HeaderBlock): _description_
+        branch (str): Release branch
+        today (str): Date the merged entry is filed under
+        git_cache (dict): Optional store of Git answers
+        deadline (Deadline): Optional time limit for Git
+        git_stats (dict): Optional Git call counters (see
+            `ask_git()`)
+        slots (tuple): Number of Git slots (see `git_slot_dirs()`)
+
+    Raises:
+        GitTimeoutError: Git did not answer in time (the
+            header is left unchanged, i.e., the merge is
+            deferred to a later run)
     """
     filepath = h.get("file")
     # Establish the last time this file was committed to main.
     # If never committed, the default date is used
-    git_cmd = f"git log -1 --format=%cd -- {branch} -- {filepath}"
-    last_commit_date = ask_git(git_cmd)
+    git_cmd = GIT_FACTS["last_commit"].format(branch=branch, path=filepath)
+    last_commit_date = ask_git(git_cmd, git_cache, deadline, git_stats, slots)
     if last_commit_date == "":
         last_commit_date = DEFAULT_DATE
     last_commit_date = git_date_convert(last_commit_date)
@@ -682,15 +2283,22 @@ def changelog_merger(h: HeaderBlock, branch: str) -> None:
                 prepped = prep_for_join(val)
                 latest_log.append(prepped)
                 h.drop(key)
-    h.add(TODAY, " ".join(latest_log[::-1]))
+    merged = " ".join(latest_log[::-1])
+    if today in h:
+        # Already committed today, so today's entry wasn't merged
+        # above. Fold in anything newer, rather than clashing
+        if merged:
+            h.append(today, merged)
+    else:
+        h.add(today, merged)
 
 
-def changelog_trim(h: HeaderBlock) -> None:
+def changelog_trim(h: HeaderBlock, lang: Language = PYTHON) -> None:
     # Apply word wrapping to a copy of the
     # header, so we can judge how many lines
     # the header (currently) takes up
     h2 = copy.deepcopy(h)
-    wrap_wrapper(h2)
+    wrap_wrapper(h2, lang)
     # Dates to drop
     drop_dates = []
     # Count changelog lines
@@ -698,43 +2306,3222 @@ def changelog_trim(h: HeaderBlock) -> None:
     for key, val, is_changelog in h2:
         if is_changelog:
             n_lines += val.count("\n") + 1
-            if n_lines > LOG_LINE_LENGTH:
+            if n_lines > lang.settings.LOG_LINE_LENGTH:
                 drop_dates.append(key)
     # Drop!
     for date in drop_dates:
         h.drop(date)
 
 
-def chain(file_to_proc: str) -> None:
-    # Load file
-    with open(file_to_proc) as f:
-        file_contents = f.readlines()
-    # Attempt to convert header block
-    # to dict, and split off the rest of the
-    # file
-    header, the_rest = load_meta(file_contents)
-    # Ensure "Last updated" date is synced with the
-    # change log
-    update_last_updated(header)
-    # Trim changelog, if it's too long
-    changelog_trim(header)
+class HeaderDraft:
+    """A header part way through normalisation. `normalise()`
+    runs the three steps (parse, apply the header stages, render)
+    back to back; the pipeline executor runs each on a different
+    stage (see `Pipeline`)
+
+    Args:
+        file_contents (list): Lines of the file
+        ctx (RunContext): Run options, clock and caches
+        lang (Language): Language of the file
+        report (FileReport): Filled in with the outcome and
+            per-stage measurements
+    """
+
+    def __init__(
+        self,
+        file_contents: list,
+        ctx: RunContext,
+        lang: Language,
+        report: FileReport,
+    ):
+        self.file_contents = file_contents
+        self.ctx = ctx
+        self.lang = lang
+        self.report = report
+        # The file's time budget starts as soon as work on it does
+        self.deadline = ctx.file_deadline()
+        self.header = None
+        self.original = None
+        self.the_rest = file_contents
+
+    def parse(self) -> bool:
+        """Parse the header
+
+        Returns:
+            bool: `False` if the header is already canonical
+                (nothing more to do)
+        """
+        report = self.report
+        # Skip all the work if the header is already canonical
+        with report.stage("fingerprint"):
+            canonical = has_valid_fingerprint(
+                self.file_contents, self.lang, self.ctx.today
+            )
+        if canonical:
+            report.canonical = True
+            return False
+        # Attempt to convert header block
+        # to dict, and split off the rest of the
+        # file
+        with report.stage("load_meta"):
+            self.header, self.the_rest = load_meta(
+                self.file_contents,
+                check_fs=self.ctx.check_fs,
+                lang=self.lang,
+            )
+            self.original = copy.deepcopy(self.header)
+        return True
+
+    def resolve(self) -> None:
+        """Apply the header stages (see `active_stages()`)"""
+        for stage in active_stages(self.ctx):
+            stage.run(self)
+
+    def render(self) -> list:
+        """Wrap and render the header
+
+        Returns:
+            list: New header lines
+        """
+        header = self.header
+        report = self.report
+        with report.stage("wrap_wrapper"):
+            wrap_wrapper(header, self.lang)
+            if self.ctx.fingerprint or "fingerprint" in header:
+                add_fingerprint(header, self.lang)
+        with report.stage("render"):
+            new_header = render_header(header, self.lang)
+            # Rendered lines may hold several (wrapped) lines each,
+            # so compare the text
+            new_contents = "".join(new_header + self.the_rest)
+            report.changed = new_contents != "".join(self.file_contents)
+            # Compare like with like (both wrapped)
+            wrap_wrapper(self.original, self.lang)
+            report.changed_keys = self.original.changed_keys(header)
+        return new_header
+
+
+class HeaderStage:
+    """One declared step of header normalisation
+
+    Args:
+        name (str): Stage name (as used in `HEADER_STAGES`, and
+            in timing reports)
+        func (Callable): Called with the `HeaderDraft` to work on
+        git_facts (tuple): Git facts (keys of `GIT_FACTS`) the
+            stage asks for. Stages that need Git are skipped in
+            offline runs, and their facts can be fetched for all
+            files in one batch (see `prefetch_git_facts()`)
+    """
+
+    def __init__(self, name: str, func, git_facts: tuple = ()):
+        self.name = name
+        self.func = func
+        self.git_facts = git_facts
+
+    def run(self, draft: "HeaderDraft") -> None:
+        with draft.report.stage(self.name):
+            try:
+                self.func(draft)
+            except GitTimeoutError:
+                # Deferred (or a recorded value kept) until Git
+                # can answer in time
+                draft.report.degraded.append(self.name)
+
+
+def run_changelog_merger(draft: HeaderDraft) -> None:
     # Merge log entries that exist between commits
     # to main
-    changelog_merger(header, "main")
+    ctx = draft.ctx
+    changelog_merger(
+        draft.header,
+        ctx.branch,
+        ctx.today,
+        ctx.git_cache,
+        draft.deadline,
+        draft.report.git,
+        ctx.settings.git_slots,
+    )
+
+
+def run_check_release_date(draft: HeaderDraft) -> None:
     # Ensure "First release" date matches first push to
     # main branch. If never pushed to main, a default
     # date is used
-    check_release_date(header, "main")
-    wrap_wrapper(header)
-    # Save to file
-    create_new_file(header, the_rest, file_to_proc)
+    ctx = draft.ctx
+    check_release_date(
+        draft.header,
+        ctx.today,
+        ctx.branch,
+        ctx.git_cache,
+        draft.deadline,
+        draft.report.git,
+        ctx.settings,
+    )
+
+
+HEADER_STAGE_REGISTRY = {
+    x.name: x
+    for x in [
+        HeaderStage(
+            "changelog_merger", run_changelog_merger, ("last_commit",)
+        ),
+        HeaderStage(
+            "changelog_trim", lambda d: changelog_trim(d.header, d.lang)
+        ),
+        HeaderStage(
+            "changelog_rules",
+            lambda d: apply_changelog_rules(d.header, d.ctx.settings),
+        ),
+        HeaderStage(
+            "check_release_date", run_check_release_date, ("first_added",)
+        ),
+        HeaderStage(
+            "update_last_updated", lambda d: update_last_updated(d.header)
+        ),
+    ]
+}
+
+
+def active_stages(ctx: RunContext) -> list:
+    """Header stages to run, in order (stages needing Git are
+    dropped from offline runs)
+
+    Args:
+        ctx (RunContext): Run options
+
+    Returns:
+        list: `HeaderStage`s
+    """
+    stages = [HEADER_STAGE_REGISTRY[x] for x in ctx.settings.HEADER_STAGES]
+    if ctx.offline:
+        stages = [x for x in stages if not x.git_facts]
+    return stages
+
+
+def normalise(
+    file_contents: list,
+    ctx: RunContext,
+    lang: Language = PYTHON,
+    report: FileReport = None,
+) -> Tuple[list, list]:
+    """Normalise the header of a file held in memory (the
+    part of `chain()` that doesn't touch the filesystem)
+
+    Args:
+        file_contents (list): Lines of the file
+        ctx (RunContext): Run options, clock and caches
+        lang (Language): Language of the file. Default
+            is Python
+        report (FileReport): If provided, filled in with the
+            outcome and per-stage measurements
+
+    Returns:
+        Tuple[list, list]: New header lines and the rest of
+            the file (unaltered). Concatenated, these make up
+            the new file. If the header is already canonical,
+            the header lines are empty and the rest of the file
+            is the whole file
+    """
+    if report is None:
+        report = FileReport(None)
+    draft = HeaderDraft(file_contents, ctx, lang, report)
+    if not draft.parse():
+        return [], file_contents
+    draft.resolve()
+    return draft.render(), draft.the_rest
+
+
+def chain(
+    file_to_proc: str,
+    ctx: RunContext = None,
+    lang: Language = PYTHON,
+    report: FileReport = None,
+) -> bool:
+    """Format the header block of a single file. Safe to call
+    concurrently (from threads) for different files sharing
+    the same `RunContext`
+
+    Note:
+        Headers that already carry a fingerprint always have
+        it refreshed, even if `ctx.fingerprint` is `False`. Once
+        the run/file deadline has passed, Git-derived steps fall
+        back to cached/recorded values (or are skipped), while
+        formatting steps always complete
+
+    Args:
+        file_to_proc (str): File to process
+        ctx (RunContext): Run options, clock and caches. Default
+            is a fresh context with default options
+        lang (Language): Language of the file. Default
+            is Python
+        report (FileReport): If provided, filled in with the
+            outcome and per-stage measurements
+
+    Returns:
+        bool: `True` if the header was (or, in check mode,
+            would be) changed
+    """
+    if ctx is None:
+        ctx = RunContext()
+    if report is None:
+        report = FileReport(file_to_proc)
+    if not ctx.zero_decode:
+        return chain_text(file_to_proc, ctx, lang, report)
+    # Load file (only the header region is decoded)
+    with report.stage("read"):
+        with open(file_to_proc, "rb") as f:
+            source = ByteSource(f.read(), lang)
+    report.size = len(source.data)
+    new_header, the_rest = normalise(source.lines, ctx, lang, report)
+    chunks = [source.data]
+    if report.changed:
+        chunks = source.rebuild(new_header, the_rest)
+    if ctx.digests:
+        report.digest_in = content_digest([source.data])
+        report.digest_out = content_digest(chunks)
+    # Save to file (only if something changed)
+    if report.changed and not ctx.check:
+        with report.stage("write"):
+            with open(file_to_proc, "wb") as f:
+                f.writelines(chunks)
+    return report.changed
+
+
+def content_digest(chunks: list) -> str:
+    """Digest of file contents, given as chunks of bytes (or
+    `memoryview`s)"""
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def chain_text(
+    file_to_proc: str, ctx: RunContext, lang: Language, report: FileReport
+) -> bool:
+    """Text mode version of `chain()`. The whole file is decoded
+    (platform default encoding) and written back with "\\n" line
+    endings"""
+    # Load file (decoded as `open()` would in text mode, keeping
+    # the bytes for the digests)
+    with report.stage("read"):
+        with open(file_to_proc, "rb") as f:
+            data = f.read()
+        file_contents = io.TextIOWrapper(io.BytesIO(data)).readlines()
+    report.size = sum(len(x) for x in file_contents)
+    new_header, the_rest = normalise(file_contents, ctx, lang, report)
+    if ctx.digests:
+        report.digest_in = content_digest([data])
+        report.digest_out = report.digest_in
+        if report.changed:
+            # Encoded as the text mode write below would
+            out = io.BytesIO()
+            writer = io.TextIOWrapper(out)
+            writer.writelines(new_header + the_rest)
+            writer.flush()
+            report.digest_out = content_digest([out.getvalue()])
+    # Save to file (only if something changed)
+    if report.changed and not ctx.check:
+        with report.stage("write"):
+            with open(file_to_proc, "w") as f:
+                f.writelines(new_header + the_rest)
+    return report.changed
+
+
+def process_file(file_to_proc: str, ctx: RunContext) -> FileReport:
+    """Process a single (supported) file. Module-level, so it
+    can be dispatched to process pools
+
+    Args:
+        file_to_proc (str): File to process
+        ctx (RunContext): Run options, clock and caches
+
+    Returns:
+        FileReport: Outcome of processing the file
+    """
+    report = FileReport(file_to_proc, ctx.memory)
+    try:
+        lang = classify(file_to_proc, ctx.settings)
+        chain(file_to_proc, ctx, lang, report)
+    except Exception as e:
+        report.error = f"{type(e).__name__}: {e}"
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        report.peak_rss_kb = usage.ru_maxrss
+    return report
+
+
+def run_files(
+    files: list, ctx: RunContext, executor: str = "serial", jobs: int = None
+) -> list:
+    """Process a list of files. Unsupported file types
+    are skipped
+
+    Args:
+        files (list): Files to process
+        ctx (RunContext): Run options, clock and caches
+        executor (str): One of `EXECUTORS`. Threads share the
+            context (and its caches) directly, which is cheapest
+            on free-threaded Python builds. Processes each get a
+            copy of the context. The pipeline overlaps reading,
+            parsing, Git and writing (see `Pipeline`). "auto"
+            picks serial, thread or process execution (and the
+            number of workers) per run, recording the plan as
+            `ctx.plan` (see `plan_execution()`). Default
+            is "serial". Memory
+            tracing (`ctx.memory`) is process-wide, so always
+            runs serially
+        jobs (int): Number of workers (Git stage threads, for the
+            pipeline). Default is chosen by `concurrent.futures`
+
+    Returns:
+        list: `FileReport` for each file, in the order of `files`
+    """
+    order = {path: i for i, path in enumerate(files)}
+    reports = list(iter_files(files, ctx, executor, jobs))
+    return sorted(reports, key=lambda x: order[x.path])
+
+
+def iter_files(
+    files: list, ctx: RunContext, executor: str = "serial", jobs: int = None
+):
+    """Process a list of files, yielding each report as soon
+    as its file is done (see `run_files()` for arguments)
+
+    Yields:
+        FileReport: Report for each supported file, in order
+            of completion
+    """
+    if executor not in EXECUTORS:
+        raise ValueError(f"Unknown executor `{executor}`")
+    files = [x for x in files if classify(x, ctx.settings) is not None]
+    if not ctx.offline:
+        use_manifest(ctx)
+    plan = None
+    if executor == "auto":
+        start = time.perf_counter()
+        plan = plan_execution(files, ctx, jobs)
+        executor, jobs = plan.executor, plan.workers
+        ctx.plan = plan
+    # Process pools share prefetched answers through an index instead
+    # (see `publish_history()`)
+    if executor != "process":
+        prefetch_git_facts(files, ctx)
+    if ctx.memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if executor == "serial" or len(files) < 2 or ctx.memory:
+        for file in files:
+            yield process_file(file, ctx)
+    elif executor == "pipeline":
+        yield from Pipeline(ctx, jobs).run(files)
+    else:
+        yield from pool_files(files, ctx, executor, jobs)
+    update_manifest(files, ctx)
+    if plan is not None:
+        plan.actual_s = time.perf_counter() - start
+
+
+def pool_files(files: list, ctx: RunContext, executor: str, jobs: int):
+    """Process files on a thread or process pool (see
+    `iter_files()`)"""
+    if executor == "thread":
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    else:
+        # Settings travel with the context sent with each file
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+    shared, index_path = ctx, None
+    if executor == "process":
+        handle, index_path = tempfile.mkstemp(suffix=".header-hook-index")
+        os.close(handle)
+    try:
+        if index_path is not None:
+            # Workers get a copy of the context with every file, so
+            # prefetched Git answers are sent as a (shared) index
+            shared = publish_history(files, ctx, index_path)
+        with pool:
+            futures = [pool.submit(process_file, x, shared) for x in files]
+            for future in concurrent.futures.as_completed(futures):
+                yield future.result()
+    finally:
+        if shared is not ctx:
+            shared.git_cache.history.close()
+        if index_path is not None:
+            os.remove(index_path)
+
+
+def summary_event(reports: list, elapsed_s: float, check: bool) -> dict:
+    """Closing event for a JSON Lines stream
+
+    Args:
+        reports (list): `FileReport`s from the run
+        elapsed_s (float): Wall time of the run (seconds)
+        check (bool): Whether the run was in check mode
+
+    Returns:
+        dict: Event, with a count of files for each outcome
+    """
+    outcomes = {}
+    for report in reports:
+        outcome = report.outcome(check)
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    return {
+        "event": "summary",
+        "files": len(reports),
+        "outcomes": outcomes,
+        "degraded": sum(1 for x in reports if x.degraded),
+        "elapsed_ms": round(elapsed_s * 1000, 3),
+        "git_calls": sum(x.git["calls"] for x in reports),
+        "git_cache_hits": sum(x.git["cache_hits"] for x in reports),
+        "git_wait_ms": round(sum(x.git["wait_s"] for x in reports) * 1000, 3),
+        "wrap_cache": wrap_cache_stats(),
+    }
+
+
+def memory_report(reports: list, top: int = 10) -> str:
+    """Summarise memory use from a run made with `ctx.memory`
+
+    Args:
+        reports (list): `FileReport`s from the run
+        top (int): Number of worst files to list. Default is 10
+
+    Returns:
+        str: Report, listing the largest per-stage allocation
+            peak across all files, then the files with the
+            largest peaks
+    """
+    stage_peaks = {}
+    stage_net = {}
+    for report in reports:
+        for name, record in report.stages.items():
+            stage_peaks[name] = max(
+                stage_peaks.get(name, 0), record.get("mem_peak", 0)
+            )
+            stage_net[name] = max(
+                stage_net.get(name, 0), record.get("mem_net", 0)
+            )
+    lines = ["Memory by stage (worst file, KiB):"]
+    lines.append(f"  {'stage':<22}{'peak':>10}{'net':>10}")
+    for name, peak in stage_peaks.items():
+        lines.append(
+            f"  {name:<22}{peak / 1024:>10.1f}{stage_net[name] / 1024:>10.1f}"
+        )
+    worst = sorted(reports, key=lambda x: x.mem_peak(), reverse=True)
+    lines.append(f"Worst {min(top, len(worst))} files (KiB):")
+    lines.append(f"  {'peak':>10}{'size':>10}  file")
+    for report in worst[0:top]:
+        size = (report.size or 0) / 1024
+        lines.append(
+            f"  {report.mem_peak() / 1024:>10.1f}{size:>10.1f}  {report.path}"
+        )
+    if reports:
+        peak_rss = max(x.peak_rss_kb or 0 for x in reports)
+        lines.append(f"Peak RSS: {peak_rss} KiB")
+    return "\n".join(lines)
+
+
+#################################
+# Execution planner
+#################################
+
+
+class ExecutionPlan:
+    """How a run's files will be spread over workers (see
+    `plan_execution()`), and how long that was expected to take
+
+    Args:
+        executor (str): Chosen executor (one of `EXECUTORS`)
+        workers (int): Number of workers (1 when serial)
+        predicted_s (float): Predicted time for the run (seconds)
+        inputs (dict): What the prediction was based on
+    """
+
+    def __init__(
+        self, executor: str, workers: int, predicted_s: float, inputs: dict
+    ):
+        self.executor = executor
+        self.workers = workers
+        self.predicted_s = predicted_s
+        self.inputs = inputs
+        # Filled in once the run is over
+        self.actual_s = None
+
+    def to_dict(self) -> dict:
+        actual_ms = None
+        if self.actual_s is not None:
+            actual_ms = round(self.actual_s * 1000, 3)
+        return {
+            "executor": self.executor,
+            "workers": self.workers,
+            "predicted_ms": round(self.predicted_s * 1000, 3),
+            "actual_ms": actual_ms,
+            **self.inputs,
+        }
+
+
+def plan_execution(files: list, ctx: RunContext, jobs: int = None):
+    """Choose the cheapest way to run a list of files, using a
+    simple cost model (see `PLAN_COSTS`): per-file work, Git
+    answers not already cached (asked file by file, or with one
+    history walk per fact for larger runs), and the cost of
+    starting and feeding a pool. Threads only overlap waiting on
+    Git; processes also spread the parsing. The pipeline executor
+    is never chosen (it has to be asked for)
+
+    Args:
+        files (list): Supported files about to be processed
+        ctx (RunContext): Run options, clock and caches (Git
+            answers already cached count as free)
+        jobs (int): Number of workers to use, if pooled. Default
+            is chosen by the planner
+
+    Returns:
+        ExecutionPlan: The cheapest plan
+    """
+    n_files = len(files)
+    n_bytes = 0
+    for path in files:
+        with contextlib.suppress(OSError):
+            n_bytes += os.path.getsize(path)
+    facts = set()
+    if not ctx.offline:
+        facts = {x for y in active_stages(ctx) for x in y.git_facts}
+    # Git answers still needed, per fact
+    missing = {
+        fact: sum(
+            1
+            for x in files
+            if GIT_FACTS[fact].format(branch=ctx.branch, path=x)
+            not in ctx.git_cache
+        )
+        for fact in facts
+    }
+    n_questions = n_files * len(facts)
+    hit_rate = 1.0
+    if n_questions:
+        hit_rate = 1 - sum(missing.values()) / n_questions
+    # Facts fetched up front with one history walk each (see
+    # `prefetch_git_facts()`)
+    walks = [x for x, y in missing.items() if y >= GIT_BATCH_MIN_FILES]
+    if walks:
+        try:
+            top = ask_git(
+                "git rev-parse --show-toplevel",
+                ctx.git_cache,
+                ctx.deadline,
+                slots=ctx.settings.git_slots,
+            )
+            if os.path.realpath(top) != os.path.realpath(os.getcwd()):
+                walks = []
+        except GitError:
+            walks = []
+    costs = PLAN_COSTS
+    setup = len(walks) * costs["git_walk"]
+    cpu = n_files * costs["file"] + n_bytes / 1024 * costs["kb"]
+    git = costs["git_call"] * sum(
+        y for x, y in missing.items() if x not in walks
+    )
+    cpus = os.cpu_count() or 1
+    # Workers for a pool (of either kind). Git itself needs a CPU, so
+    # only as many answers as there are CPUs are awaited at once
+    w = jobs or min(n_files, cpus)
+    options = [("serial", 1, setup + cpu + git)]
+    if n_files > 1 and not ctx.memory:
+        start = w * costs["thread_start"]
+        options.append(("thread", w, setup + start + cpu + git / w))
+        start = w * costs["process_start"]
+        feed = n_files * costs["process_file"]
+        options.append(("process", w, setup + start + feed + (cpu + git) / w))
+    # Ties go to the simplest option
+    executor, workers, predicted_s = min(options, key=lambda x: x[2])
+    inputs = {
+        "files": n_files,
+        "bytes": n_bytes,
+        "git_hit_rate": round(hit_rate, 3),
+        "git_walks": len(walks),
+    }
+    return ExecutionPlan(executor, workers, predicted_s, inputs)
+
+
+def plan_report(plan: ExecutionPlan) -> str:
+    """One-line summary of an execution plan, and how it went"""
+    inputs = plan.inputs
+    text = (
+        f"Plan: {plan.executor} x{plan.workers} for {inputs['files']} "
+        + f"files ({inputs['bytes'] / 1024:.0f} KB, "
+        + f"{inputs['git_hit_rate']:.0%} of Git answers cached, "
+        + f"{inputs['git_walks']} history walks): "
+        + f"predicted {plan.predicted_s:.3f}s"
+    )
+    if plan.actual_s is not None:
+        text += f", actual {plan.actual_s:.3f}s"
+    return text
+
+
+#################################
+# History index
+#################################
+# Indexes attached by this process, by file (see
+# `HistoryIndex.__setstate__`)
+ATTACHED_HISTORY = {}
+
+
+class HistoryIndex:
+    """Read-only table of Git facts (see `GIT_FACTS`) for many
+    paths, held in a memory-mapped file so process pool workers
+    share one copy of it. Pickling an index only sends the file
+    name; each worker maps the file once, whatever the number of
+    files (and pickled contexts) it is sent
+
+    Note:
+        File layout (little-endian): a header (magic, number of
+        paths), path offsets (uint32, one more than the number of
+        paths), one column of int32 day ordinals per fact, then
+        the sorted, UTF-8 encoded paths. Ordinal 0 means "never
+        committed" and -1 "not known" (ask Git)
+
+    Args:
+        path (str): Index file (see `HistoryIndex.build()`)
+        branch (str): Release branch the facts were fetched for
+        facts (tuple): Facts held, in column order
+    """
+
+    header = struct.Struct("<4sI")
+    magic = b"HHX1"
+
+    def __init__(self, path: str, branch: str, facts: tuple):
+        self.path = path
+        self.branch = branch
+        self.facts = facts
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.map)
+        magic, self.n = self.header.unpack_from(view)
+        if magic != self.magic:
+            raise ValueError(f"{path} is not a history index")
+        start = self.header.size
+        end = start + 4 * (self.n + 1)
+        self.offsets = view[start:end].cast("I")
+        self.columns = {}
+        for fact in facts:
+            start, end = end, end + 4 * self.n
+            self.columns[fact] = view[start:end].cast("i")
+        self.names = view[end:]
+        # Commands answered, as the text either side of the path
+        self.templates = {}
+        for fact in facts:
+            cmd = GIT_FACTS[fact].format(branch=branch, path="\0")
+            self.templates[fact] = tuple(cmd.split("\0"))
+
+    @classmethod
+    def build(cls, path: str, branch: str, answers: dict) -> "HistoryIndex":
+        """Write an index file
+
+        Args:
+            path (str): File to write
+            branch (str): Release branch
+            answers (dict): For each fact, the Git answer for each
+                path (as returned by `ask_git()`)
+
+        Returns:
+            HistoryIndex: The index, mapped
+        """
+        facts = tuple(sorted(answers))
+        paths = {x for y in answers.values() for x in y}
+        names = sorted(x.encode(errors="surrogateescape") for x in paths)
+        offsets = array.array("I", [0])
+        for name in names:
+            offsets.append(offsets[-1] + len(name))
+        with open(path, "wb") as f:
+            f.write(cls.header.pack(cls.magic, len(names)))
+            f.write(offsets.tobytes())
+            for fact in facts:
+                known = answers[fact]
+                column = array.array("i", [-1]) * len(names)
+                for i, name in enumerate(names):
+                    answer = known.get(name.decode(errors="surrogateescape"))
+                    if answer is not None:
+                        column[i] = git_date_ordinal(answer)
+                f.write(column.tobytes())
+            f.writelines(names)
+        return cls(path, branch, facts)
+
+    def __getstate__(self) -> dict:
+        return {"path": self.path, "branch": self.branch, "facts": self.facts}
+
+    def __setstate__(self, state: dict) -> None:
+        attached = ATTACHED_HISTORY.get(state["path"])
+        if attached is None:
+            attached = HistoryIndex(**state)
+            ATTACHED_HISTORY[state["path"]] = attached
+        self.__dict__.update(attached.__dict__)
+
+    def find(self, path: str) -> Any:
+        """Position of a path in the table (binary search), or
+        `None` if it isn't there"""
+        key = path.encode(errors="surrogateescape")
+        offsets, names = self.offsets, self.names
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            name = names[offsets[mid] : offsets[mid + 1]].tobytes()
+            if name == key:
+                return mid
+            if name < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def answer(self, cmd: str) -> Any:
+        """Answer a Git fact command (see `GIT_FACTS`) from the
+        table
+
+        Args:
+            cmd (str): Command, as passed to `ask_git()`
+
+        Returns:
+            str: The answer (Git's date format, or an empty string
+                if never committed), or `None` if not known
+        """
+        for fact, (before, after) in self.templates.items():
+            if not (cmd.startswith(before) and cmd.endswith(after)):
+                continue
+            i = self.find(cmd[len(before) : len(cmd) - len(after)])
+            if i is None:
+                return None
+            day = self.columns[fact][i]
+            if day < 0:
+                return None
+            if day == 0:
+                return ""
+            date = datetime.fromordinal(day)
+            return date.strftime("%a %b %d %H:%M:%S %Y +0000")
+        return None
+
+    def close(self) -> None:
+        self.offsets.release()
+        for column in self.columns.values():
+            column.release()
+        self.names.release()
+        self.map.close()
+
+
+class GitCache(dict):
+    """Git answer cache (see `ask_git()`) backed by a shared
+    `HistoryIndex`. Answers found in neither are asked of Git
+    and kept in the dict as usual
+
+    Args:
+        history (HistoryIndex): Index to consult
+    """
+
+    def __init__(self, history: HistoryIndex):
+        super().__init__()
+        self.history = history
+
+    def __contains__(self, cmd: str) -> bool:
+        if super().__contains__(cmd):
+            return True
+        return self.history.answer(cmd) is not None
+
+    def __missing__(self, cmd: str) -> str:
+        answer = self.history.answer(cmd)
+        if answer is None:
+            raise KeyError(cmd)
+        return answer
+
+
+def git_date_ordinal(answer: str) -> int:
+    """Day ordinal of a Git date (in the committer's time zone,
+    as `git_date_convert()`), or 0 for an empty answer"""
+    if answer == "":
+        return 0
+    date = datetime.strptime(answer, "%a %b %d %H:%M:%S %Y %z")
+    return date.toordinal()
+
+
+def publish_history(files: list, ctx: RunContext, index_path: str) -> Any:
+    """Fetch the Git facts needed for many files (see
+    `prefetch_git_facts()`) into a `HistoryIndex`, for sharing
+    with process pool workers
+
+    Args:
+        files (list): Files about to be processed
+        ctx (RunContext): Run options, clock and caches
+        index_path (str): File to write the index to
+
+    Returns:
+        RunContext: Copy of `ctx` whose Git cache is backed by
+            the index (cheap to send to workers), or `ctx` itself
+            if there is nothing to share
+    """
+    prefetch_git_facts(files, ctx)
+    facts = {x for stage in active_stages(ctx) for x in stage.git_facts}
+    answers = {x: {} for x in sorted(facts)}
+    for fact in answers:
+        for path in files:
+            cmd = GIT_FACTS[fact].format(branch=ctx.branch, path=path)
+            if cmd in ctx.git_cache:
+                answers[fact][path] = ctx.git_cache[cmd]
+    if ctx.offline or not any(answers.values()):
+        return ctx
+    shared = copy.copy(ctx)
+    history = HistoryIndex.build(index_path, ctx.branch, answers)
+    shared.git_cache = GitCache(history)
+    return shared
+
+
+#################################
+# Pipeline executor
+#################################
+
+
+class PipelineJob:
+    """One file passing through the `Pipeline`"""
+
+    def __init__(self, path: str, lang: Language):
+        self.path = path
+        self.lang = lang
+        self.report = FileReport(path)
+        self.source = None
+        self.draft = None
+        self.chunks = None
+
+
+class PipelineStage:
+    """One stage of the `Pipeline`: a pool of threads taking
+    jobs from a bounded queue, with utilisation and queue depth
+    counters
+
+    Args:
+        name (str): Stage name
+        func (Callable): Called with each job. Returns the name
+            of the stage to pass the job on to, or `None` when
+            the job is finished
+        workers (int): Number of threads
+        maxsize (int): Capacity of the stage's queue
+    """
+
+    def __init__(self, name: str, func, workers: int, maxsize: int):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.inbox = queue.Queue(maxsize)
+        self.lock = threading.Lock()
+        self.running = workers
+        self.items = 0
+        self.busy_s = 0.0
+        self.depth_max = 0
+        self.depth_sum = 0
+        # Time upstream stages spent blocked on this stage's queue
+        self.blocked_s = 0.0
+
+    def put(self, job: Any) -> None:
+        start = time.perf_counter()
+        self.inbox.put(job)
+        depth = self.inbox.qsize()
+        with self.lock:
+            self.blocked_s += time.perf_counter() - start
+            self.depth_max = max(self.depth_max, depth)
+            self.depth_sum += depth
+            self.items += 1
+
+    def stats(self, elapsed_s: float) -> dict:
+        items = max(self.items, 1)
+        capacity = max(elapsed_s * self.workers, 1e-9)
+        return {
+            "stage": self.name,
+            "workers": self.workers,
+            "items": self.items,
+            "busy_s": round(self.busy_s, 6),
+            "utilisation": round(self.busy_s / capacity, 3),
+            "depth_max": self.depth_max,
+            "depth_mean": round(self.depth_sum / items, 2),
+            "blocked_s": round(self.blocked_s, 6),
+        }
+
+
+class Pipeline:
+    """Files flow through stages connected by bounded queues, so
+    disk, Git and CPU work overlap and a run is limited by the
+    slowest of them, rather than the sum. Stages: "read" (load
+    bytes), "parse" (fingerprint check and `load_meta()`), "git"
+    (the header stages, see `HEADER_STAGES`), "format" (wrapping
+    and rendering) and "write"
+
+    Note:
+        Files are always read as bytes (see `ByteSource`). The CPU
+        stages have one thread each, as they hold the GIL; extra
+        threads go to the I/O- and Git-bound stages. Memory
+        tracing (`ctx.memory`) is not supported
+
+    Args:
+        ctx (RunContext): Run options, clock and caches (shared
+            by every stage)
+        jobs (int): Number of Git stage threads. Default is
+            `PIPELINE_WORKERS["git"]`
+    """
+
+    def __init__(self, ctx: RunContext, jobs: int = None):
+        self.ctx = ctx
+        workers = dict(PIPELINE_WORKERS)
+        if jobs is not None:
+            workers["git"] = jobs
+        funcs = {
+            "read": self.read,
+            "parse": self.parse,
+            "git": self.resolve,
+            "format": self.render,
+            "write": self.write,
+        }
+        # Input is queued up front, so the first queue is unbounded
+        self.stages = {
+            name: PipelineStage(
+                name,
+                funcs[name],
+                workers[name],
+                0 if name == "read" else PIPELINE_QUEUE_SIZE,
+            )
+            for name in PIPELINE_STAGES
+        }
+        self.done = queue.Queue()
+        self.elapsed_s = 0.0
+
+    def read(self, job: PipelineJob) -> Any:
+        with job.report.stage("read"):
+            with open(job.path, "rb") as f:
+                job.source = ByteSource(f.read(), job.lang)
+        job.report.size = len(job.source.data)
+        if self.ctx.digests:
+            job.report.digest_in = content_digest([job.source.data])
+        return "parse"
+
+    def parse(self, job: PipelineJob) -> Any:
+        job.draft = HeaderDraft(
+            job.source.lines, self.ctx, job.lang, job.report
+        )
+        if job.draft.parse():
+            return "git"
+        if self.ctx.digests:
+            job.report.digest_out = job.report.digest_in
+        return None
+
+    def resolve(self, job: PipelineJob) -> Any:
+        job.draft.resolve()
+        return "format"
+
+    def render(self, job: PipelineJob) -> Any:
+        new_header = job.draft.render()
+        job.chunks = [job.source.data]
+        if job.report.changed:
+            job.chunks = job.source.rebuild(new_header, job.draft.the_rest)
+        if self.ctx.digests:
+            job.report.digest_out = content_digest(job.chunks)
+        if job.report.changed and not self.ctx.check:
+            return "write"
+        return None
+
+    def write(self, job: PipelineJob) -> Any:
+        with job.report.stage("write"):
+            with open(job.path, "wb") as f:
+                f.writelines(job.chunks)
+        return None
+
+    def work(self, stage: PipelineStage) -> None:
+        """Worker thread loop for a stage"""
+        while True:
+            job = stage.inbox.get()
+            if job is None:
+                break
+            start = time.perf_counter()
+            try:
+                next_stage = stage.func(job)
+            except Exception as e:
+                job.report.error = f"{type(e).__name__}: {e}"
+                next_stage = None
+            with stage.lock:
+                stage.busy_s += time.perf_counter() - start
+            if next_stage is None:
+                self.done.put(job.report)
+            else:
+                self.stages[next_stage].put(job)
+        # The last worker out shuts down the next stage. Jobs only
+        # ever move forwards, so nothing can arrive afterwards
+        with stage.lock:
+            stage.running -= 1
+            last = stage.running == 0
+        position = PIPELINE_STAGES.index(stage.name)
+        if last and position + 1 < len(PIPELINE_STAGES):
+            following = self.stages[PIPELINE_STAGES[position + 1]]
+            for _ in range(following.workers):
+                following.inbox.put(None)
+
+    def run(self, files: list):
+        """Process files, yielding each report as soon as its
+        file is done
+
+        Args:
+            files (list): Supported files to process
+
+        Yields:
+            FileReport: Report for each file, in order of
+                completion
+        """
+        start = time.perf_counter()
+        first = self.stages[PIPELINE_STAGES[0]]
+        for path in files:
+            first.put(PipelineJob(path, classify(path, self.ctx.settings)))
+        for _ in range(first.workers):
+            first.inbox.put(None)
+        threads = [
+            threading.Thread(target=self.work, args=(stage,), daemon=True)
+            for stage in self.stages.values()
+            for _ in range(stage.workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for _ in files:
+            yield self.done.get()
+        for thread in threads:
+            thread.join()
+        self.elapsed_s = time.perf_counter() - start
+        self.ctx.pipeline_stats = self.stats()
+
+    def stats(self) -> list:
+        """Per-stage counters (see `PipelineStage.stats()`)"""
+        return [x.stats(self.elapsed_s) for x in self.stages.values()]
+
+
+def pipeline_report(stats: list) -> str:
+    """Human-readable per-stage utilisation and queue depth
+
+    Args:
+        stats (list): Stage counters (see `Pipeline.stats()`)
+
+    Returns:
+        str: Report text. The busiest stage is the bottleneck
+    """
+    lines = ["Pipeline stages:"]
+    lines.append(
+        f"  {'stage':<8}{'workers':>8}{'items':>8}{'busy s':>10}"
+        + f"{'util':>7}{'depth max':>11}{'mean':>7}{'blocked s':>11}"
+    )
+    for x in stats:
+        lines.append(
+            f"  {x['stage']:<8}{x['workers']:>8}{x['items']:>8}"
+            + f"{x['busy_s']:>10.3f}{x['utilisation']:>7.0%}"
+            + f"{x['depth_max']:>11}{x['depth_mean']:>7.1f}"
+            + f"{x['blocked_s']:>11.3f}"
+        )
+    if stats:
+        busiest = max(stats, key=lambda x: x["utilisation"])
+        lines.append(f"Bottleneck: {busiest['stage']}")
+    return "\n".join(lines)
+
+
+#################################
+# Release manifest
+#################################
+
+
+class Manifest:
+    """Committed record of each file's release: the date and hash
+    of the commit that first added it to the release branch. Lets
+    shallow clones (e.g., in CI) date releases without the history
+
+    Args:
+        path (str): Path to the manifest file
+        branch (str): Release branch the entries refer to
+        entries (dict): {"released": date, "commit": hash} for each
+            file, keyed by path (relative to the repository root)
+    """
+
+    def __init__(self, path: str, branch: str, entries: dict = None):
+        self.path = path
+        self.branch = branch
+        self.entries = entries if entries is not None else {}
+        self.dirty = False
+
+    @classmethod
+    def load(cls, path: str, branch: str) -> Any:
+        """Read a manifest file
+
+        Args:
+            path (str): Path to the manifest file
+            branch (str): Release branch of a manifest that doesn't
+                record one (the configured `DEFAULT_BRANCH`)
+
+        Raises:
+            ConfigError: If the file is not a valid manifest
+
+        Returns:
+            Manifest: The manifest, or `None` if the file does
+                not exist
+        """
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            raise ConfigError(f"Invalid release manifest `{path}`: {e}")
+        if not isinstance(data, dict) or not isinstance(
+            data.get("files"), dict
+        ):
+            raise ConfigError(f"Invalid release manifest `{path}`")
+        return cls(path, data.get("branch", branch), data["files"])
+
+    def save(self) -> None:
+        """Write the manifest (one entry per line, sorted, so
+        changes diff cleanly)"""
+        data = {"branch": self.branch, "files": self.entries}
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+            f.write("\n")
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+    def add(self, path: str, commit: str, released: str) -> None:
+        self.entries[path] = {"commit": commit, "released": released}
+        self.dirty = True
+
+    def prune(self) -> list:
+        """Drop entries for files that no longer exist (e.g., the
+        old name of a renamed file)
+
+        Returns:
+            list: Paths dropped
+        """
+        gone = [x for x in self.entries if not os.path.exists(x)]
+        for path in gone:
+            del self.entries[path]
+        self.dirty = self.dirty or bool(gone)
+        return gone
+
+
+def use_manifest(ctx: RunContext) -> Any:
+    """Load the release manifest (the `MANIFEST_FILE` setting, in
+    the current directory) into a run, so release dates recorded in it are
+    answered without asking Git
+
+    Args:
+        ctx (RunContext): Run options, clock and caches. The
+            manifest is stored as `ctx.manifest`, and its answers
+            added to `ctx.git_cache`
+
+    Returns:
+        Manifest: The manifest, or `None` if there isn't one (or
+            it records a different release branch)
+    """
+    if ctx.manifest is not None:
+        return ctx.manifest
+    manifest = Manifest.load(
+        ctx.settings.MANIFEST_FILE, ctx.settings.DEFAULT_BRANCH
+    )
+    if manifest is None or manifest.branch != ctx.branch:
+        return None
+    for path, entry in manifest.entries.items():
+        cmd = GIT_FACTS["first_added"].format(branch=ctx.branch, path=path)
+        ctx.git_cache.setdefault(cmd, entry["released"])
+    ctx.manifest = manifest
+    return manifest
+
+
+def update_manifest(files: list, ctx: RunContext) -> list:
+    """Record the releases of files missing from the manifest
+    (newly added or renamed files), once they reach the release
+    branch. Only Git is asked, and only about the missing files
+
+    Args:
+        files (list): Files processed by the run
+        ctx (RunContext): Run options, clock and caches. Nothing
+            is written in check mode, or if the run has no
+            manifest
+
+    Returns:
+        list: Paths added to the manifest
+    """
+    manifest = ctx.manifest
+    if manifest is None or ctx.check or ctx.offline:
+        return []
+    missing = {
+        x
+        for x in files
+        if x not in manifest.entries
+        and not os.path.isabs(x)
+        and os.path.normpath(x) == x
+    }
+    if not missing:
+        return []
+    try:
+        if len(missing) >= GIT_BATCH_MIN_FILES:
+            commits = first_added_commits(
+                missing, ctx.branch, ctx.deadline, ctx.settings.git_slots
+            )
+        else:
+            commits = {}
+            for path in missing:
+                answer = ask_git(
+                    "git log --diff-filter=A --follow --format=%H%x01%cd "
+                    + f"-1 {ctx.branch} -- {path}",
+                    deadline=ctx.deadline,
+                    slots=ctx.settings.git_slots,
+                )
+                commits[path] = tuple(answer.split("\x01")) if answer else None
+    except GitError:
+        # Try again next run
+        return []
+    added = []
+    for path, commit in sorted(commits.items()):
+        # Not released yet?
+        if commit is not None:
+            manifest.add(path, commit[0], commit[1])
+            added.append(path)
+    if added:
+        manifest.prune()
+    if manifest.dirty:
+        manifest.save()
+    return added
+
+
+def verify_manifest_main(argv: list, settings: Settings = None) -> int:
+    settings = BUILTIN_SETTINGS if settings is None else settings
+    manifest_file = settings.MANIFEST_FILE
+    parser = argparse.ArgumentParser(
+        prog="header_hook.py verify-manifest",
+        description="Rebuild the release manifest from local Git history, "
+        + "and compare it with the committed one",
+    )
+    parser.add_argument(
+        "--write",
+        action="store_true",
+        help="Write the rebuilt manifest (creating it if needed)",
+    )
+    parser.add_argument("--branch", default=settings.DEFAULT_BRANCH)
+    args = parser.parse_args(argv)
+    try:
+        files = [
+            x
+            for x in ask_git("git ls-files").split("\n")
+            if x and classify(x, settings) is not None
+        ]
+    except (GitError, OSError) as e:
+        # Not a Git repository (or Git isn't installed)
+        print(f"header_hook.py: {e}", file=sys.stderr)
+        return 2
+    try:
+        commits = first_added_commits(
+            set(files), args.branch, None, settings.git_slots
+        )
+    except GitError:
+        print(f"Branch {args.branch} not found in project", file=sys.stderr)
+        return 2
+    rebuilt = Manifest(manifest_file, args.branch)
+    for path, commit in sorted(commits.items()):
+        if commit is not None:
+            rebuilt.add(path, commit[0], commit[1])
+    if args.write:
+        rebuilt.save()
+        print(f"Wrote {len(rebuilt.entries)} entries to {manifest_file}")
+        return 0
+    current = Manifest.load(manifest_file, settings.DEFAULT_BRANCH)
+    if current is None:
+        print(f"No release manifest ({manifest_file})", file=sys.stderr)
+        return 1
+    problems = []
+    if current.branch != rebuilt.branch:
+        problems.append(f"branch: {current.branch} != {rebuilt.branch}")
+    for path in sorted(set(current.entries) | set(rebuilt.entries)):
+        old = current.entries.get(path)
+        new = rebuilt.entries.get(path)
+        if old is None:
+            problems.append(f"{path}: missing")
+        elif new is None:
+            problems.append(f"{path}: not released on {args.branch}")
+        elif old != new:
+            problems.append(
+                f"{path}: {old['commit'][0:12]} ({old['released']}) != "
+                + f"{new['commit'][0:12]} ({new['released']})"
+            )
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    return int(bool(problems))
+
+
+#################################
+# Header catalogue
+#################################
+
+
+def tracked_files() -> dict:
+    """Index blob ids of the files tracked by Git
+
+    Raises:
+        GitError: Not a Git repository
+
+    Returns:
+        dict: Blob id for each path (relative to the repository
+            root)
+    """
+    try:
+        res = subprocess.run(
+            ["git", "ls-files", "-s", "-z"],
+            check=True,
+            capture_output=True,
+        )
+    except subprocess.CalledProcessError as e:
+        raise GitError(f"Problem communicating with Git: {e}")
+    blobs = {}
+    for entry in res.stdout.decode(errors="surrogateescape").split("\0"):
+        if entry:
+            info, path = entry.split("\t", 1)
+            blobs[path] = info.split(" ")[1]
+    return blobs
+
+
+def catalogue_entry(path: str, settings: Settings) -> dict:
+    """Extract the header of one file for the catalogue. Module
+    level, so it can be dispatched to process pools
+
+    Args:
+        path (str): File to read
+        settings (Settings): Settings in use
+
+    Returns:
+        dict: Catalogue columns (see `open_catalogue()`), minus
+            the change-detection columns
+    """
+    lang = classify(path, settings)
+    entry = {
+        "path": path,
+        "lang": lang.name,
+        "error": None,
+        "header": None,
+        "maintainers": None,
+        "last_updated": None,
+        "released": None,
+    }
+    try:
+        with open(path, "rb") as f:
+            source = ByteSource(f.read(), lang)
+        header, _ = load_meta(source.lines, check_fs=False, lang=lang)
+    except Exception as e:
+        entry["error"] = f"{type(e).__name__}: {e}"
+        return entry
+    # As in `check_release_date()`: the release date is the entry
+    # the change log rules drop as a "first release" entry
+    rules = settings.changelog_rules()
+    fields = {}
+    changelog = {}
+    for key, val, is_changelog in header:
+        if is_changelog:
+            changelog[key] = val
+            if rules.match(val) == (True, None):
+                entry["released"] = key
+        else:
+            fields[key] = val
+    if header.shebang is not None:
+        fields["shebang"] = header.shebang
+    fields["change log"] = changelog
+    entry["header"] = json.dumps(fields, sort_keys=True)
+    entry["maintainers"] = fields.get("maintainer(s)")
+    entry["last_updated"] = fields.get("last updated")
+    return entry
+
+
+def open_catalogue(db_path: str) -> Any:
+    """Open (creating if needed) a catalogue database. A
+    catalogue from a different schema version is rebuilt
+
+    Args:
+        db_path (str): SQLite database file
+
+    Returns:
+        sqlite3.Connection: Open connection
+    """
+    conn = sqlite3.connect(db_path)
+    if conn.execute("PRAGMA user_version").fetchone()[0] != CATALOGUE_SCHEMA:
+        conn.execute("DROP TABLE IF EXISTS files")
+    # One row per file. `header` holds every header field as JSON
+    # (change log entries under "change log"); the other columns
+    # are copies of commonly queried fields. `mtime_ns`, `size` and
+    # `blob` (Git index blob id) decide whether a file needs
+    # re-reading
+    columns = (
+        "path TEXT PRIMARY KEY, lang TEXT, mtime_ns INTEGER, size INTEGER, "
+        + "blob TEXT, error TEXT, header TEXT, maintainers TEXT, "
+        + "last_updated TEXT, released TEXT"
+    )
+    conn.execute(f"CREATE TABLE IF NOT EXISTS files ({columns})")
+    conn.execute(f"PRAGMA user_version = {CATALOGUE_SCHEMA}")
+    return conn
+
+
+def refresh_catalogue(
+    db_path: str,
+    paths: list = None,
+    jobs: int = None,
+    settings: Settings = None,
+) -> Tuple[int, int]:
+    """Bring a catalogue up to date. Only files whose mtime,
+    size or Git blob id changed since they were catalogued are
+    re-read, in parallel. Files that have gone are removed
+
+    Args:
+        db_path (str): SQLite database file
+        paths (list): Files/directories to catalogue. Default is
+            every supported file tracked by Git (or, outside a Git
+            repository, below the current directory)
+        jobs (int): Number of worker processes. Default is chosen
+            by `concurrent.futures`
+        settings (Settings): Settings in use. Default is the
+            built-in settings
+
+    Returns:
+        Tuple[int, int]: Number of files catalogued, and the
+            number (re-)read by this refresh
+    """
+    settings = BUILTIN_SETTINGS if settings is None else settings
+    try:
+        blobs = tracked_files()
+    except GitError:
+        blobs = {}
+    if paths:
+        files = list(iter_supported_files(paths, settings))
+    elif blobs:
+        files = [x for x in blobs if classify(x, settings) is not None]
+    else:
+        files = list(iter_supported_files(["."], settings))
+    files = [os.path.normpath(x) for x in files]
+    conn = open_catalogue(db_path)
+    known = {
+        row[0]: row[1::]
+        for row in conn.execute("SELECT path, mtime_ns, size, blob FROM files")
+    }
+    stale = {}
+    for path in files:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        key = (stat.st_mtime_ns, stat.st_size, blobs.get(path))
+        if known.get(path) != key:
+            stale[path] = key
+    read = functools.partial(catalogue_entry, settings=settings)
+    if len(stale) < CATALOGUE_BATCH:
+        entries = map(read, stale)
+        pool = None
+    else:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+        entries = pool.map(read, stale, chunksize=CATALOGUE_BATCH)
+    try:
+        with conn:
+            for entry in entries:
+                mtime_ns, size, blob = stale[entry["path"]]
+                entry.update(mtime_ns=mtime_ns, size=size, blob=blob)
+                conn.execute(
+                    "INSERT OR REPLACE INTO files VALUES (:path, :lang, "
+                    + ":mtime_ns, :size, :blob, :error, :header, "
+                    + ":maintainers, :last_updated, :released)",
+                    entry,
+                )
+            gone = set(known) - set(files) if not paths else set()
+            conn.executemany(
+                "DELETE FROM files WHERE path = ?", [(x,) for x in gone]
+            )
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    total = conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+    conn.close()
+    return total, len(stale)
+
+
+def export_catalogue(db_path: str, json_path: str) -> None:
+    """Write a catalogue out as JSON (a list of rows, with the
+    header fields decoded)"""
+    conn = open_catalogue(db_path)
+    conn.row_factory = sqlite3.Row
+    rows = []
+    for row in conn.execute("SELECT * FROM files ORDER BY path"):
+        row = dict(row)
+        row["header"] = json.loads(row["header"]) if row["header"] else None
+        rows.append(row)
+    conn.close()
+    with open(json_path, "w") as f:
+        json.dump(rows, f, indent=1)
+        f.write("\n")
+
+
+def catalogue_main(argv: list, settings: Settings = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="header_hook.py catalogue",
+        description="Extract every file's header into a SQLite "
+        + "catalogue, re-reading only files that changed",
+    )
+    parser.add_argument(
+        "paths",
+        nargs="*",
+        help="Files/directories to catalogue. Default is every "
+        + "supported file tracked by Git",
+    )
+    parser.add_argument("--db", default=CATALOGUE_FILE, help="SQLite file")
+    parser.add_argument(
+        "--json", default=None, metavar="PATH", help="Also write as JSON"
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=None, help="Number of worker processes"
+    )
+    args = parser.parse_args(argv)
+    start = time.perf_counter()
+    total, refreshed = refresh_catalogue(
+        args.db, args.paths, args.jobs, settings
+    )
+    if args.json is not None:
+        export_catalogue(args.db, args.json)
+    print(
+        f"Catalogued {total} files ({refreshed} re-read) in "
+        + f"{time.perf_counter() - start:.2f}s",
+        file=sys.stderr,
+    )
+    return 0
+
+
+#################################
+# Completion journal
+#################################
+
+
+def journal_key(ctx: RunContext) -> str:
+    """Digest of everything (besides a file's contents) that
+    decides a file's output. Journal entries written under a
+    different key are ignored"""
+    options = (
+        __version__,
+        ctx.settings.snapshot,
+        ctx.branch,
+        ctx.fingerprint,
+        ctx.offline,
+        ctx.check_fs,
+    )
+    text = json.dumps(options, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()[0:16]
+
+
+class Journal:
+    """Append-only record of the files a run has completed, so an
+    interrupted run can be resumed (possibly in a later CI job)
+    without redoing them. One JSON line per completed file, with
+    digests of its contents before and after processing. Lines
+    are flushed as files complete, so little is lost to an
+    interruption
+
+    Args:
+        path (str): Journal file (created if needed)
+        key (str): Run configuration (see `journal_key()`)
+    """
+
+    def __init__(self, path: str, key: str):
+        self.path = path
+        self.key = key
+        # Path -> digest of the contents it was left with
+        self.done = {}
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Torn final line from an interrupted run
+                        continue
+                    if entry.get("key") == key:
+                        self.done[entry["path"]] = entry["out"]
+        except FileNotFoundError:
+            pass
+        self.file = open(path, "a")
+
+    def pending(self, files: list) -> list:
+        """Files still to do: those not journaled, or whose
+        contents changed since they were
+
+        Args:
+            files (list): Files the run was asked to process
+
+        Returns:
+            list: Files to process, in their original order
+        """
+        todo = []
+        for path in files:
+            digest = self.done.get(path)
+            if digest is not None:
+                try:
+                    with open(path, "rb") as f:
+                        if content_digest([f.read()]) == digest:
+                            continue
+                except OSError:
+                    pass
+            todo.append(path)
+        return todo
+
+    def record(self, report: FileReport, check: bool = False) -> None:
+        """Journal a file, if it was completed (files with errors,
+        or degraded by time budgets, are left to be redone)"""
+        if report.error is not None or report.degraded:
+            return
+        if report.digest_out is None:
+            return
+        entry = {
+            "path": report.path,
+            "key": self.key,
+            "in": report.digest_in,
+            "out": report.digest_out,
+            "outcome": report.outcome(check),
+        }
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        self.done[report.path] = report.digest_out
+
+    def close(self) -> None:
+        self.file.close()
+
+
+#################################
+# Background audit
+#################################
+
+
+def audit_path() -> str:
+    """Where the audit queue is kept: inside the Git directory
+    (it's local to a clone), or the current directory outside Git"""
+    try:
+        return ask_git(f"git rev-parse --git-path {AUDIT_FILE}")
+    except GitError:
+        return AUDIT_FILE
+
+
+class AuditQueue:
+    """Persisted record of when each file was last verified, used
+    as a priority queue: each run checks a few extra files, least
+    recently verified (or never verified) first, so the whole
+    repository is kept fresh at a small, bounded cost per run
+
+    Args:
+        path (str): Queue file (created on save, if needed)
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.verified = json.load(f)
+        except (OSError, ValueError):
+            self.verified = {}
+
+    def select(self, candidates: list, exclude: list, n: int = None):
+        """Files to audit next
+
+        Args:
+            candidates (list): Files eligible for auditing
+            exclude (list): Files already being processed
+            n (int): Number of files. Default is all of them (in
+                priority order)
+
+        Returns:
+            list: Files, least recently verified first
+        """
+        exclude = set(exclude)
+        candidates_by_age = (
+            (self.verified.get(x, 0.0), x)
+            for x in candidates
+            if x not in exclude
+        )
+        if n is None:
+            return [x for _, x in sorted(candidates_by_age)]
+        return [x for _, x in heapq.nsmallest(n, candidates_by_age)]
+
+    def mark(self, path: str, when: float) -> None:
+        self.verified[path] = when
+
+    def save(self, keep: list = None) -> None:
+        """Write the queue
+
+        Args:
+            keep (list): If given, entries for other files (e.g.,
+                deleted files) are dropped
+        """
+        if keep is not None:
+            keep = set(keep)
+            self.verified = {
+                x: y for x, y in self.verified.items() if x in keep
+            }
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.verified, f, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+def audit_files(files: list, ctx: RunContext, deadline: Deadline):
+    """Process audit files one at a time until a time budget
+    runs out
+
+    Args:
+        files (list): Files, in priority order
+        ctx (RunContext): Run options, clock and caches
+        deadline (Deadline): When to stop starting new files
+
+    Yields:
+        FileReport: Report for each file processed
+    """
+    for path in files:
+        if deadline.expired():
+            return
+        yield process_file(path, ctx)
+
+
+#################################
+# Multi-repository mode
+#################################
+
+
+def discover_repos(dirs: list) -> Tuple[list, list]:
+    """Find Git checkouts. Each directory given is either a
+    checkout itself, or holds checkouts (one level down)
+
+    Args:
+        dirs (list): Directories to search
+
+    Returns:
+        Tuple[list, list]: Checkouts, in the order given (then by
+            name), and a (directory, error) pair for each directory
+            that couldn't be searched
+    """
+    repos = []
+    errors = []
+    for path in dirs:
+        if os.path.exists(os.path.join(path, ".git")):
+            repos.append(os.path.normpath(path))
+            continue
+        try:
+            with os.scandir(path) as entries:
+                children = sorted(x.path for x in entries if x.is_dir())
+        except OSError as e:
+            errors.append((os.path.normpath(path), e))
+            continue
+        repos.extend(
+            os.path.normpath(x)
+            for x in children
+            if os.path.exists(os.path.join(x, ".git"))
+        )
+    return repos, errors
+
+
+class RepoPlan:
+    """Files of one repository, queued for a shared worker pool
+    (see `run_repos()`)
+
+    Args:
+        label (str): Repository, as reported (paths in its reports
+            are prefixed with this)
+        root (str): Absolute path of the repository
+        ctx (RunContext): Run context for the repository (with the
+            repository's settings)
+        files (list): Files to process, relative to the repository
+            root
+    """
+
+    def __init__(self, label: str, root: str, ctx: RunContext, files: list):
+        self.label = label
+        self.root = root
+        self.ctx = ctx
+        # Context sent to workers (see `publish_history()`)
+        self.shared = ctx
+        self.files = files
+        self.chunks = collections.deque(
+            files[i : i + REPO_CHUNK_FILES]
+            for i in range(0, len(files), REPO_CHUNK_FILES)
+        )
+
+
+def plan_repo(label: str, ctx: RunContext, index_path: str) -> RepoPlan:
+    """Load the settings and tracked files of a repository, and
+    index the Git facts its files need. Run from the repository
+    root
+
+    Args:
+        label (str): Repository
+        ctx (RunContext): Run options (copied for the repository)
+        index_path (str): File for the repository's history index
+
+    Returns:
+        RepoPlan: The repository's queue of files
+    """
+    settings = configure()
+    repo_ctx = copy.copy(ctx)
+    # Unless the run was given a release branch, each repository
+    # uses the one from its own settings (see `RunContext.branch`)
+    repo_ctx.settings = settings
+    repo_ctx.git_cache = {}
+    repo_ctx.manifest = None
+    files = [
+        x
+        for x in tracked_files()
+        if classify(x, settings) and os.path.isfile(x)
+    ]
+    plan = RepoPlan(label, os.getcwd(), repo_ctx, files)
+    if not ctx.offline:
+        use_manifest(repo_ctx)
+    plan.shared = publish_history(files, repo_ctx, index_path)
+    return plan
+
+
+def repo_worker(root: str, files: list, ctx: RunContext):
+    """Process a chunk of one repository's files on a shared
+    worker (module-level, so it can be dispatched to process
+    pools)
+
+    Returns:
+        list: `FileReport` for each file
+    """
+    os.chdir(root)
+    return [process_file(x, ctx) for x in files]
+
+
+def run_repos(dirs: list, ctx: RunContext, jobs: int = None):
+    """Process every supported tracked file of many repositories
+    on one process pool. Repositories take turns to submit chunks
+    of files (`REPO_CHUNK_FILES`), so large repositories don't
+    hold up small ones, and the pool stays busy until the last
+    repository is done
+
+    Note:
+        Workers change directory to each file's repository, so
+        only processes (not threads) can be shared this way. Each
+        repository uses its own configuration, manifest and Git
+        history index
+
+    Args:
+        dirs (list): Repositories, or directories holding them
+            (see `discover_repos()`)
+        ctx (RunContext): Run options, clock and caches
+        jobs (int): Number of worker processes. Default is the
+            number of CPUs
+
+    Yields:
+        FileReport: Report for each file (paths prefixed with
+            their repository), in order of completion. Repositories
+            (and directories searched for them) that can't be read
+            get a single report with an error
+    """
+    home = os.getcwd()
+    plans = []
+    repos, errors = discover_repos(dirs)
+    for path, e in errors:
+        report = FileReport(path)
+        report.error = f"{type(e).__name__}: {e}"
+        yield report
+    index_dir = tempfile.TemporaryDirectory()
+    try:
+        for i, label in enumerate(repos):
+            index_path = os.path.join(index_dir.name, f"{i}.idx")
+            report = FileReport(label)
+            try:
+                os.chdir(label)
+                plans.append(plan_repo(label, ctx, index_path))
+            except (GitError, ConfigError, OSError) as e:
+                report.error = f"{type(e).__name__}: {e}"
+            finally:
+                os.chdir(home)
+            if report.error is not None:
+                yield report
+        workers = jobs or os.cpu_count() or 1
+        rotation = collections.deque(x for x in plans if x.chunks)
+        futures = {}
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            while rotation or futures:
+                # Keep every worker busy, with one chunk queued behind
+                while rotation and len(futures) < 2 * workers:
+                    plan = rotation.popleft()
+                    args = (plan.root, plan.chunks.popleft(), plan.shared)
+                    future = pool.submit(repo_worker, *args)
+                    futures[future] = plan
+                    if plan.chunks:
+                        rotation.append(plan)
+                done, _ = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    plan = futures.pop(future)
+                    for report in future.result():
+                        report.path = os.path.join(plan.label, report.path)
+                        yield report
+        for plan in plans:
+            os.chdir(plan.root)
+            update_manifest(plan.files, plan.ctx)
+    finally:
+        for plan in plans:
+            if plan.shared is not plan.ctx:
+                plan.shared.git_cache.history.close()
+        index_dir.cleanup()
+        os.chdir(home)
+
+
+#################################
+# Staged (index) mode
+#################################
+
+
+class CatFileBatch:
+    """Long-lived `git cat-file --batch` process, so any number
+    of blobs can be read with a single Git process
+
+    Note:
+        Use as a context manager, so the process is always
+        shut down
+    """
+
+    def __init__(self):
+        self._proc = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def __enter__(self) -> "CatFileBatch":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def read(self, spec: str) -> Any:
+        """Read an object
+
+        Args:
+            spec (str): Object name. For example, ":path/to/file"
+                for the staged version of a file
+
+        Returns:
+            bytes: Object contents, or `None` if the object
+                does not exist
+        """
+        self._proc.stdin.write(spec.encode() + b"\n")
+        self._proc.stdin.flush()
+        info = self._proc.stdout.readline().split()
+        if len(info) != 3:
+            # "<spec> missing" (or "ambiguous")
+            return None
+        size = int(info[2])
+        data = self._proc.stdout.read(size)
+        # Contents are followed by a newline
+        self._proc.stdout.read(1)
+        return data
+
+    def close(self) -> None:
+        if self._proc.poll() is None:
+            self._proc.stdin.close()
+            self._proc.wait()
+
+
+def index_entries(files: list) -> dict:
+    """Look up the staged mode of files (single Git call)
+
+    Args:
+        files (list): Paths, relative to the current directory
+
+    Returns:
+        dict: Path -> mode, for files present in the index
+    """
+    if not files:
+        return {}
+    res = subprocess.run(
+        ["git", "ls-files", "--stage", "-z", "--"] + files,
+        check=True,
+        capture_output=True,
+    )
+    entries = {}
+    for record in res.stdout.decode().split("\0"):
+        if not record:
+            continue
+        info, path = record.split("\t", 1)
+        entries[path] = info.split(" ")[0]
+    return entries
+
+
+def write_index(updates: list) -> None:
+    """Store new blobs and stage them: one `git hash-object`
+    call for all the blobs, then one `git update-index` call
+
+    Args:
+        updates (list): (path, mode, contents) tuples, with the
+            path relative to the current directory and the
+            contents as bytes
+    """
+    # `--index-info` paths are relative to the repository root
+    prefix = ask_git("git rev-parse --show-prefix")
+    with tempfile.TemporaryDirectory() as tmp:
+        blob_paths = []
+        for i, (_, _, contents) in enumerate(updates):
+            blob_path = os.path.join(tmp, str(i))
+            with open(blob_path, "wb") as f:
+                f.write(contents)
+            blob_paths.append(blob_path)
+        # Contents are already in repository form, so Git's
+        # filters (e.g., line ending conversion) are bypassed
+        res = subprocess.run(
+            ["git", "hash-object", "-w", "--no-filters", "--stdin-paths"],
+            input="\n".join(blob_paths) + "\n",
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+    shas = res.stdout.split()
+    index_info = ""
+    for (path, mode, _), sha in zip(updates, shas):
+        path = os.path.normpath(os.path.join(prefix, path))
+        index_info += f"{mode} {sha} 0\t{path}\n"
+    subprocess.run(
+        ["git", "update-index", "--index-info"],
+        input=index_info,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+
+
+def mirror_header(
+    file_path: str, new_header: list, ctx: RunContext, lang: Language
+) -> None:
+    """Replace the header of the working tree copy of a file,
+    leaving the rest (including any unstaged changes) alone
+
+    Args:
+        file_path (str): File in the working tree
+        new_header (list): New header lines
+        ctx (RunContext): Run options
+        lang (Language): Language of the file
+    """
+    with open(file_path, "rb") as f:
+        source = ByteSource(f.read(), lang)
+    _, the_rest = load_meta(source.lines, check_fs=ctx.check_fs, lang=lang)
+    if "".join(new_header + the_rest) != "".join(source.lines):
+        with open(file_path, "wb") as f:
+            f.writelines(source.rebuild(new_header, the_rest))
+
+
+def staged_files() -> list:
+    """Added/modified files in the index, relative to the
+    current directory"""
+    out = ask_git("git diff --cached --name-only --diff-filter=AM")
+    # Listed relative to the repository root
+    cdup = ask_git("git rev-parse --show-cdup")
+    return [
+        os.path.relpath(os.path.join(cdup, x)) for x in out.split("\n") if x
+    ]
+
+
+def run_staged(files: list, ctx: RunContext) -> list:
+    """Normalise the staged (index) versions of files. Blobs are
+    read through a single `git cat-file --batch` process and
+    normalised in memory. New blobs are written and staged in one
+    batch, and each header change is mirrored into the working
+    tree. Partly-staged files are therefore committed with a
+    normalised header, without pre-commit having to stash and
+    retry
+
+    Args:
+        files (list): Paths, relative to the current directory.
+            Unsupported and unstaged files are skipped
+        ctx (RunContext): Run options, clock and caches. In
+            check mode, neither the index nor the working tree
+            is modified
+
+    Returns:
+        list: `FileReport` for each file processed
+    """
+    files = [x for x in files if classify(x, ctx.settings) is not None]
+    if not ctx.offline:
+        use_manifest(ctx)
+    prefetch_git_facts(files, ctx)
+    modes = index_entries(files)
+    reports = []
+    updates = []
+    headers = {}
+    with CatFileBatch() as cat:
+        for path in files:
+            if path not in modes:
+                continue
+            report = FileReport(path, ctx.memory)
+            reports.append(report)
+            lang = classify(path, ctx.settings)
+            try:
+                with report.stage("read"):
+                    # ":./" resolves from the current directory
+                    # (":" alone, from the repository root)
+                    data = cat.read(f":./{path}")
+                    if data is None:
+                        raise GitError(f"No staged version of {path}")
+                    source = ByteSource(data, lang)
+                report.size = len(source.data)
+                new_header, the_rest = normalise(
+                    source.lines, ctx, lang, report
+                )
+            except Exception as e:
+                report.error = f"{type(e).__name__}: {e}"
+                continue
+            if report.changed:
+                new_contents = b"".join(source.rebuild(new_header, the_rest))
+                updates.append((path, modes[path], new_contents))
+                headers[path] = new_header
+    if updates and not ctx.check:
+        try:
+            write_index(updates)
+        except (GitError, subprocess.CalledProcessError, OSError) as e:
+            for report in reports:
+                if report.path in headers:
+                    report.error = f"Index not updated: {e}"
+            headers = {}
+        for report in reports:
+            if report.path not in headers:
+                continue
+            try:
+                with report.stage("write"):
+                    mirror_header(
+                        report.path,
+                        headers[report.path],
+                        ctx,
+                        classify(report.path, ctx.settings),
+                    )
+            except Exception as e:
+                report.error = f"Working tree not updated: {e}"
+    update_manifest(files, ctx)
+    return reports
+
+
+#################################
+# Configuration
+#################################
+
+
+def find_config(start: str = ".") -> Any:
+    """Find the nearest `pyproject.toml`, searching upwards
+
+    Args:
+        start (str): Directory to start from. Default is the
+            current directory
+
+    Returns:
+        str: Path to the file, or `None` if there isn't one
+    """
+    path = os.path.abspath(start)
+    while True:
+        candidate = os.path.join(path, "pyproject.toml")
+        if os.path.isfile(candidate):
+            return candidate
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def read_config(raw: bytes) -> dict:
+    """Extract the `[tool.header-hook]` table from the contents
+    of a `pyproject.toml` file
+
+    Args:
+        raw (bytes): File contents
+
+    Raises:
+        ConfigError: If the table is present but can't be parsed
+            (including when no TOML parser is available)
+
+    Returns:
+        dict: The table (empty if not present)
+    """
+    if f"tool.{CONFIG_TABLE}".encode() not in raw:
+        return {}
+    if tomllib is None:
+        raise ConfigError("Reading pyproject.toml needs Python 3.11+ or tomli")
+    try:
+        data = tomllib.loads(raw.decode())
+    except (UnicodeDecodeError, tomllib.TOMLDecodeError) as e:
+        raise ConfigError(f"Unable to parse pyproject.toml: {e}")
+    return data.get("tool", {}).get(CONFIG_TABLE, {})
+
+
+def build_settings(table: dict) -> dict:
+    """Validate a `[tool.header-hook]` table, and merge it with
+    the built-in settings
+
+    Args:
+        table (dict): Configuration table (see `CONFIG_KEYS`)
+
+    Raises:
+        ConfigError: If a key is unknown, or a value is invalid
+
+    Returns:
+        dict: Complete settings snapshot (JSON-serialisable),
+            keyed by setting name, including derived settings
+    """
+    settings = copy.deepcopy(DEFAULT_SETTINGS)
+    for key, value in table.items():
+        if key not in CONFIG_KEYS:
+            raise ConfigError(f"Unknown [tool.{CONFIG_TABLE}] key `{key}`")
+        name, kind = CONFIG_KEYS[key]
+        if not isinstance(value, kind) or isinstance(value, bool):
+            raise ConfigError(f"`{key}` must be a {kind.__name__}")
+        if kind is int and value < 0:
+            raise ConfigError(f"`{key}` can't be negative")
+        if kind is list and key != "changelog-rules":
+            if not all(isinstance(x, str) for x in value):
+                raise ConfigError(f"`{key}` must be a list of strings")
+        if key == "changelog-rules":
+            # Array of tables: {glob = "...", replace = "..."}. Rules
+            # without a replacement drop matching entries
+            try:
+                value = [[x["glob"], x.get("replace")] for x in value]
+            except (TypeError, KeyError):
+                raise ConfigError("`changelog-rules` entries need a `glob`")
+        if key == "languages":
+            value = merge_languages(settings["LANGUAGES"], value)
+        settings[name] = value
+    if "valid-lang" in table:
+        python = table.get("languages", {}).get("python", {})
+        if "shebangs" not in python:
+            settings["LANGUAGES"]["python"]["shebangs"] = settings[
+                "VALID_LANG"
+            ]
+    settings["ALLOWED_KEYS"] = [x.lower() for x in settings["ALLOWED_KEYS"]]
+    missing = [x for x in REQUIRED_KEYS if x not in settings["ALLOWED_KEYS"]]
+    if missing:
+        raise ConfigError(f"`allowed-keys` must include {missing}")
+    if settings["SEP"] == "":
+        raise ConfigError("`sep` can't be empty")
+    # Each language draws its dividers with its own comment marker, so
+    # only the width of `sep` is used
+    if set(settings["SEP"]) != {"#"}:
+        raise ConfigError("`sep` can only be made of `#` (it sets the width)")
+    unknown = set(settings["HEADER_STAGES"]) - set(
+        DEFAULT_SETTINGS["HEADER_STAGES"]
+    )
+    if unknown:
+        raise ConfigError(f"Unknown stages {sorted(unknown)}")
+    # Derived settings
+    settings["WRAP_LIMIT"] = len(settings["SEP"])
+    settings["FIRST_KEYVAL_INDENT_N"] = (
+        max([len(x) for x in settings["ALLOWED_KEYS"]]) + 1
+    )
+    settings["DATE_INDENT"] = " " * settings["DATE_INDENT_N"]
+    settings["SECOND_KEYVAL_INDENT_N"] = (
+        settings["FIRST_KEYVAL_INDENT_N"] - settings["DATE_INDENT_N"]
+    )
+    if settings["SECOND_KEYVAL_INDENT_N"] < 1:
+        raise ConfigError("`date-indent` is wider than the longest key")
+    return settings
+
+
+def merge_languages(languages: dict, overrides: dict) -> dict:
+    """Merge `languages` overrides into the `LANGUAGES` setting.
+    New languages may be added; fields not given are left as
+    they are (or empty, for new languages)
+
+    Args:
+        languages (dict): Current `LANGUAGES` setting
+        overrides (dict): Overrides, keyed by language name
+
+    Raises:
+        ConfigError: If a language entry is invalid
+
+    Returns:
+        dict: Merged `LANGUAGES` setting
+    """
+    merged = copy.deepcopy(languages)
+    blank = {"comment": "#", "shebangs": [], "extensions": [], "filenames": []}
+    for name, spec in overrides.items():
+        if not isinstance(spec, dict) or not set(spec) <= set(blank):
+            raise ConfigError(f"`languages.{name}` may only set {list(blank)}")
+        entry = merged.setdefault(name, copy.deepcopy(blank))
+        entry.update(spec)
+        if not isinstance(entry["comment"], str) or entry["comment"] == "":
+            raise ConfigError(f"`languages.{name}.comment` can't be empty")
+    return merged
+
+
+def cache_dir() -> str:
+    """Directory for header-hook's caches"""
+    return os.environ.get("HEADER_HOOK_CACHE_DIR", CACHE_DIR)
+
+
+def load_settings(config_path: str) -> dict:
+    """Load the settings snapshot for a `pyproject.toml` file.
+    Snapshots are cached on disk, keyed by the config file's
+    path, mtime and hash (and the header-hook version), so the
+    TOML is only parsed and validated when the file changes
+
+    Args:
+        config_path (str): Path to `pyproject.toml`
+
+    Raises:
+        ConfigError: If the configuration is invalid
+
+    Returns:
+        dict: Settings snapshot (see `build_settings()`)
+    """
+    config_path = os.path.abspath(config_path)
+    mtime_ns = os.stat(config_path).st_mtime_ns
+    key = hashlib.sha256(config_path.encode()).hexdigest()[0:16]
+    cache_file = os.path.join(cache_dir(), f"config-{key}.json")
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cached["version"] != __version__:
+            cached = None
+    except (OSError, ValueError, KeyError):
+        cached = None
+    # Unchanged since last time. The file needn't even be read
+    if cached is not None and cached["mtime_ns"] == mtime_ns:
+        return cached["settings"]
+    with open(config_path, "rb") as f:
+        raw = f.read()
+    digest = hashlib.sha256(raw).hexdigest()
+    if cached is not None and cached["sha256"] == digest:
+        # Touched, but not changed
+        settings = cached["settings"]
+    else:
+        settings = build_settings(read_config(raw))
+    entry = {
+        "version": __version__,
+        "mtime_ns": mtime_ns,
+        "sha256": digest,
+        "settings": settings,
+    }
+    try:
+        os.makedirs(cache_dir(), exist_ok=True)
+        # Written then renamed, so concurrent runs never see
+        # half a file
+        with tempfile.NamedTemporaryFile(
+            "w", dir=cache_dir(), delete=False, suffix=".tmp"
+        ) as f:
+            json.dump(entry, f)
+        os.replace(f.name, cache_file)
+    except OSError:
+        # Caching is best-effort (e.g., read-only home directory)
+        pass
+    return settings
+
+
+def configure(config_path: str = None) -> Settings:
+    """Load the configuration in `pyproject.toml`. Nothing global
+    is changed: the settings are used by passing them to a run
+    (see `RunContext`)
+
+    Args:
+        config_path (str): Path to the config file. Default is
+            the nearest `pyproject.toml` (if any)
+
+    Raises:
+        ConfigError: If the configuration is invalid
+
+    Returns:
+        Settings: The settings (the built-in settings, if there
+            is no config file)
+    """
+    if config_path is None:
+        config_path = find_config()
+        if config_path is None:
+            return BUILTIN_SETTINGS
+    return settings_from_json(json.dumps(load_settings(config_path)))
+
+
+#################################
+# Stdin filter mode
+#################################
+def run_stdin(file_path: str, ctx: RunContext, stdin=None, stdout=None):
+    """Normalise content piped in on stdin, writing the result
+    to stdout (editor format-on-save). Nothing is read from or
+    written to disk
+
+    Note:
+        Content is always written out, so editors can replace the
+        buffer wholesale. Unsupported file types, canonical headers
+        and content that fails to process are echoed back as-is,
+        without re-encoding. In check mode, nothing is written
+
+    Args:
+        file_path (str): Path the content belongs to. Used to
+            choose the language, and to label the report
+        ctx (RunContext): Run options, clock and caches
+        stdin: Binary stream to read. Default is `sys.stdin`
+        stdout: Binary stream to write. Default is `sys.stdout`
+
+    Returns:
+        FileReport: Outcome of processing the content
+    """
+    stdin = sys.stdin.buffer if stdin is None else stdin
+    stdout = sys.stdout.buffer if stdout is None else stdout
+    report = FileReport(file_path, ctx.memory)
+    with report.stage("read"):
+        data = stdin.read()
+    report.size = len(data)
+    output = [data]
+    lang = classify(file_path, ctx.settings)
+    if lang is not None:
+        try:
+            if not ctx.offline:
+                use_manifest(ctx)
+            source = ByteSource(data, lang)
+            new_header, the_rest = normalise(source.lines, ctx, lang, report)
+            if report.changed:
+                output = source.rebuild(new_header, the_rest)
+        except Exception as e:
+            report.error = f"{type(e).__name__}: {e}"
+    if not ctx.check:
+        with report.stage("write"):
+            stdout.writelines(output)
+            stdout.flush()
+    return report
+
+
+#################################
+# flake8 plugin
+#################################
+
+
+class Flake8Checker:
+    """flake8 plugin (registered under the "HDR" prefix, as a
+    `[flake8:local-plugins]` extension, see the README). Headers
+    are checked using the lines flake8 has already read, so linting
+    headers adds no file I/O to an existing flake8 run. Nothing is
+    ever written
+
+    Note:
+        Git-derived checks (release date, change log merging) are
+        off by default, and enabled with `--header-hook-git` (or
+        `header-hook-git = true` in the flake8 configuration)
+
+    Args:
+        tree: Parsed module (unused, but flake8 only runs plugins
+            that take it or a line)
+        filename (str): File being checked ("-" for stdin)
+        lines (list): Lines of the file
+    """
+
+    name = "header-hook"
+    version = __version__
+    # Shared by every file checked in a (flake8 worker) process
+    git = False
+    ctx = None
+
+    def __init__(self, tree: Any, filename: str, lines: list):
+        self.filename = filename
+        self.lines = lines
+
+    @classmethod
+    def add_options(cls, manager: Any) -> None:
+        manager.add_option(
+            "--header-hook-git",
+            action="store_true",
+            parse_from_config=True,
+            help="Also check header fields derived from Git history "
+            + "(header-hook)",
+        )
+
+    @classmethod
+    def parse_options(cls, options: Any) -> None:
+        cls.git = options.header_hook_git
+        cls.ctx = None
+
+    @classmethod
+    def context(cls) -> RunContext:
+        """Run context shared by every file checked (settings are
+        loaded with the first file)"""
+        if cls.ctx is None:
+            cls.ctx = RunContext(
+                check=True, offline=not cls.git, settings=configure()
+            )
+        return cls.ctx
+
+    def run(self):
+        """Check the header
+
+        Yields:
+            tuple: (line, column, message, checker type) for each
+                problem found
+        """
+        ctx = self.context()
+        lang = classify(self.filename, ctx.settings)
+        if lang is None:
+            lang = ctx.settings.lang_by_name["python"]
+        first = next(
+            (i for i, x in enumerate(self.lines) if not is_blank(x)), None
+        )
+        if first is None:
+            yield 1, 0, FLAKE8_CODES["missing"], type(self)
+            return
+        report = FileReport(self.filename)
+        try:
+            try:
+                normalise(self.lines, ctx, lang, report)
+            except GitError as e:
+                # Git itself is unusable here (e.g., not a repository):
+                # the Git-derived checks are skipped, the rest still run
+                message = FLAKE8_CODES["degraded"].format(e)
+                yield first + 1, 0, message, type(self)
+                offline = copy.copy(ctx)
+                offline.offline = True
+                report = FileReport(self.filename)
+                normalise(self.lines, offline, lang, report)
+        except MissingHeaderBlockError:
+            yield first + 1, 0, FLAKE8_CODES["missing"], type(self)
+            return
+        except Exception as e:
+            # Reported like the hook reports a file it can't process
+            error = f"{type(e).__name__}: {e}"
+            message = FLAKE8_CODES["invalid"].format(error)
+            yield first + 1, 0, message, type(self)
+            return
+        if report.changed:
+            keys = ", ".join(report.changed_keys) or "layout"
+            message = FLAKE8_CODES["changed"].format(keys)
+            yield first + 1, 0, message, type(self)
+        if report.degraded:
+            message = FLAKE8_CODES["degraded"].format(
+                ", ".join(report.degraded)
+            )
+            yield first + 1, 0, message, type(self)
+
+
+#################################
+# Watch mode
+#################################
+
+
+def iter_supported_files(paths: list, settings: Settings = None):
+    """Expand a list of files/directories into the supported
+    files they contain
+
+    Args:
+        paths (list): Files and/or directories. Directories
+            are searched recursively (skipping `SKIP_DIRS`)
+        settings (Settings): Settings in use. Default is the
+            built-in settings
+
+    Yields:
+        str: Path of each supported file
+    """
+    for path in paths:
+        if os.path.isfile(path):
+            if classify(path, settings) is not None:
+                yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [x for x in dirs if x not in SKIP_DIRS]
+            for name in files:
+                if classify(name, settings) is not None:
+                    yield os.path.join(root, name)
+
+
+class PollingWatcher:
+    """Detects changed files by comparing mtimes/sizes
+    between scans. Works everywhere, including containers
+    and network filesystems where inotify is unavailable
+
+    Args:
+        paths (list): Files and/or directories to watch
+        settings (Settings): Settings in use (which files are
+            supported). Default is the built-in settings
+    """
+
+    def __init__(self, paths: list, settings: Settings = None):
+        self.paths = paths
+        self.settings = settings
+        self._stats = self._scan()
+
+    def _scan(self) -> dict:
+        stats = {}
+        for path in iter_supported_files(self.paths, self.settings):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            stats[path] = (st.st_mtime_ns, st.st_size)
+        return stats
+
+    def wait(self, timeout: float = None) -> set:
+        """Wait for changes
+
+        Args:
+            timeout (float): Max seconds to wait. Waits
+                indefinitely if `None`
+
+        Returns:
+            set: Paths of files that changed (empty if the
+                timeout expired first)
+        """
+        start = time.monotonic()
+        while True:
+            if timeout is None:
+                time.sleep(WATCH_POLL_S)
+            else:
+                time.sleep(min(WATCH_POLL_S, timeout))
+            stats = self._scan()
+            changed = {
+                path
+                for path, stat in stats.items()
+                if self._stats.get(path) != stat
+            }
+            self._stats = stats
+            if changed:
+                return changed
+            if timeout is not None and time.monotonic() - start >= timeout:
+                return set()
+
+
+class InotifyWatcher:
+    """Detects changed files using Linux inotify (through
+    libc, so no 3rd party packages are needed)
+
+    Args:
+        paths (list): Files and/or directories to watch
+        settings (Settings): Settings in use (which files are
+            supported). Default is the built-in settings
+
+    Raises:
+        OSError: inotify is not available
+    """
+
+    # Event flags, see inotify(7)
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_ISDIR = 0x40000000
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, paths: list, settings: Settings = None):
+        self.settings = settings
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("libc not found")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError("inotify not supported on this platform")
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs = {}
+        # Individually-named files are watched via their parent
+        # directory, and other files in that directory ignored
+        self._files = set()
+        self._roots = []
+        for path in paths:
+            if os.path.isfile(path):
+                self._files.add(os.path.normpath(path))
+                self._add_dir(os.path.dirname(path) or ".")
+            else:
+                self._roots.append(os.path.normpath(path))
+                self._add_tree(path)
+
+    def _add_dir(self, directory: str) -> None:
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(directory), mask
+        )
+        if wd >= 0:
+            self._dirs[wd] = directory
+
+    def _add_tree(self, directory: str) -> None:
+        for root, dirs, _ in os.walk(directory):
+            dirs[:] = [x for x in dirs if x not in SKIP_DIRS]
+            self._add_dir(root)
+
+    def _wanted(self, path: str) -> bool:
+        path = os.path.normpath(path)
+        if path in self._files:
+            return True
+        if classify(path, self.settings) is None:
+            return False
+        return any(
+            path.startswith(root + os.sep) or root == "."
+            for root in self._roots
+        )
+
+    def wait(self, timeout: float = None) -> set:
+        """Wait for changes
+
+        Args:
+            timeout (float): Max seconds to wait. Waits
+                indefinitely if `None`
+
+        Returns:
+            set: Paths of files that changed (empty if the
+                timeout expired first)
+        """
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return set()
+        data = os.read(self._fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_len = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = data[offset : offset + name_len].rstrip(b"\0")
+            offset += name_len
+            if wd not in self._dirs:
+                continue
+            path = os.path.join(self._dirs[wd], os.fsdecode(name))
+            if mask & self.IN_ISDIR:
+                # New directory: watch it, and pick up any files
+                # written before the watch was in place
+                if any(path.startswith(root) for root in self._roots):
+                    self._add_tree(path)
+                    changed.update(iter_supported_files([path]))
+            elif self._wanted(path):
+                changed.add(path)
+        return changed
+
+
+def make_watcher(
+    paths: list, polling: bool = False, settings: Settings = None
+) -> Any:
+    """Create the best available file watcher
+
+    Args:
+        paths (list): Files and/or directories to watch
+        polling (bool): If `True`, always use mtime polling.
+            Default is `False`
+        settings (Settings): Settings in use. Default is the
+            built-in settings
+
+    Returns:
+        InotifyWatcher | PollingWatcher: File watcher
+    """
+    if not polling:
+        try:
+            return InotifyWatcher(paths, settings)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(paths, settings)
+
+
+def file_digest(file_path: str) -> str:
+    with open(file_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def watch(
+    paths: list,
+    check_fs: bool = True,
+    fingerprint: bool = False,
+    polling: bool = False,
+    settings: Settings = None,
+) -> None:
+    """Re-format files as they are saved, until interrupted.
+    Bursts of saves are debounced, and only files whose
+    content actually changed are re-processed. Git answers
+    are kept between events (until HEAD moves), as is the
+    word wrap cache
+
+    Args:
+        paths (list): Files and/or directories to watch
+        check_fs (bool): If `False`, shebangs are validated
+            without filesystem access. Default is `True`
+        fingerprint (bool): If `True`, fingerprints are added
+            to headers. Default is `False`
+        polling (bool): If `True`, mtime polling is used even
+            where inotify is available. Default is `False`
+        settings (Settings): Settings in use. Default is the
+            built-in settings
+    """
+    ctx = RunContext(
+        check_fs=check_fs, fingerprint=fingerprint, settings=settings
+    )
+    watcher = make_watcher(paths, polling, ctx.settings)
+    # Content last seen for each file (including content written
+    # by the hook itself, so our own writes don't trigger a loop)
+    seen = {}
+    for path in iter_supported_files(paths, ctx.settings):
+        seen[path] = file_digest(path)
+    git_head = None
+    while True:
+        pending = watcher.wait()
+        # Debounce: keep collecting until things go quiet
+        while True:
+            more = watcher.wait(WATCH_DEBOUNCE_S)
+            if not more:
+                break
+            pending |= more
+        # Git answers are only valid while HEAD stays put (and
+        # the date moves on if left running overnight)
+        try:
+            head = ask_git("git rev-parse HEAD")
+        except GitError:
+            head = None
+        if head != git_head:
+            ctx.git_cache.clear()
+            git_head = head
+        ctx.today = current_date()
+        for path in sorted(pending):
+            try:
+                digest = file_digest(path)
+            except OSError:
+                # Deleted (or replaced) since the event
+                seen.pop(path, None)
+                continue
+            if seen.get(path) == digest:
+                continue
+            try:
+                changed = chain(path, ctx, classify(path, ctx.settings))
+            except Exception as e:
+                print(f"{path}: {type(e).__name__}: {e}", file=sys.stderr)
+                seen[path] = digest
+                continue
+            if changed:
+                print(f"Reformatted {path}", file=sys.stderr)
+                seen[path] = file_digest(path)
+            else:
+                seen[path] = digest
+
+
+def watch_main(argv: list, settings: Settings = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="header_hook.py watch",
+        description="Re-format headers as files are saved",
+    )
+    parser.add_argument(
+        "paths", nargs="*", default=["."], help="Files/directories to watch"
+    )
+    parser.add_argument(
+        "--poll",
+        action="store_true",
+        help="Poll file mtimes instead of using inotify",
+    )
+    parser.add_argument("--syntactic-shebang", action="store_true")
+    parser.add_argument("--fingerprint", action="store_true")
+    args = parser.parse_args(argv)
+    try:
+        watch(
+            args.paths,
+            check_fs=not args.syntactic_shebang,
+            fingerprint=args.fingerprint,
+            polling=args.poll,
+            settings=settings,
+        )
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+# Sub-commands (first command-line argument). Anything else is
+# treated as a list of files to process
+COMMANDS = {
+    "watch": watch_main,
+    "verify-manifest": verify_manifest_main,
+    "catalogue": catalogue_main,
+}
+
+
+def parse_args(argv: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="header_hook.py",
+        description="Formatting and error checking of header blocks "
+        + "within code files",
+    )
+    parser.add_argument("files", nargs="*", help="Files to process")
+    parser.add_argument(
+        "--syntactic-shebang",
+        action="store_true",
+        help="Validate shebangs without checking the interpreter "
+        + "exists on disk",
+    )
+    parser.add_argument(
+        "--fingerprint",
+        action="store_true",
+        help="Embed a fingerprint in each header, so unchanged "
+        + "headers can be validated without being parsed",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Report files that would be changed, without modifying them",
+    )
+    parser.add_argument(
+        "--budget-ms",
+        type=float,
+        default=None,
+        help="Time budget for the whole run. Once spent, Git-derived "
+        + "steps fall back to recorded values or are deferred",
+    )
+    parser.add_argument(
+        "--file-budget-ms",
+        type=float,
+        default=None,
+        help="Time budget for each file (see --budget-ms)",
+    )
+    parser.add_argument(
+        "--executor",
+        choices=EXECUTORS,
+        default="auto",
+        help="Process files serially, or on a thread/process pool. By "
+        + "default, the cheapest option is chosen for each run",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=None, help="Number of pool workers"
+    )
+    parser.add_argument(
+        "--memory-report",
+        type=int,
+        nargs="?",
+        const=10,
+        default=None,
+        metavar="N",
+        help="Trace allocations for each stage of each file, and "
+        + "report the N (default 10) worst files. Forces serial "
+        + "execution",
+    )
+    parser.add_argument(
+        "--format",
+        choices=OUTPUT_FORMATS,
+        default="text",
+        help="Output format. jsonl streams one event per file to "
+        + "stdout as it finishes, then a summary event",
+    )
+    parser.add_argument(
+        "--staged",
+        action="store_true",
+        help="Normalise the staged (index) versions of files, and "
+        + "mirror header changes into the working tree. If no files "
+        + "are given, all staged files are processed",
+    )
+    parser.add_argument(
+        "--stdin-filename",
+        default=None,
+        metavar="PATH",
+        help="Read content from stdin and write the result to stdout. "
+        + "PATH chooses the language. Pass - as the only file",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Never consult Git: only formatting (and other Git-free) "
+        + "stages run",
+    )
+    parser.add_argument(
+        "--branch",
+        default=None,
+        help="Release branch. Default is the `branch` setting (with "
+        + "--repos, each repository's own)",
+    )
+    parser.add_argument(
+        "--journal",
+        nargs="?",
+        const=JOURNAL_FILE,
+        default=None,
+        metavar="PATH",
+        help="Append each completed file to a journal (default "
+        + f"{JOURNAL_FILE})",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip files the journal records as completed, unless "
+        + "they have changed since. Implies --journal",
+    )
+    parser.add_argument(
+        "--repos",
+        nargs="+",
+        default=None,
+        metavar="DIR",
+        help="Process every tracked file of these repositories (or of "
+        + "the repositories they hold) on one shared process pool, "
+        + "with one combined report",
+    )
+    parser.add_argument(
+        "--audit-budget",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Also check up to N other tracked files, least recently "
+        + "verified first, so the whole repository is kept fresh over "
+        + "successive runs",
+    )
+    parser.add_argument(
+        "--audit-budget-ms",
+        type=float,
+        default=None,
+        metavar="MS",
+        help="Time budget for the extra audit files (processed one at "
+        + "a time, after the given files). Can be combined with "
+        + "--audit-budget",
+    )
+    parser.add_argument(
+        "--plan-report",
+        action="store_true",
+        help="Report the execution plan chosen by --executor auto, "
+        + "with its predicted and actual run time",
+    )
+    parser.add_argument(
+        "--pipeline-report",
+        action="store_true",
+        help="With --executor pipeline, report the utilisation and "
+        + "queue depth of each stage",
+    )
+    parser.add_argument(
+        "--config",
+        default=None,
+        metavar="PATH",
+        help="pyproject.toml to read [tool.header-hook] settings from. "
+        + "Default is the nearest pyproject.toml",
+    )
+    args = parser.parse_args(argv)
+    if args.stdin_filename is not None and args.files != ["-"]:
+        parser.error("--stdin-filename needs - as the only file")
+    if args.staged and args.repos:
+        parser.error("--staged can't be combined with --repos")
+    # The journal tracks the given files on disk (staged runs work on
+    # the index, and --repos picks its own files)
+    journaled = args.journal is not None or args.resume
+    if journaled and (args.staged or args.repos or args.stdin_filename):
+        parser.error(
+            "--journal/--resume can't be combined with --staged, "
+            + "--repos or --stdin-filename"
+        )
+    return args
+
+
+def emit(event: dict) -> None:
+    """Write one JSON Lines event to stdout, immediately"""
+    sys.stdout.write(json.dumps(event) + "\n")
+    sys.stdout.flush()
+
+
+def report_text(report: FileReport, check: bool) -> None:
+    """Print messages (stderr) for a file needing attention"""
+    if report.error is not None:
+        print(f"{report.path}: {report.error}", file=sys.stderr)
+    if report.degraded:
+        print(
+            f"Degraded {report.path} (over budget: "
+            + f"{', '.join(report.degraded)})",
+            file=sys.stderr,
+        )
+    if report.changed and check:
+        print(f"Would reformat {report.path}", file=sys.stderr)
+
+
+def ms_to_s(ms: float) -> Any:
+    return None if ms is None else ms / 1000
+
+
+def main(argv: list) -> int:
+    if len(argv) > 0 and argv[0] in COMMANDS:
+        config_path, command, argv = None, COMMANDS[argv[0]], argv[1::]
+    else:
+        args = parse_args(argv)
+        config_path, command = args.config, None
+    try:
+        settings = configure(config_path)
+    except ConfigError as e:
+        print(f"header_hook.py: {e}", file=sys.stderr)
+        return 2
+    if command is not None:
+        return command(argv, settings)
+    ctx = RunContext(
+        check_fs=not args.syntactic_shebang,
+        fingerprint=args.fingerprint,
+        check=args.check,
+        budget_s=ms_to_s(args.budget_ms),
+        file_budget_s=ms_to_s(args.file_budget_ms),
+        memory=args.memory_report is not None,
+        offline=args.offline,
+        branch=args.branch,
+        settings=settings,
+    )
+    files = args.files
+    journal = None
+    if args.resume and args.journal is None:
+        args.journal = JOURNAL_FILE
+    if args.journal is not None:
+        ctx.digests = True
+        journal = Journal(args.journal, journal_key(ctx))
+    if args.resume:
+        n_files = len(files)
+        files = journal.pending(files)
+        if args.format == "text" and len(files) < n_files:
+            print(
+                f"Resuming: {n_files - len(files)} files already done",
+                file=sys.stderr,
+            )
+    start = time.perf_counter()
+    if args.stdin_filename is not None:
+        # Stdout carries the content, so messages go to stderr only
+        report = run_stdin(args.stdin_filename, ctx)
+        report_text(report, args.check)
+        failed = report.error is not None
+        return int(failed or (report.changed and args.check))
+    if args.staged:
+        staged = args.files or staged_files()
+    audit, extras = None, []
+    if args.audit_budget is not None or args.audit_budget_ms is not None:
+        audit = AuditQueue(audit_path())
+        try:
+            tracked = [x for x in tracked_files() if classify(x, settings)]
+            keep = tracked
+        except GitError:
+            # Without the tracked files, no entry is known to be stale
+            tracked, keep = [], None
+        given = staged if args.staged else files
+        given = [os.path.normpath(x) for x in given]
+        extras = audit.select(tracked, given, args.audit_budget)
+    if args.staged:
+        results = run_staged(staged, ctx)
+    elif args.repos:
+        results = run_repos(args.repos, ctx, args.jobs)
+    elif args.audit_budget_ms is None:
+        # A fixed number of extra files: run them with the rest
+        results = iter_files(files + extras, ctx, args.executor, args.jobs)
+        extras = []
+    else:
+        results = iter_files(files, ctx, args.executor, args.jobs)
+    if extras:
+        # Staged mode reads the index, so extras are run separately
+        deadline = Deadline(ms_to_s(args.audit_budget_ms))
+        results = itertools.chain(results, audit_files(extras, ctx, deadline))
+    reports = []
+    exit_code = 0
+    for report in results:
+        reports.append(report)
+        if journal is not None:
+            journal.record(report, args.check)
+        if args.format == "jsonl":
+            emit(report.to_event(args.check))
+        else:
+            report_text(report, args.check)
+        if report.error is not None or (report.changed and args.check):
+            exit_code = 1
+    if journal is not None:
+        journal.close()
+    if audit is not None:
+        now = time.time()
+        for report in reports:
+            if report.error is None:
+                audit.mark(os.path.normpath(report.path), now)
+        audit.save(keep=keep)
+    if args.format == "jsonl":
+        elapsed_s = time.perf_counter() - start
+        summary = summary_event(reports, elapsed_s, args.check)
+        if ctx.plan is not None:
+            summary["plan"] = ctx.plan.to_dict()
+        emit(summary)
+    if args.memory_report is not None:
+        print(memory_report(reports, args.memory_report), file=sys.stderr)
+    if args.plan_report and ctx.plan is not None:
+        print(plan_report(ctx.plan), file=sys.stderr)
+    if args.pipeline_report and ctx.pipeline_stats is not None:
+        print(pipeline_report(ctx.pipeline_stats), file=sys.stderr)
+    return exit_code
 
 
 if __name__ == "__main__":
     # Get the list of files passed to the script
-    files = sys.argv[1:]
-    # Process each file, in turn
-    for file in files:
-        # TODO: update with list of supported files
-        if file.endswith(".py"):
-            chain(file)
+    sys.exit(main(sys.argv[1:]))
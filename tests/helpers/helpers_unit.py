@@ -0,0 +1,56 @@
+##################################################################
+# File               : tests/helpers/helpers_unit.py
+# Description        : Helper functions for unit testing of
+#                      header-hook internals
+# Maintainer(s)      : richardgarryparker@gmail.com
+# Created            : 2026-10-19
+# Last updated       : 2026-10-19
+# Change Log :
+#   2026-10-19       : First release.
+##################################################################
+"""helpers_unit.py
+Helper functions for unit testing of header-hook internals
+"""
+
+# Metadata attributes
+# __version__ and __date__ refer to the pipeline
+# as a whole, not this individual file. Datestamps
+# for this file can be found in the header comment
+# block
+__version__ = "0.0.0"
+__date__ = "1970-01-01"
+__author__ = "richardgarryparker@gmail.com"
+
+#################################
+# Imports
+#################################
+# Standard
+import importlib.util
+import sys
+from pathlib import Path
+from types import ModuleType
+
+#################################
+# Basic setup
+#################################
+# The hook is a standalone script (not an installed package), so
+# it is loaded straight from its source path
+hook_file = (
+    Path(__file__).parent.parent.parent / "src/header_hook/header_hook.py"
+)
+
+
+def load_hook() -> ModuleType:
+    """Import the hook script as a module
+
+    Returns:
+        ModuleType: The loaded `header_hook` module. The same
+            module object is returned on repeat calls
+    """
+    if "header_hook" in sys.modules:
+        return sys.modules["header_hook"]
+    spec = importlib.util.spec_from_file_location("header_hook", hook_file)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["header_hook"] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,1259 @@
+#!/usr/bin/python3
+##################################################################
+# File               : tests/unit/header_hook_test.py
+# Description        : Unit tests for individual header-hook
+#                      helpers
+# Command-line usage : header_hook_test.py
+# Maintainer(s)      : richardgarryparker@gmail.com
+# Created            : 2026-10-19
+# Last updated       : 2026-10-19
+# Change Log :
+#   2026-10-19       : First release.
+##################################################################
+"""header_hook_test.py
+
+Unit tests for individual header-hook helpers
+"""
+
+# Metadata attributes
+# __version__ and __date__ refer to the pipeline
+# as a whole, not this individual file. Datestamps
+# for this file can be found in the header comment
+# block
+__version__ = "0.0.0"
+__date__ = "1970-01-01"
+__author__ = "richardgarryparker@gmail.com"
+#################################
+# Imports
+#################################
+
+# Standard
+import copy
+import io
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+# Project-specific
+from tests.helpers.helpers_unit import load_hook
+
+hh = load_hook()
+
+
+#################################
+# Tests
+#################################
+class TestWrapCache(unittest.TestCase):
+    """Memoized word wrapping"""
+
+    def setUp(self):
+        hh.cached_wrap_and_indent.cache_clear()
+
+    def test_cached_result_matches_uncached(self):
+        """Cached wrapping must not change the output"""
+        msg = "word " * 40
+        self.assertEqual(
+            hh.cached_wrap_and_indent(msg, 65, 21),
+            hh.wrap_and_indent(msg, 65, 21),
+        )
+
+    def test_repeat_values_hit_the_cache(self):
+        """The same value wrapped for two headers is a cache hit"""
+        for _ in range(2):
+            h = hh.HeaderBlock()
+            h.add("file", "a.py")
+            h.add("description", "Shared boilerplate description")
+            hh.wrap_wrapper(h)
+        stats = hh.wrap_cache_stats()
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hits"], 1)
+
+
+class TestShebang(unittest.TestCase):
+    """Shebang validation"""
+
+    def test_env_form_is_valid_without_filesystem(self):
+        self.assertTrue(
+            hh.is_valid_shebang("#!/usr/bin/env python3", check_fs=False)
+        )
+        self.assertTrue(
+            hh.is_valid_shebang("#!/usr/bin/env -S bash -e", check_fs=False)
+        )
+
+    def test_unsupported_language_is_rejected(self):
+        self.assertFalse(
+            hh.is_valid_shebang("#!/usr/bin/env node", check_fs=False)
+        )
+        self.assertFalse(hh.is_valid_shebang("#!python3", check_fs=False))
+
+    def test_interpreter_lookup_is_cached(self):
+        hh.interpreter_exists.cache_clear()
+        for _ in range(3):
+            hh.is_valid_shebang("#!/no/such/dir/python3")
+        self.assertEqual(hh.interpreter_exists.cache_info().misses, 1)
+
+
+class TestChangelogRules(unittest.TestCase):
+    """Compiled change log normalisation rules"""
+
+    def setUp(self):
+        self.h = hh.HeaderBlock()
+        self.h.add("file", "a.py")
+        self.h.add("description", "First release")
+        self.h.add("2025-01-01", "Initial release.")
+        self.h.add("2025-01-02", "Auto-generated by bot")
+        self.h.add("2025-01-03", "Fixed a bug")
+
+    def test_drop_and_rewrite_in_one_pass(self):
+        rules = hh.compile_changelog_rules(
+            (("?nitial ?elease.", None), ("*by bot", "Automated update."))
+        )
+        rules.apply(self.h)
+        self.assertEqual(
+            [(k, v) for k, v, _ in self.h],
+            [
+                ("file", "a.py"),
+                ("description", "First release"),
+                ("2025-01-03", "Fixed a bug"),
+                ("2025-01-02", "Automated update."),
+            ],
+        )
+
+    def test_default_rules_drop_legacy_release_entries(self):
+        self.h.add("2024-12-31", "First release.")
+        rules = hh.compile_changelog_rules(tuple(hh.CHANGELOG_RULES))
+        rules.apply(self.h)
+        dates = [k for k, _, is_changelog in self.h if is_changelog]
+        self.assertEqual(dates, ["2025-01-03", "2025-01-02"])
+
+    def test_compiled_once_per_rule_set(self):
+        rules = (("a*", None),)
+        self.assertIs(
+            hh.compile_changelog_rules(rules),
+            hh.compile_changelog_rules(rules),
+        )
+
+
+class TestLanguages(unittest.TestCase):
+    """Language registry and per-language comment syntax"""
+
+    def test_classify_by_extension_and_filename(self):
+        self.assertEqual(hh.classify("a/b.py").name, "python")
+        self.assertEqual(hh.classify("analysis.R").name, "r")
+        self.assertEqual(hh.classify("build/Dockerfile").name, "dockerfile")
+        self.assertEqual(hh.classify("q.sql").name, "sql")
+        self.assertIsNone(hh.classify("notes.txt"))
+
+    def test_sql_header_is_parsed(self):
+        sql = hh.LANG_BY_NAME["sql"]
+        lines = [
+            "-" * 66 + "\n",
+            "-- File        : q.sql\n",
+            "-- Description : Monthly\n",
+            "--               totals\n",
+            "-" * 66 + "\n",
+            "SELECT 1;\n",
+        ]
+        h, rest = hh.load_meta(lines, lang=sql)
+        self.assertEqual(h.get("description"), "Monthly totals")
+        self.assertEqual(rest, ["SELECT 1;\n"])
+
+    def test_shebang_rules_are_per_language(self):
+        r = hh.LANG_BY_NAME["r"]
+        yaml = hh.LANG_BY_NAME["yaml"]
+        shebang = "#!/usr/bin/env Rscript"
+        self.assertTrue(hh.is_valid_shebang(shebang, False, r))
+        self.assertFalse(hh.is_valid_shebang(shebang, False))
+        self.assertFalse(hh.is_valid_shebang(shebang, False, yaml))
+
+
+class TestFingerprint(unittest.TestCase):
+    """Embedded header fingerprints"""
+
+    today = "2026-01-01"
+
+    def render(self, today_entry: bool = True) -> list:
+        h = hh.HeaderBlock()
+        h.add("file", "a.py")
+        h.add("description", "Example")
+        h.add("2025-01-01", "First release")
+        if today_entry:
+            h.add(self.today, "Changed things.")
+        hh.wrap_wrapper(h)
+        hh.add_fingerprint(h)
+        return hh.render_header(h) + ["\n", "print(1)\n"]
+
+    def valid(self, lines: list) -> bool:
+        return hh.has_valid_fingerprint(lines, hh.PYTHON, self.today)
+
+    def test_rendered_header_validates(self):
+        self.assertTrue(self.valid(self.render()))
+
+    def test_edited_header_does_not_validate(self):
+        lines = self.render()
+        lines[2] = lines[2].replace("Example", "Edited")
+        self.assertFalse(self.valid(lines))
+
+    def test_header_from_previous_day_does_not_validate(self):
+        self.assertFalse(self.valid(self.render(today_entry=False)))
+
+
+class TestWatch(unittest.TestCase):
+    """Watch mode file discovery and change detection"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        os.makedirs(os.path.join(self.root, ".git"))
+        for name in ["a.py", "notes.txt", ".git/b.py"]:
+            with open(os.path.join(self.root, name), "w") as f:
+                f.write("# x\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_only_supported_files_are_found(self):
+        found = list(hh.iter_supported_files([self.root]))
+        self.assertEqual(found, [os.path.join(self.root, "a.py")])
+
+    def test_polling_watcher_reports_changed_files(self):
+        watcher = hh.PollingWatcher([self.root])
+        self.assertEqual(watcher.wait(timeout=0.01), set())
+        path = os.path.join(self.root, "a.py")
+        with open(path, "a") as f:
+            f.write("# more\n")
+        self.assertEqual(watcher.wait(timeout=0.01), {path})
+
+
+class TestWatchLoop(unittest.TestCase):
+    """Watch mode driven end to end with the polling watcher"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        git = ["git", "-c", "user.name=t", "-c", "user.email=t@t"]
+        subprocess.run(git + ["init", "-q", "-b", "main"], check=True)
+        self.path = os.path.join(".", "a.py")
+        self.write("x = 0\n")
+        subprocess.run(git + ["add", "a.py"], check=True)
+        subprocess.run(git + ["commit", "-qm", "one"], check=True)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def write(self, body):
+        with open(self.path, "w") as f:
+            f.write(hh.SEP + "\n# File : a.py\n# Last updated : 2025-01-01\n")
+            f.write("#   2025-01-01 : First release.\n" + hh.SEP + "\n")
+            f.write(body)
+
+    def test_burst_is_rewritten_once(self):
+        ready = threading.Event()
+        stop = threading.Event()
+
+        class Watcher(hh.PollingWatcher):
+            def wait(self, timeout=None):
+                ready.set()
+                return super().wait(timeout)
+
+            def _scan(self):
+                if stop.is_set():
+                    raise KeyboardInterrupt
+                return super()._scan()
+
+        def make_watcher(paths, polling, settings):
+            return Watcher(paths, settings)
+
+        def run():
+            try:
+                hh.watch(["."], polling=True)
+            except KeyboardInterrupt:
+                pass
+
+        self.addCleanup(patch.stopall)
+        patch.object(hh, "WATCH_POLL_S", 0.01).start()
+        patch.object(hh, "WATCH_DEBOUNCE_S", 0.2).start()
+        patch.object(hh, "make_watcher", make_watcher).start()
+        err = patch("sys.stderr", new=io.StringIO()).start()
+        chain = patch.object(hh, "chain", wraps=hh.chain).start()
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        self.assertTrue(ready.wait(5))
+        # Saves closer together than the debounce interval
+        for i in range(1, 4):
+            self.write("x = 1\n" * i)
+            time.sleep(0.02)
+        deadline = time.monotonic() + 5
+        while not chain.called and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # Long enough for our own write to be seen (and ignored)
+        time.sleep(1)
+        stop.set()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(chain.call_count, 1)
+        self.assertEqual(err.getvalue(), f"Reformatted {self.path}\n")
+        with open(self.path) as f:
+            text = f.read()
+        self.assertIn("# File               : a.py\n", text)
+        self.assertTrue(text.endswith("x = 1\n" * 3))
+
+
+class TestBudget(unittest.TestCase):
+    """Latency budget and graceful degradation"""
+
+    def header(self) -> "hh.HeaderBlock":
+        h = hh.HeaderBlock()
+        h.add("file", "a.py")
+        h.add("last updated", "2025-02-01")
+        h.add("2025-02-01", "Change")
+        h.add("2025-01-01", "First release.")
+        return h
+
+    def test_ask_git_does_not_spawn_after_deadline(self):
+        with self.assertRaises(hh.GitTimeoutError):
+            hh.ask_git("git --version", deadline=hh.Deadline(0))
+
+    def test_silent_history_walk_is_stopped_at_deadline(self):
+        popen = subprocess.Popen
+        # Stands in for a walk that finds nothing for a long time
+        sleeper = [sys.executable, "-c", "import time; time.sleep(30)"]
+
+        def silent_git(cmd, **kwargs):
+            return popen(sleeper, **kwargs)
+
+        start = time.monotonic()
+        with patch("subprocess.Popen", side_effect=silent_git):
+            with self.assertRaises(hh.GitTimeoutError):
+                list(hh.iter_git_log(["HEAD"], hh.Deadline(0.2)))
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_cached_answer_survives_deadline(self):
+        cache = {"git --version": "cached"}
+        self.assertEqual(
+            hh.ask_git("git --version", cache, hh.Deadline(0)), "cached"
+        )
+
+    def test_release_date_falls_back_to_recorded_value(self):
+        h = self.header()
+        hh.check_release_date(h, "2025-06-01", deadline=hh.Deadline(0))
+        self.assertEqual(h.get("2025-01-01"), "First release")
+
+    def test_chain_reports_degraded_steps(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "a.py")
+            lines = hh.render_header(self.header()) + ["print(1)\n"]
+            with open(path, "w") as f:
+                f.writelines(lines)
+            report = hh.FileReport(path)
+            hh.chain(path, hh.RunContext(budget_s=0), report=report)
+        self.assertEqual(report.degraded, ["changelog_merger"])
+
+
+class TestExecutors(unittest.TestCase):
+    """Serial/thread execution through an explicit run context"""
+
+    def test_thread_pool_matches_serial(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            files = []
+            for i in range(4):
+                h = hh.HeaderBlock()
+                h.add("file", f"f{i}.py")
+                h.add("description", "word " * 30)
+                h.add("last updated", "2025-01-01")
+                h.add("2025-01-01", "First release")
+                path = os.path.join(tmp, f"f{i}.py")
+                with open(path, "w") as f:
+                    f.writelines(hh.render_header(h))
+                files.append(path)
+            files.append(os.path.join(tmp, "skipped.txt"))
+            results = {}
+            for executor in ["serial", "thread"]:
+                # Git is never consulted, as the budget is already spent
+                ctx = hh.RunContext(check=True, budget_s=0, today="2025-06-01")
+                reports = hh.run_files(files, ctx, executor, 2)
+                results[executor] = [
+                    (x.path, x.changed, x.degraded) for x in reports
+                ]
+        self.assertEqual(results["serial"], results["thread"])
+        self.assertEqual(len(results["serial"]), 4)
+        self.assertTrue(all(changed for _, changed, _ in results["serial"]))
+
+    def test_unknown_executor_is_rejected(self):
+        with self.assertRaises(ValueError):
+            hh.run_files([], hh.RunContext(), "fork")
+
+
+class TestMemoryReport(unittest.TestCase):
+    """Per-stage memory accounting"""
+
+    def test_stages_record_allocations(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "a.py")
+            h = hh.HeaderBlock()
+            h.add("file", "a.py")
+            h.add("last updated", "2025-01-01")
+            h.add("2025-01-01", "First release")
+            with open(path, "w") as f:
+                f.writelines(hh.render_header(h) + ["x = 1\n"] * 5000)
+            ctx = hh.RunContext(check=True, budget_s=0, memory=True)
+            try:
+                (report,) = hh.run_files([path, path + ".txt"], ctx)
+            finally:
+                hh.tracemalloc.stop()
+        self.assertGreater(report.stages["read"]["mem_peak"], 0)
+        self.assertIn("load_meta", report.stages)
+        text = hh.memory_report([report], top=1)
+        self.assertIn(path, text)
+        self.assertIn("changelog_trim", text)
+
+
+class TestEvents(unittest.TestCase):
+    """Machine-readable per-file events"""
+
+    def test_changed_keys(self):
+        a = hh.HeaderBlock()
+        a.add("file", "a.py")
+        a.add("last updated", "2025-01-01")
+        b = copy.deepcopy(a)
+        b.amend("last updated", "2025-02-01")
+        b.add("2025-02-01", "New")
+        self.assertEqual(a.changed_keys(b), ["last updated", "2025-02-01"])
+
+    def test_event_is_json_serialisable(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "a.py")
+            with open(path, "w") as f:
+                f.write("print('no header')\n")
+            ctx = hh.RunContext(check=True)
+            (report,) = hh.run_files([path], ctx)
+        event = json.loads(json.dumps(report.to_event(check=True)))
+        self.assertEqual(event["outcome"], "error")
+        self.assertIn("MissingHeaderBlockError", event["error"])
+        summary = hh.summary_event([report], 0.5, check=True)
+        self.assertEqual(summary["outcomes"], {"error": 1})
+
+
+class TestStaged(unittest.TestCase):
+    """Normalising staged (index) content"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        git = ["git", "-c", "user.name=t", "-c", "user.email=t@t"]
+        subprocess.run(git + ["init", "-q", "-b", "main"], check=True)
+        with open("a.py", "w") as f:
+            f.write(hh.SEP + "\n# File : a.py\n# Last updated : 2025-01-01\n")
+            f.write("#   2025-01-01 : First release.\n" + hh.SEP + "\n")
+            f.write("x = 1\n")
+        subprocess.run(git + ["add", "a.py"], check=True)
+        # Unstaged change, which must survive
+        with open("a.py", "a") as f:
+            f.write("y = 2\n")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_index_and_working_tree_headers_are_updated(self):
+        # No commits yet, so skip Git history lookups
+        ctx = hh.RunContext(budget_s=0)
+        (report,) = hh.run_staged(["a.py", "b.py"], ctx)
+        self.assertIsNone(report.error)
+        self.assertTrue(report.changed)
+        with hh.CatFileBatch() as cat:
+            staged = cat.read(":a.py").decode()
+            self.assertIsNone(cat.read(":b.py"))
+        with open("a.py") as f:
+            working = f.read()
+        self.assertIn("# File               : a.py\n", staged)
+        self.assertTrue(staged.endswith(hh.SEP + "\nx = 1\n"))
+        self.assertEqual(working, staged + "y = 2\n")
+
+    def test_from_a_subdirectory(self):
+        os.mkdir("sub")
+        with open(os.path.join("sub", "c.py"), "w") as f:
+            f.write(hh.SEP + "\n# File : c.py\n# Last updated : 2025-01-01\n")
+            f.write("#   2025-01-01 : First release.\n" + hh.SEP + "\n")
+        subprocess.run(["git", "add", "sub"], check=True)
+        os.chdir("sub")
+        files = hh.staged_files()
+        self.assertEqual(sorted(files), [os.path.join("..", "a.py"), "c.py"])
+        reports = hh.run_staged(files, hh.RunContext(budget_s=0))
+        self.assertEqual([x.error for x in reports], [None, None])
+        with hh.CatFileBatch() as cat:
+            staged = cat.read(":sub/c.py").decode()
+            self.assertIsNone(cat.read(":c.py"))
+        self.assertIn("# File               : c.py\n", staged)
+
+    def test_index_write_failure_is_reported(self):
+        error = subprocess.CalledProcessError(128, ["git", "update-index"])
+        with patch.object(hh, "write_index", side_effect=error):
+            (report,) = hh.run_staged(["a.py"], hh.RunContext(budget_s=0))
+        self.assertIn("Index not updated", report.error)
+        with open("a.py") as f:
+            self.assertIn("# File : a.py\n", f.read())
+
+
+class TestByteSource(unittest.TestCase):
+    """Header-only decoding, with the rest of the file untouched"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "a.py")
+        self.ctx = hh.RunContext(budget_s=0, today="2026-01-01")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def header(self, newline):
+        lines = [hh.SEP, "# File : a.py", "# Last updated : 2025-01-01"]
+        lines += ["#   2025-01-01 : First release.", hh.SEP, ""]
+        return newline.join(lines).encode()
+
+    def test_crlf_line_endings_are_kept(self):
+        body = b"x = 1\r\ny = 2\r\n"
+        with open(self.path, "wb") as f:
+            f.write(self.header("\r\n") + body)
+        self.assertTrue(hh.chain(self.path, self.ctx))
+        with open(self.path, "rb") as f:
+            data = f.read()
+        self.assertTrue(data.endswith(body))
+        self.assertNotIn(b"\n", data.replace(b"\r\n", b""))
+        self.assertIn(b"# File               : a.py\r\n", data)
+
+    def test_undeclared_latin1_body_is_untouched(self):
+        body = "s = 'caf\xe9'\n".encode("latin-1") + b"\xff\xfe\x00\n"
+        with open(self.path, "wb") as f:
+            f.write(self.header("\n") + body)
+        self.assertTrue(hh.chain(self.path, self.ctx))
+        with open(self.path, "rb") as f:
+            data = f.read()
+        self.assertTrue(data.endswith(hh.SEP.encode() + b"\n" + body))
+
+    def test_unknown_codec_falls_back_to_latin1(self):
+        cookie = "# -*- coding: no-such-codec -*-\n# Author : Ren\xe9\n"
+        header = self.header("\n").replace(
+            b"# File", cookie.encode("latin-1") + b"# File", 1
+        )
+        source = hh.ByteSource(header + b"x = '\xe9'\n", hh.PYTHON)
+        self.assertEqual(source.encoding, "latin-1")
+        self.assertIn("# Author : Ren\xe9\n", source.lines)
+        chunks = source.rebuild(["# Ren\xe9\n"], [])
+        self.assertEqual(b"".join(chunks), b"# Ren\xe9\nx = '\xe9'\n")
+
+    def test_bom_and_coding_cookie_are_kept(self):
+        cookie = "# -*- coding: latin-1 -*-\n# Author : Ren\xe9\n"
+        header = self.header("\n").replace(
+            b"# File", cookie.encode("latin-1") + b"# File", 1
+        )
+        with open(self.path, "wb") as f:
+            f.write(b"\xef\xbb\xbf" + header + b"x = 1\n")
+        source = hh.ByteSource(open(self.path, "rb").read(), hh.PYTHON)
+        self.assertEqual(source.encoding, "latin-1")
+        self.assertEqual(source.bom, b"\xef\xbb\xbf")
+        self.assertIn("# Author : Ren\xe9\n", source.lines)
+        # Decoding stops at the closing divider
+        self.assertEqual(source.lines[-1], hh.SEP + "\n")
+        chunks = source.rebuild(["# new\n"], [])
+        self.assertEqual(b"".join(chunks), b"\xef\xbb\xbf# new\nx = 1\n")
+
+
+class TestStdin(unittest.TestCase):
+    """Stdin to stdout filter mode"""
+
+    def setUp(self):
+        self.ctx = hh.RunContext(budget_s=0)
+        self.data = (
+            f"{hh.SEP}\n# File : a.py\n# Last updated : 2025-01-01\n"
+            + f"#   2025-01-01 : First release.\n{hh.SEP}\nx = 1\n"
+        ).encode()
+
+    def filter(self, path, data, ctx=None):
+        out = io.BytesIO()
+        report = hh.run_stdin(path, ctx or self.ctx, io.BytesIO(data), out)
+        return report, out.getvalue()
+
+    def test_header_is_normalised(self):
+        report, out = self.filter("a.py", self.data)
+        self.assertTrue(report.changed)
+        self.assertIn(b"# File               : a.py\n", out)
+        self.assertTrue(out.endswith(hh.SEP.encode() + b"\nx = 1\n"))
+
+    def test_canonical_and_unsupported_content_is_echoed(self):
+        _, out = self.filter("a.py", self.data)
+        report, again = self.filter("a.py", out)
+        self.assertFalse(report.changed)
+        self.assertEqual(again, out)
+        report, same = self.filter("a.txt", self.data)
+        self.assertFalse(report.changed)
+        self.assertEqual(same, self.data)
+
+    def test_check_mode_writes_nothing(self):
+        ctx = hh.RunContext(budget_s=0, check=True)
+        report, out = self.filter("a.py", self.data, ctx)
+        self.assertTrue(report.changed)
+        self.assertEqual(out, b"")
+
+
+class TestConfig(unittest.TestCase):
+    """Settings from pyproject.toml"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.env = patch.dict(
+            os.environ, {"HEADER_HOOK_CACHE_DIR": self.tmp.name}
+        )
+        self.env.start()
+        self.path = os.path.join(self.tmp.name, "pyproject.toml")
+        self.write('[tool.header-hook]\nsep = "####"\nbranch = "trunk"\n')
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmp.cleanup()
+
+    def write(self, text, mtime_ns=None):
+        with open(self.path, "w") as f:
+            f.write(text)
+        if mtime_ns is not None:
+            os.utime(self.path, ns=(mtime_ns, mtime_ns))
+
+    def test_settings_are_merged_and_derived(self):
+        settings = hh.build_settings(
+            {"allowed-keys": hh.REQUIRED_KEYS + ["a much longer key"]}
+        )
+        self.assertEqual(settings["FIRST_KEYVAL_INDENT_N"], 18)
+        self.assertEqual(settings["SEP"], hh.SEP)
+        bad = [{"nope": 1}, {"sep": 4}, {"sep": "#====="}]
+        for table in bad + [{"allowed-keys": ["file"]}]:
+            with self.assertRaises(hh.ConfigError):
+                hh.build_settings(table)
+
+    def test_snapshot_is_cached_by_mtime_and_hash(self):
+        self.assertEqual(hh.load_settings(self.path)["WRAP_LIMIT"], 4)
+        # Same mtime: served from the cache, without reading the file
+        mtime_ns = os.stat(self.path).st_mtime_ns
+        self.write('[tool.header-hook]\nsep = "##"\n', mtime_ns)
+        self.assertEqual(hh.load_settings(self.path)["WRAP_LIMIT"], 4)
+        # New mtime and content: re-parsed
+        self.write('[tool.header-hook]\nsep = "##"\n', mtime_ns + 10**9)
+        self.assertEqual(hh.load_settings(self.path)["WRAP_LIMIT"], 2)
+
+    def test_settings_stay_with_their_run(self):
+        settings = hh.configure(self.path)
+        self.assertEqual(hh.classify("a.py", settings).sep, "####")
+        self.assertEqual(hh.RunContext(settings=settings).branch, "trunk")
+        # Nothing global changed
+        self.assertEqual(hh.classify("a.py"), hh.PYTHON)
+        self.assertEqual(hh.PYTHON.sep, hh.SEP)
+        self.assertEqual(hh.RunContext().branch, "main")
+
+
+class TestPipeline(unittest.TestCase):
+    """Pipelined (staged, bounded queue) executor"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.files = []
+        for i in range(20):
+            path = os.path.join(self.tmp.name, f"m{i}.py")
+            with open(path, "w") as f:
+                f.write(hh.SEP + f"\n# File : m{i}.py\n")
+                f.write("# Last updated : 2025-01-01\n")
+                f.write("#   2025-01-01 : First release.\n" + hh.SEP + "\n")
+                f.write("x = 1\n")
+            self.files.append(path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_matches_serial_and_reports_stages(self):
+        # No Git repository, so skip Git history lookups
+        check = hh.RunContext(budget_s=0, check=True)
+        serial = hh.run_files(self.files, check)
+        ctx = hh.RunContext(budget_s=0)
+        reports = hh.run_files(self.files, ctx, "pipeline", jobs=3)
+        self.assertEqual(
+            [(x.path, x.changed, x.error) for x in reports],
+            [(x.path, x.changed, x.error) for x in serial],
+        )
+        stats = {x["stage"]: x for x in ctx.pipeline_stats}
+        self.assertEqual(list(stats), hh.PIPELINE_STAGES)
+        self.assertEqual(stats["git"]["workers"], 3)
+        self.assertEqual(stats["write"]["items"], 20)
+        self.assertIn("Bottleneck:", hh.pipeline_report(ctx.pipeline_stats))
+        with open(self.files[0]) as f:
+            self.assertIn("# File               : m0.py\n", f.read())
+
+
+class TestHeaderStages(unittest.TestCase):
+    """Declared header stages, offline runs and batched Git facts"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.header = [
+            hh.SEP + "\n",
+            "# File : a.py\n",
+            "# Last updated : 2025-01-01\n",
+            "#   2025-01-01 : First release.\n",
+            hh.SEP + "\n",
+        ]
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def git(self, *args):
+        git = ["git", "-c", "user.name=t", "-c", "user.email=t@t"]
+        subprocess.run(git + list(args), check=True, capture_output=True)
+
+    def test_offline_runs_skip_git_stages(self):
+        ctx = hh.RunContext(offline=True)
+        report = hh.FileReport("a.py")
+        hh.normalise(self.header, ctx, report=report)
+        self.assertEqual(report.git["calls"], 0)
+        self.assertEqual(report.degraded, [])
+        self.assertIn("update_last_updated", report.stages)
+        self.assertNotIn("changelog_merger", report.stages)
+
+    def test_changelog_rules_apply_without_git(self):
+        snapshot = dict(hh.BUILTIN_SETTINGS.snapshot)
+        snapshot["CHANGELOG_RULES"] = snapshot["CHANGELOG_RULES"] + [
+            ("WIP*", "Work in progress"),
+        ]
+        ctx = hh.RunContext(offline=True, settings=hh.Settings(snapshot))
+        header = (
+            self.header[0:3]
+            + [
+                "#   2025-03-01 : WIP parser\n",
+                "#   2025-02-01 : Initial release\n",
+            ]
+            + self.header[3::]
+        )
+        new_header, _ = hh.normalise(header, ctx)
+        text = "".join(new_header)
+        self.assertIn(": Work in progress\n", text)
+        # Only the release entry survives, re-worded
+        self.assertNotIn("Initial release", text)
+        self.assertEqual(text.count(": First release\n"), 1)
+
+    def test_batched_facts_follow_merges(self):
+        def git_on(day, *args):
+            date = f"2025-01-{day:02}T00:00:00+0000"
+            with patch.dict(os.environ, {"GIT_COMMITTER_DATE": date}):
+                self.git(*args)
+
+        def append(*names):
+            for name in names:
+                with open(name, "a") as f:
+                    f.write("main\n")
+
+        self.git("init", "-q", "-b", "main")
+        for name in ("a.py", "b.py", "c.py"):
+            with open(name, "w") as f:
+                f.write("".join(f"{i}\n" for i in range(50)))
+        self.git("add", ".")
+        git_on(1, "commit", "-qm", "one")
+        self.git("checkout", "-qb", "side")
+        self.git("mv", "a.py", "renamed.py")
+        git_on(2, "commit", "-qm", "rename")
+        self.git("checkout", "-q", "main")
+        self.git("rm", "-q", "b.py")
+        git_on(3, "commit", "-qm", "delete")
+        append("a.py", "c.py")
+        git_on(4, "commit", "-qam", "modify")
+        # Renamed on one side, modified on the other: the merge lists
+        # renamed.py with a combined status ("RM") and a single path
+        git_on(5, "merge", "-q", "--no-edit", "side")
+        files = sorted(os.listdir("."))
+        files.remove(".git")
+        answers = hh.batch_last_commit(set(files), "main", None)
+        for name in files:
+            cmd = hh.GIT_FACTS["last_commit"].format(branch="main", path=name)
+            self.assertEqual(answers[name], hh.ask_git(cmd), name)
+
+    def test_batched_facts_match_per_file_answers(self):
+        self.git("init", "-q", "-b", "main")
+        files = [f"m{i}.py" for i in range(hh.GIT_BATCH_MIN_FILES)]
+        for name in files:
+            with open(name, "w") as f:
+                f.write("x = 1\n")
+        self.git("add", ".")
+        self.git("commit", "-qm", "one")
+        self.git("mv", "m0.py", "renamed.py")
+        self.git("commit", "-qm", "two")
+        # Work on another branch doesn't count (facts come from main)
+        self.git("checkout", "-qb", "feature")
+        with open("m1.py", "a") as f:
+            f.write("y = 2\n")
+        date = "2030-01-01T00:00:00+0000"
+        with patch.dict(os.environ, {"GIT_COMMITTER_DATE": date}):
+            self.git("commit", "-qam", "three")
+        files = files[1::] + ["renamed.py", "never.py"]
+        ctx = hh.RunContext()
+        self.assertEqual(hh.prefetch_git_facts(files, ctx), 2 * len(files))
+        for cmd, answer in ctx.git_cache.items():
+            if cmd.startswith("git log"):
+                self.assertEqual(hh.ask_git(cmd), answer)
+                self.assertNotIn("2030", answer)
+        offline = hh.RunContext(offline=True)
+        self.assertEqual(hh.prefetch_git_facts(files, offline), 0)
+
+
+class TestManifest(unittest.TestCase):
+    """Committed release-date manifest"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.git("init", "-q", "-b", "main")
+        for name in ("a.py", "b.py"):
+            with open(name, "w") as f:
+                f.write(hh.SEP + f"\n# File : {name}\n")
+                f.write("# Last updated : 2025-01-01\n")
+                f.write("#   2025-01-01 : First release.\n" + hh.SEP + "\n")
+        self.git("add", ".")
+        self.git("commit", "-qm", "one")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def git(self, *args):
+        git = ["git", "-c", "user.name=t", "-c", "user.email=t@t"]
+        subprocess.run(git + list(args), check=True, capture_output=True)
+
+    def test_recorded_dates_are_used_and_new_files_added(self):
+        manifest = hh.Manifest(hh.MANIFEST_FILE, "main")
+        manifest.add("a.py", "0" * 40, "Sat Jun 1 00:00:00 2024 +0000")
+        manifest.save()
+        ctx = hh.RunContext()
+        reports = hh.run_files(["a.py", "b.py"], ctx)
+        self.assertEqual([x.error for x in reports], [None, None])
+        with open("a.py") as f:
+            self.assertIn("#   2024-06-01       : First release", f.read())
+        updated = hh.Manifest.load(hh.MANIFEST_FILE, "main")
+        self.assertEqual(sorted(updated.entries), ["a.py", "b.py"])
+        self.assertEqual(len(updated.entries["b.py"]["commit"]), 40)
+
+    def test_stdin_runs_use_the_manifest(self):
+        manifest = hh.Manifest(hh.MANIFEST_FILE, "main")
+        manifest.add("a.py", "0" * 40, "Sat Jun 1 00:00:00 2024 +0000")
+        manifest.save()
+        with open("a.py", "rb") as f:
+            stdin = io.BytesIO(f.read())
+        stdout = io.BytesIO()
+        report = hh.run_stdin("a.py", hh.RunContext(), stdin, stdout)
+        self.assertIsNone(report.error)
+        output = stdout.getvalue().decode()
+        self.assertIn("#   2024-06-01       : First release", output)
+
+    def test_unrecorded_branch_is_the_configured_one(self):
+        with open(hh.MANIFEST_FILE, "w") as f:
+            json.dump({"files": {}}, f)
+        settings = hh.Settings(
+            dict(hh.BUILTIN_SETTINGS.snapshot, DEFAULT_BRANCH="develop")
+        )
+        ctx = hh.RunContext(settings=settings)
+        self.assertEqual(hh.use_manifest(ctx).branch, "develop")
+
+    def test_verify_rebuilds_and_compares(self):
+        self.assertEqual(hh.verify_manifest_main(["--write"]), 0)
+        self.assertEqual(hh.verify_manifest_main([]), 0)
+        self.git("mv", "b.py", "c.py")
+        self.git("commit", "-qm", "two")
+        self.assertEqual(hh.verify_manifest_main([]), 1)
+
+    def test_verify_outside_a_repository(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            with patch("sys.stderr", new=io.StringIO()) as err:
+                self.assertEqual(hh.verify_manifest_main([]), 2)
+        self.assertIn("Problem communicating with Git", err.getvalue())
+
+
+class TestCatalogue(unittest.TestCase):
+    """Header catalogue with incremental refresh"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        for name in ("a.py", "b.sh"):
+            self.write(name, "2025-01-02")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def write(self, name, last_updated):
+        with open(name, "w") as f:
+            f.write(hh.SEP + f"\n# File : {name}\n# Maintainer(s) : ann\n")
+            f.write(f"# Last updated : {last_updated}\n")
+            f.write("#   2025-01-01 : First release\n" + hh.SEP + "\n")
+
+    def test_refresh_only_rereads_changed_files(self):
+        self.assertEqual(hh.refresh_catalogue("c.db"), (2, 2))
+        self.assertEqual(hh.refresh_catalogue("c.db"), (2, 0))
+        self.write("a.py", "2025-03-03")
+        os.remove("b.sh")
+        self.assertEqual(hh.refresh_catalogue("c.db"), (1, 1))
+        hh.export_catalogue("c.db", "c.json")
+        with open("c.json") as f:
+            (row,) = json.load(f)
+        self.assertEqual(row["path"], "a.py")
+        self.assertEqual(row["last_updated"], "2025-03-03")
+        self.assertEqual(row["released"], "2025-01-01")
+        self.assertEqual(row["maintainers"], "ann")
+        self.assertEqual(row["header"]["file"], "a.py")
+
+    def test_release_entry_follows_the_changelog_rules(self):
+        with open("a.py") as f:
+            text = f.read().replace("First release", "Shipped")
+        with open("a.py", "w") as f:
+            f.write(text)
+        entry = hh.catalogue_entry("a.py", hh.BUILTIN_SETTINGS)
+        self.assertIsNone(entry["released"])
+        snapshot = dict(hh.BUILTIN_SETTINGS.snapshot)
+        snapshot["CHANGELOG_RULES"] = [("Shipped", None)]
+        entry = hh.catalogue_entry("a.py", hh.Settings(snapshot))
+        self.assertEqual(entry["released"], "2025-01-01")
+
+
+class TestJournal(unittest.TestCase):
+    """Completion journal and resumed runs"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.files = []
+        for i in range(3):
+            name = f"m{i}.py"
+            with open(name, "w") as f:
+                f.write(hh.SEP + f"\n# File : {name}\n")
+                f.write("# Last updated : 2025-01-01\n")
+                f.write("#   2025-01-01 : First release.\n" + hh.SEP + "\n")
+            self.files.append(name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_completed_files_are_skipped_until_they_change(self):
+        ctx = hh.RunContext(offline=True, digests=True)
+        journal = hh.Journal("j.jsonl", hh.journal_key(ctx))
+        for report in hh.run_files(self.files[0:2], ctx):
+            journal.record(report)
+        journal.close()
+        # Torn line, as left by an interrupted run
+        with open("j.jsonl", "a") as f:
+            f.write('{"path": "m2.py", "ke')
+        journal = hh.Journal("j.jsonl", hh.journal_key(ctx))
+        self.assertEqual(journal.pending(self.files), ["m2.py"])
+        with open("m0.py", "a") as f:
+            f.write("x = 1\n")
+        self.assertEqual(journal.pending(self.files), ["m0.py", "m2.py"])
+        journal.close()
+        # Different options: nothing counts as done
+        other = hh.Journal("j.jsonl", hh.journal_key(hh.RunContext()))
+        self.assertEqual(other.pending(self.files), self.files)
+        other.close()
+
+    def test_text_mode_runs_are_journaled(self):
+        ctx = hh.RunContext(offline=True, digests=True, zero_decode=False)
+        journal = hh.Journal("j.jsonl", hh.journal_key(ctx))
+        reports = hh.run_files(self.files, ctx)
+        self.assertTrue(all(x.changed for x in reports))
+        for report in reports:
+            journal.record(report)
+        self.assertEqual(journal.pending(self.files), [])
+        journal.close()
+
+    def test_resume(self):
+        err = patch("sys.stderr", new=io.StringIO()).start()
+        self.addCleanup(patch.stopall)
+        self.assertEqual(hh.main(["--offline", "--resume"] + self.files), 0)
+        with open("m1.py", "a") as f:
+            f.write("x = 1\n")
+        self.assertEqual(hh.main(["--offline", "--resume"] + self.files), 0)
+        self.assertIn("Resuming: 2 files already done", err.getvalue())
+        with self.assertRaises(SystemExit):
+            hh.main(["--staged", "--resume"])
+
+
+class TestAuditQueue(unittest.TestCase):
+    """Least-recently-verified selection of extra files"""
+
+    def test_least_recently_verified_first(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "audit.json")
+            audit = hh.AuditQueue(path)
+            files = ["a.py", "b.py", "c.py", "d.py"]
+            audit.mark("a.py", 30.0)
+            audit.mark("b.py", 10.0)
+            audit.mark("gone.py", 5.0)
+            # Never-verified files come first, staged files are skipped
+            self.assertEqual(
+                audit.select(files, ["d.py"], 2), ["c.py", "b.py"]
+            )
+            self.assertEqual(
+                audit.select(files, []), ["c.py", "d.py", "b.py", "a.py"]
+            )
+            audit.save(keep=files)
+            again = hh.AuditQueue(path)
+            self.assertEqual(again.verified, {"a.py": 30.0, "b.py": 10.0})
+
+    def test_history_survives_git_failures(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            self.addCleanup(os.chdir, cwd)
+            audit = hh.AuditQueue(hh.AUDIT_FILE)
+            audit.mark("old.py", 5.0)
+            audit.save()
+            with open("m.py", "w") as f:
+                f.write(hh.SEP + "\n# File : m.py\n" + hh.SEP + "\n")
+            # Not a repository: the tracked files can't be listed
+            with patch("sys.stderr", new=io.StringIO()):
+                hh.main(["--offline", "--audit-budget", "1", "m.py"])
+            again = hh.AuditQueue(hh.AUDIT_FILE)
+            self.assertEqual(again.verified["old.py"], 5.0)
+
+
+class TestFlake8Checker(unittest.TestCase):
+    """flake8 plugin, run on lines already in memory"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        hh.Flake8Checker.parse_options(
+            type("Options", (), {"header_hook_git": False})
+        )
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def check(self, lines: list) -> list:
+        checker = hh.Flake8Checker(None, "m.py", lines)
+        return [(x[0], x[2].split()[0]) for x in checker.run()]
+
+    def test_codes(self):
+        sep = hh.SEP + "\n"
+        today = hh.RunContext().today
+        header = [
+            sep,
+            "# File : m.py\n",
+            f"# Last updated : {today}\n",
+            f"#   {today} : First release.\n",
+            sep,
+        ]
+        # No m.py on disk: only the lines given are checked
+        self.assertEqual(self.check([]), [(1, "HDR100")])
+        self.assertEqual(self.check(["\n", "x = 1\n"]), [(2, "HDR100")])
+        self.assertEqual(self.check(header), [(1, "HDR102")])
+        ctx = hh.RunContext(check=True, offline=True)
+        new_header, _ = hh.normalise(header, ctx)
+        canonical = "".join(new_header).splitlines(keepends=True)
+        self.assertEqual(self.check(canonical + ["x = 1\n"]), [])
+        self.assertEqual(self.check([sep, "# no key\n"]), [(1, "HDR101")])
+        # Git checks outside a repository: skipped, not invalid
+        hh.Flake8Checker.parse_options(
+            type("Options", (), {"header_hook_git": True})
+        )
+        self.assertEqual(self.check(header), [(1, "HDR103"), (1, "HDR102")])
+
+
+class TestHistoryIndex(unittest.TestCase):
+    """Memory-mapped Git fact table shared with process workers"""
+
+    def test_answers_round_trip(self):
+        answers = {
+            "first_added": {
+                "b.py": "Sat Jun 1 23:30:00 2024 -0500",
+                "a.py": "",
+            },
+            "last_commit": {"b.py": "Mon Jul 1 08:00:00 2024 +0100"},
+        }
+
+        def cmd(fact: str, path: str) -> str:
+            return hh.GIT_FACTS[fact].format(branch="main", path=path)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            history = hh.HistoryIndex.build(
+                os.path.join(tmp, "index"), "main", answers
+            )
+            # Workers receive the file name, and map it themselves
+            cache = pickle.loads(pickle.dumps(hh.GitCache(history)))
+            # Dates survive as days (in the committer's time zone)
+            answer = cache[cmd("first_added", "b.py")]
+            self.assertEqual(hh.git_date_convert(answer), "2024-06-01")
+            answer = cache[cmd("last_commit", "b.py")]
+            self.assertEqual(hh.git_date_convert(answer), "2024-07-01")
+            self.assertEqual(cache[cmd("first_added", "a.py")], "")
+            # Not fetched, or not in the table: ask Git
+            self.assertNotIn(cmd("last_commit", "a.py"), cache)
+            self.assertNotIn(cmd("first_added", "c.py"), cache)
+            cache.history.close()
+            history.close()
+
+
+class TestRepos(unittest.TestCase):
+    """Multi-repository runs on one shared pool"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        os.mkdir("notes")
+        for repo, n_files in (("big", 40), ("small", 1)):
+            os.mkdir(repo)
+            for i in range(n_files):
+                with open(os.path.join(repo, f"m{i}.py"), "w") as f:
+                    f.write(hh.SEP + f"\n# File : m{i}.py\n" + hh.SEP + "\n")
+            for cmd in (["init", "-q"], ["add", "."]):
+                subprocess.run(["git", "-C", repo, *cmd], check=True)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_combined_report(self):
+        self.assertEqual(hh.discover_repos(["."]), (["big", "small"], []))
+        ctx = hh.RunContext(check=True, offline=True)
+        paths = [x.path for x in hh.run_repos(["."], ctx, jobs=1)]
+        self.assertEqual(os.getcwd(), self.tmp.name)
+        self.assertEqual(len(paths), 41)
+        # The small repository doesn't wait for the big one
+        self.assertLess(paths.index(os.path.join("small", "m0.py")), 40)
+
+    def test_unreadable_directories_are_reported(self):
+        ctx = hh.RunContext(check=True, offline=True)
+        reports = list(hh.run_repos(["gone", "small"], ctx, jobs=1))
+        self.assertEqual(reports[0].path, "gone")
+        self.assertIn("FileNotFoundError", reports[0].error)
+        self.assertEqual(reports[1].path, os.path.join("small", "m0.py"))
+
+    def test_branch(self):
+        with open(os.path.join("small", "pyproject.toml"), "w") as f:
+            f.write('[tool.header-hook]\nbranch = "trunk"\n')
+        ctx = hh.RunContext(offline=True)
+        branch = {}
+        for repo in ("big", "small"):
+            os.chdir(os.path.join(self.tmp.name, repo))
+            branch[repo] = hh.plan_repo(repo, ctx, "index").ctx.branch
+        self.assertEqual(branch, {"big": "main", "small": "trunk"})
+        # Unless the run chose one (even the default)
+        ctx = hh.RunContext(offline=True, branch="main")
+        plan = hh.plan_repo("small", ctx, "index")
+        self.assertEqual(plan.ctx.branch, "main")
+
+    def test_not_with_staged(self):
+        with patch("sys.stderr", new=io.StringIO()):
+            with self.assertRaises(SystemExit):
+                hh.parse_args(["--staged", "--repos", "."])
+
+
+class TestPlanner(unittest.TestCase):
+    """Choice of executor and worker count"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        self.files = []
+        for i in range(200):
+            name = f"m{i}.py"
+            with open(name, "w") as f:
+                f.write(hh.SEP + f"\n# File : {name}\n" + hh.SEP + "\n")
+            self.files.append(name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_small_runs_are_serial_large_runs_pooled(self):
+        ctx = hh.RunContext(check=True, offline=True)
+        with patch("os.cpu_count", return_value=8):
+            plan = hh.plan_execution(self.files[0:1], ctx)
+            self.assertEqual((plan.executor, plan.workers), ("serial", 1))
+            with patch.dict(hh.PLAN_COSTS, {"file": 0.01}):
+                plan = hh.plan_execution(self.files, ctx)
+            self.assertEqual((plan.executor, plan.workers), ("process", 8))
+            # Uncached Git answers, asked file by file, favour threads
+            ctx = hh.RunContext(check=True)
+            with patch.object(hh, "GIT_BATCH_MIN_FILES", 1000):
+                plan = hh.plan_execution(self.files[0:4], ctx)
+            self.assertEqual(plan.executor, "thread")
+            self.assertEqual(plan.inputs["git_hit_rate"], 0.0)
+
+    def test_planner_keeps_to_the_budget(self):
+        ctx = hh.RunContext(check=True, budget_s=0)
+        spawned = AssertionError("Git was run after the deadline")
+        with patch("subprocess.run", side_effect=spawned):
+            plan = hh.plan_execution(self.files, ctx)
+        self.assertEqual(plan.inputs["git_walks"], 0)
+
+    def test_plan_is_recorded(self):
+        ctx = hh.RunContext(check=True, offline=True)
+        reports = hh.run_files(self.files[0:3], ctx, "auto")
+        self.assertEqual(len(reports), 3)
+        self.assertIsNotNone(ctx.plan.actual_s)
+        self.assertIn("predicted", hh.plan_report(ctx.plan))
+
+
+class TestGitGovernor(unittest.TestCase):
+    """Machine-wide and per-repository caps on Git commands"""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.patches = [
+            patch.object(hh, "GIT_SLOT_DIR", self.tmp.name),
+            patch.object(hh, "GIT_MACHINE_SLOTS", 1),
+            patch.object(hh, "GIT_REPO_SLOTS", 0),
+        ]
+        for x in self.patches:
+            x.start()
+
+    def tearDown(self):
+        for x in self.patches:
+            x.stop()
+        self.tmp.cleanup()
+
+    @unittest.skipIf(hh.fcntl is None, "Needs flock")
+    def test_waits_for_a_free_slot(self):
+        ((directory, slots),) = hh.git_slot_dirs()
+        # Another run holds the only slot (locks are per open file)
+        fd = hh.acquire_slot(directory, slots)
+        stats = {"wait_s": 0.0}
+        with self.assertRaises(hh.GitTimeoutError):
+            with hh.git_slot(hh.Deadline(0.02), stats):
+                pass
+        os.close(fd)
+        with hh.git_slot(hh.Deadline(1), stats):
+            # Slot held: nobody else gets it
+            with self.assertRaises(hh.GitTimeoutError):
+                hh.acquire_slot(directory, slots, hh.Deadline(0))
+        self.assertGreater(stats["wait_s"], 0)
+
+
+#################################
+# Execute
+#################################
+if __name__ == "__main__":
+    unittest.main()
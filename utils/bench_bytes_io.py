@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+##################################################################
+# File               : utils/bench_bytes_io.py
+# Description        : Compare the bytes (header-only decoding)
+#                      and text file paths of header-hook
+# Command-line usage : bench_bytes_io.py [--files N] [--size-kb N]
+#                      [--repeat N]
+# Maintainer(s)      : richardgarryparker@gmail.com
+# Created            : 2026-10-19
+# Last updated       : 2026-10-19
+# Change Log :
+#   2026-10-19       : First release.
+##################################################################
+"""bench_bytes_io.py
+Compare the bytes (header-only decoding) and text file paths of
+header-hook on large files. Every file needs its header updating,
+so each repeat reads, normalises and writes every file. Git
+lookups are skipped, so only file handling is measured
+"""
+
+# Metadata attributes
+# __version__ and __date__ refer to the pipeline
+# as a whole, not this individual file. Datestamps
+# for this file can be found in the header comment
+# block
+__version__ = "0.1.0"
+__date__ = "2026-10-19"
+__author__ = "richardgarryparker@gmail.com"
+
+#################################
+# Imports
+#################################
+# Standard
+import argparse
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+
+#################################
+# Setup
+#################################
+hook_file = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "src",
+    "header_hook",
+    "header_hook.py",
+)
+spec = importlib.util.spec_from_file_location("header_hook", hook_file)
+hh = importlib.util.module_from_spec(spec)
+sys.modules["header_hook"] = hh
+spec.loader.exec_module(hh)
+
+
+#################################
+# Helpers
+#################################
+
+
+def file_contents(name: str, size_kb: int) -> bytes:
+    """Contents of a Python file with an out-of-date header,
+    followed by roughly `size_kb` KiB of code
+
+    Args:
+        name (str): File name (for the File key)
+        size_kb (int): Approximate size of the body in KiB
+
+    Returns:
+        bytes: File contents
+    """
+    header = (
+        f"{hh.SEP}\n# File : {name}\n# Last updated : 2025-01-02\n"
+        + f"# Change Log :\n#   2025-01-01 : First release.\n{hh.SEP}\n"
+    )
+    line = "print('hello, world')  # some padding for the line\n"
+    body = line * (size_kb * 1024 // len(line))
+    return (header + body).encode()
+
+
+#################################
+# Main
+#################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--size-kb", type=int, default=4096)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{args.files} files of ~{args.size_kb} KiB, best of {args.repeat}")
+    with tempfile.TemporaryDirectory() as tmp:
+        files = {}
+        for i in range(args.files):
+            name = os.path.join(tmp, f"mod_{i:05d}.py")
+            files[name] = file_contents(name, args.size_kb)
+        for label, zero_decode in (("bytes", True), ("text", False)):
+            timings = []
+            for _ in range(args.repeat):
+                # Restore the original (out-of-date) files
+                for name, data in files.items():
+                    with open(name, "wb") as f:
+                        f.write(data)
+                ctx = hh.RunContext(budget_s=0, zero_decode=zero_decode)
+                start = time.perf_counter()
+                for name in files:
+                    hh.chain(name, ctx)
+                timings.append(time.perf_counter() - start)
+            print(f"  {label:<6} {min(timings):8.3f}s")
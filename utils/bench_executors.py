@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+##################################################################
+# File               : utils/bench_executors.py
+# Description        : Compare serial, thread-pool and
+#                      process-pool execution of header-hook
+# Command-line usage : bench_executors.py [--files N] [--jobs N]
+#                      [--repeat N]
+# Maintainer(s)      : richardgarryparker@gmail.com
+# Created            : 2026-10-19
+# Last updated       : 2026-10-19
+# Change Log :
+#   2026-10-19       : First release.
+##################################################################
+"""bench_executors.py
+Compare serial, thread-pool and process-pool execution of
+header-hook. Run under both a standard (GIL) interpreter and a
+free-threaded (e.g., ``python3.13t``) interpreter to compare the
+two. Files are processed in check mode, so every repeat sees the
+same input
+"""
+
+# Metadata attributes
+# __version__ and __date__ refer to the pipeline
+# as a whole, not this individual file. Datestamps
+# for this file can be found in the header comment
+# block
+__version__ = "0.1.0"
+__date__ = "2026-10-19"
+__author__ = "richardgarryparker@gmail.com"
+
+#################################
+# Imports
+#################################
+# Standard
+import argparse
+import importlib.util
+import os
+import subprocess
+import sys
+import sysconfig
+import tempfile
+import time
+
+#################################
+# Setup
+#################################
+hook_file = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "src",
+    "header_hook",
+    "header_hook.py",
+)
+# Registered under its own name, so process pool workers can
+# unpickle references to it
+spec = importlib.util.spec_from_file_location("header_hook", hook_file)
+hh = importlib.util.module_from_spec(spec)
+sys.modules["header_hook"] = hh
+spec.loader.exec_module(hh)
+
+DESCRIPTION = (
+    "A deliberately long description, so that every header needs "
+    + "word wrapping over several lines before it can be saved. "
+)
+
+
+#################################
+# Helpers
+#################################
+
+
+def make_repo(root: str, n_files: int) -> list:
+    """Create a Git repository (branch `main`) containing
+    `n_files` Python files with headers
+
+    Args:
+        root (str): Directory to create the repository in
+        n_files (int): Number of files
+
+    Returns:
+        list: Paths to the files (relative to `root`)
+    """
+    files = []
+    for i in range(n_files):
+        name = f"mod_{i:05d}.py"
+        with open(os.path.join(root, name), "w") as f:
+            f.write(hh.SEP + "\n")
+            f.write(f"# File : {name}\n")
+            f.write(f"# Description : {DESCRIPTION * 3}\n")
+            f.write("# Last updated : 2025-01-02\n")
+            f.write("# Change Log :\n")
+            f.write("#   2025-01-02 : Tweaks\n")
+            f.write("#   2025-01-01 : First release.\n")
+            f.write(hh.SEP + "\n")
+            f.write("print('hello')\n" * 200)
+        files.append(name)
+    git = ["git", "-c", "user.name=bench", "-c", "user.email=bench@local"]
+    subprocess.run(git + ["init", "-q", "-b", "main"], cwd=root, check=True)
+    subprocess.run(git + ["add", "."], cwd=root, check=True)
+    subprocess.run(git + ["commit", "-qm", "bench"], cwd=root, check=True)
+    return files
+
+
+def gil_status() -> str:
+    if not sysconfig.get_config_var("Py_GIL_DISABLED"):
+        return "GIL build"
+    if getattr(sys, "_is_gil_enabled", lambda: True)():
+        return "free-threaded build (GIL re-enabled)"
+    return "free-threaded build"
+
+
+#################################
+# Main
+#################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"Python {sys.version.split()[0]}, {gil_status()}")
+    print(f"{args.files} files, {args.jobs} workers, best of {args.repeat}")
+    with tempfile.TemporaryDirectory() as tmp:
+        files = make_repo(tmp, args.files)
+        os.chdir(tmp)
+        for executor in hh.EXECUTORS:
+            timings = []
+            for _ in range(args.repeat):
+                # Fresh context (and so a cold Git cache) per repeat
+                ctx = hh.RunContext(check=True)
+                start = time.perf_counter()
+                hh.run_files(files, ctx, executor, args.jobs)
+                timings.append(time.perf_counter() - start)
+            print(f"  {executor:<8} {min(timings):8.3f}s")